@@ -0,0 +1,97 @@
+"""
+    Cross-platform clipboard syncing tool
+    Copyright (C) 2013  Syncboard
+
+    This program is free software; you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation; either version 2 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License along
+    with this program; if not, write to the Free Software Foundation, Inc.,
+    51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+"""
+
+"""
+    Measures how many messages per second a single ConnectionThread can
+    receive, in aggregate, as the number of sending peers grows.
+
+    Run from the src directory:
+
+        python ../bench/bench_receive.py [seconds per run] [peer counts...]
+"""
+
+import os
+import sys
+import time
+from socket import socket, AF_INET, SOCK_STREAM
+from threading import Thread, Event
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'src'))
+
+from network import ConnectionThread, Connection, Message
+
+PAYLOAD = 'x' * 256
+
+def run(peers, duration):
+    received = [0]
+    def on_message(message, conn):
+        received[0] += 1
+
+    thread = ConnectionThread(on_message, None)
+    thread.start()
+
+    listener = socket(AF_INET, SOCK_STREAM)
+    listener.bind(('127.0.0.1', 0))
+    listener.listen(peers)
+    senders = []
+    for i in xrange(peers):
+        s = socket(AF_INET, SOCK_STREAM)
+        s.connect(listener.getsockname())
+        conn, _ = listener.accept()
+        thread.add_connection(Connection(conn))
+        senders.append(s)
+    listener.close()
+
+    # each sender writes batches of small frames as fast as the receiver
+    # lets it
+    frame = Message(1, PAYLOAD).raw() * 64
+    stop = Event()
+    def send(s):
+        try:
+            while not stop.is_set():
+                s.sendall(frame)
+        except Exception:
+            pass
+    workers = [Thread(target=send, args=(s,)) for s in senders]
+    for w in workers:
+        w.daemon = True
+        w.start()
+
+    time.sleep(0.2)
+    start_count = received[0]
+    start = time.time()
+    time.sleep(duration)
+    count = received[0] - start_count
+    elapsed = time.time() - start
+
+    stop.set()
+    for s in senders:
+        s.close()
+    thread.stop()
+    return count / elapsed
+
+def main():
+    duration = float(sys.argv[1]) if len(sys.argv) > 1 else 2.0
+    peer_counts = [int(n) for n in sys.argv[2:]] or [1, 2, 4, 8, 16, 32]
+    print "%6s %14s" % ("peers", "messages/s")
+    for peers in peer_counts:
+        print "%6d %14.0f" % (peers, run(peers, duration))
+
+if __name__ == '__main__':
+    main()
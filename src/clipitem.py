@@ -0,0 +1,265 @@
+"""
+    Cross-platform clipboard syncing tool
+    Copyright (C) 2013  Syncboard
+
+    This program is free software; you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation; either version 2 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License along
+    with this program; if not, write to the Free Software Foundation, Inc.,
+    51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+"""
+
+"""
+    Clipboard contents in several formats at once.
+
+    A copy usually offers the same data in more than one form, such as a
+    web page as HTML and as plain text, and the application that pastes
+    picks the one it understands best. A ClipboardItem holds those
+    representations. It goes over the network as a small manifest that
+    carries the text and any other representations of up to INLINE_SIZE
+    bytes; larger ones are only fetched from the sender by a peer that
+    pastes them.
+"""
+
+from collections import OrderedDict
+from threading import Lock
+import hashlib
+import json
+import os
+import struct
+
+import info
+
+# representations up to this size are sent along with the manifest
+INLINE_SIZE = 16 * 1024
+# and these are always sent with it. Text is what most pastes end up using,
+# and sending it whole lets it be sent as a delta against the last one.
+ALWAYS_INLINE = [info.TXT]
+
+# names of the data types on the wire
+WIRE_NAMES = {
+    info.TXT: 'text/plain',
+    info.HTML: 'text/html',
+    info.RTF: 'text/rtf',
+    info.PNG: 'image/png',
+    info.FILES: 'text/uri-list',
+}
+DATA_TYPES_BY_NAME = dict((name, data_type)
+                          for data_type, name in WIRE_NAMES.iteritems())
+
+# an encoded item starts with the length of its JSON manifest, which is
+# followed by the representations sent inline, in manifest order
+MANIFEST_HEADER = struct.Struct('!I')
+
+class Representation:
+    """The data of an item in one format. It is either known, can be
+    rendered locally, or has to be fetched from the peer the item came
+    from."""
+
+    def __init__(self, data = None, render = None, size = None,
+                 digest = None):
+        self.data = data
+        self.render = render
+        if data is not None:
+            size = len(data)
+        self.size = size
+        # SHA-256 digest of the data, if it is known without rendering it
+        self.digest = digest
+
+    def rendered(self):
+        return self.data is not None
+
+    def available(self):
+        """Return whether the data can be had without the network"""
+        return self.data is not None or self.render is not None
+
+class ClipboardItem:
+    """A clipboard in one or more formats, which are info data types.
+
+    Representations are kept in the order they were added, which is the
+    order of preference. Text is stored UTF-8 encoded.
+
+    Threadsafe.
+
+    """
+
+    def __init__(self, data = None, data_type = info.TXT):
+        self._formats = OrderedDict()
+        self._lock = Lock()
+        # makes manifests of items whose content is not all known unique
+        self._nonce = None
+        if data is not None:
+            self.add(data_type, data)
+
+    def add(self, data_type, data = None, render = None):
+        """Add a representation, either as its data or as a function that
+        returns the data when it is first needed. render may be called from
+        any thread, though not from the network thread, which leaves it to
+        a worker."""
+        if data_type not in WIRE_NAMES:
+            raise ValueError('unknown data type %r' % data_type)
+        if isinstance(data, unicode):
+            data = data.encode('utf-8')
+        with self._lock:
+            self._formats[data_type] = Representation(data, render)
+
+    def data_types(self):
+        with self._lock:
+            return self._formats.keys()
+
+    def data_type(self):
+        """Return the preferred data type, or None if the item is empty"""
+        with self._lock:
+            return next(iter(self._formats), None)
+
+    def __contains__(self, data_type):
+        with self._lock:
+            return data_type in self._formats
+
+    def __len__(self):
+        with self._lock:
+            return len(self._formats)
+
+    def size(self, data_type):
+        """Return the size of a representation, or None if it has not been
+        rendered yet"""
+        with self._lock:
+            return self._formats[data_type].size
+
+    def total_size(self):
+        """Return the size of the representations whose size is known"""
+        with self._lock:
+            return sum(r.size or 0 for r in self._formats.itervalues())
+
+    def available(self, data_type):
+        """Return whether get() can return a representation without it
+        being fetched from a peer"""
+        with self._lock:
+            r = self._formats.get(data_type)
+            return r is not None and r.available()
+
+    def rendered(self, data_type):
+        """Return whether a representation is there as data, without having
+        to be rendered or fetched"""
+        with self._lock:
+            r = self._formats.get(data_type)
+            return r is not None and r.rendered()
+
+    def get(self, data_type):
+        """Return a representation, rendering it if needed. Returns None if
+        the item has no such representation, or it has to be fetched."""
+        with self._lock:
+            r = self._formats.get(data_type)
+            if r is None:
+                return None
+            self._render(r)
+            return r.data
+
+    def _render(self, r):
+        if r.data is None and r.render is not None:
+            r.data = r.render()
+            if isinstance(r.data, unicode):
+                r.data = r.data.encode('utf-8')
+            r.render = None
+            r.size = len(r.data)
+
+    def set_data(self, data_type, data):
+        """Fill in a representation fetched from a peer. Raises ValueError
+        if it doesn't match the manifest."""
+        with self._lock:
+            r = self._formats.get(data_type)
+            if r is None:
+                raise ValueError('no %s in clipboard' % data_type)
+            if r.rendered():
+                return
+            if ((r.size is not None and len(data) != r.size) or
+                    (r.digest is not None and
+                     hashlib.sha256(data).digest() != r.digest)):
+                raise ValueError('%s does not match the clipboard' %
+                                 data_type)
+            r.data = data
+            r.render = None
+            r.size = len(data)
+
+    def encode(self, inline_size = INLINE_SIZE, always = ALWAYS_INLINE):
+        """Return the item as a string to be sent to peers, and a dictionary
+        of the rendered representations that are not in it, by data type.
+        Representations of the types in always are rendered if needed and
+        sent whatever their size."""
+        entries = []
+        inline = []
+        left_out = {}
+        with self._lock:
+            for data_type, r in self._formats.iteritems():
+                name = WIRE_NAMES[data_type]
+                if data_type in always:
+                    self._render(r)
+                if not r.rendered():
+                    # sent without a digest, so tell apart items that
+                    # would otherwise have the same manifest
+                    if self._nonce is None:
+                        self._nonce = os.urandom(8).encode('hex')
+                    entries.append([name, None, None, False])
+                    continue
+                digest = hashlib.sha256(r.data).hexdigest()
+                if r.size <= inline_size or data_type in always:
+                    entries.append([name, r.size, digest, True])
+                    inline.append(r.data)
+                else:
+                    entries.append([name, r.size, digest, False])
+                    left_out[data_type] = r.data
+            manifest = {'formats': entries}
+            if self._nonce is not None:
+                manifest['nonce'] = self._nonce
+        manifest = json.dumps(manifest)
+        return (MANIFEST_HEADER.pack(len(manifest)) + manifest +
+                ''.join(inline), left_out)
+
+    @staticmethod
+    def decode(payload):
+        """Return the ClipboardItem encoded in the given string. The
+        representations that were not sent with it still have to be
+        fetched. Formats we don't know are skipped.
+
+        Raises ValueError if the payload is malformed.
+
+        """
+        payload = memoryview(payload)
+        if len(payload) < MANIFEST_HEADER.size:
+            raise ValueError('short clipboard')
+        length, = MANIFEST_HEADER.unpack_from(payload)
+        offset = MANIFEST_HEADER.size + length
+        try:
+            manifest = json.loads(payload[MANIFEST_HEADER.size:offset]
+                                  .tobytes())
+            entries = manifest['formats']
+            item = ClipboardItem()
+            item._nonce = manifest.get('nonce')
+            for name, size, digest, inline in entries:
+                if digest is not None:
+                    digest = str(digest).decode('hex')
+                if inline:
+                    end = offset + size
+                    if size < 0 or end > len(payload):
+                        raise ValueError('clipboard is truncated')
+                    data = payload[offset:end].tobytes()
+                    offset = end
+                else:
+                    data = None
+                data_type = DATA_TYPES_BY_NAME.get(name)
+                if data_type is not None:
+                    item._formats[data_type] = Representation(
+                        data, size=size, digest=digest)
+        except (KeyError, TypeError, AttributeError) as e:
+            raise ValueError('malformed clipboard manifest: %s' % e)
+        if offset != len(payload):
+            raise ValueError('clipboard has trailing data')
+        return item
@@ -0,0 +1,201 @@
+"""
+    Cross-platform clipboard syncing tool
+    Copyright (C) 2013  Syncboard
+
+    This program is free software; you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation; either version 2 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License along
+    with this program; if not, write to the Free Software Foundation, Inc.,
+    51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+"""
+
+"""
+    Finding out that the OS clipboard changed, without reading it.
+
+    Where the platform keeps a change counter for the clipboard, it is
+    compared instead of the contents. On X11, the XFixes extension also
+    sends an event when the clipboard changes hands, so nothing needs to be
+    polled at all. Elsewhere, the clipboard has to be read and compared.
+"""
+
+from threading import Thread, Lock
+import ctypes
+import ctypes.util
+import select
+import struct
+import sys
+
+# how often the XFixes thread checks whether it has been stopped, in seconds
+STOP_INTERVAL = 0.5
+
+class Watcher:
+    """Reads nothing and tells nothing: the clipboard has to be compared on
+    every check.
+
+    sequence() returns a number that changes whenever the clipboard does,
+    or None if the watcher can't tell. Watchers that are event_driven call
+    their callback, in a thread of their own, after every change.
+
+    """
+
+    event_driven = False
+
+    def __init__(self, callback = None):
+        self._callback = callback
+
+    def start(self):
+        pass
+
+    def stop(self):
+        pass
+
+    def sequence(self):
+        return None
+
+class CounterWatcher(Watcher):
+    """Polls a change counter the platform keeps for the clipboard"""
+
+    def __init__(self, counter, callback = None):
+        Watcher.__init__(self, callback)
+        self._counter = counter
+
+    def sequence(self):
+        return self._counter()
+
+class XFixesWatcher(Watcher):
+    """Listens for XFixes selection events on the X11 CLIPBOARD selection,
+    on a display connection of its own"""
+
+    event_driven = True
+
+    # XFixesSelectSelectionInput masks
+    SET_SELECTION_OWNER = 1 << 0
+    SELECTION_WINDOW_DESTROY = 1 << 1
+    SELECTION_CLIENT_CLOSE = 1 << 2
+    # event number of XFixesSelectionNotify, relative to the extension's base
+    SELECTION_NOTIFY = 0
+    # sizeof(XEvent), a union padded to 24 longs
+    EVENT_SIZE = 24 * ctypes.sizeof(ctypes.c_long)
+
+    def __init__(self, callback = None, selection = 'CLIPBOARD'):
+        """Raises OSError if X11 or XFixes is not there"""
+        Watcher.__init__(self, callback)
+        self._xlib = _load('X11')
+        xfixes = _load('Xfixes')
+        self._xlib.XOpenDisplay.restype = ctypes.c_void_p
+        self._xlib.XOpenDisplay.argtypes = [ctypes.c_char_p]
+        self._xlib.XDefaultRootWindow.restype = ctypes.c_ulong
+        self._xlib.XDefaultRootWindow.argtypes = [ctypes.c_void_p]
+        self._xlib.XInternAtom.restype = ctypes.c_ulong
+        self._xlib.XInternAtom.argtypes = [ctypes.c_void_p, ctypes.c_char_p,
+                                           ctypes.c_int]
+        for name in ('XConnectionNumber', 'XPending', 'XFlush',
+                     'XCloseDisplay'):
+            getattr(self._xlib, name).argtypes = [ctypes.c_void_p]
+        self._xlib.XNextEvent.argtypes = [ctypes.c_void_p, ctypes.c_char_p]
+        xfixes.XFixesQueryExtension.argtypes = [
+            ctypes.c_void_p, ctypes.POINTER(ctypes.c_int),
+            ctypes.POINTER(ctypes.c_int)]
+        xfixes.XFixesSelectSelectionInput.argtypes = [
+            ctypes.c_void_p, ctypes.c_ulong, ctypes.c_ulong, ctypes.c_ulong]
+
+        self._display = self._xlib.XOpenDisplay(None)
+        if not self._display:
+            raise OSError('cannot open the X display')
+        event_base = ctypes.c_int()
+        error_base = ctypes.c_int()
+        if not xfixes.XFixesQueryExtension(self._display,
+                                           ctypes.byref(event_base),
+                                           ctypes.byref(error_base)):
+            self._xlib.XCloseDisplay(self._display)
+            raise OSError('the X server has no XFixes extension')
+        self._notify = event_base.value + self.SELECTION_NOTIFY
+        atom = self._xlib.XInternAtom(self._display, selection, 0)
+        xfixes.XFixesSelectSelectionInput(
+            self._display, self._xlib.XDefaultRootWindow(self._display), atom,
+            self.SET_SELECTION_OWNER | self.SELECTION_WINDOW_DESTROY |
+            self.SELECTION_CLIENT_CLOSE)
+        self._xlib.XFlush(self._display)
+
+        self._lock = Lock()
+        self._sequence = 0
+        self._running = False
+        self._thread = Thread(target=self._loop)
+        self._thread.daemon = True
+
+    def start(self):
+        self._running = True
+        self._thread.start()
+
+    def stop(self):
+        if self._running:
+            self._running = False
+            self._thread.join()
+
+    def sequence(self):
+        with self._lock:
+            return self._sequence
+
+    def _loop(self):
+        fd = self._xlib.XConnectionNumber(self._display)
+        event = ctypes.create_string_buffer(self.EVENT_SIZE)
+        while self._running:
+            select.select([fd], [], [], STOP_INTERVAL)
+            changed = False
+            while self._xlib.XPending(self._display):
+                self._xlib.XNextEvent(self._display, event)
+                event_type, = struct.unpack_from('i', event.raw)
+                if event_type == self._notify:
+                    changed = True
+            if changed:
+                with self._lock:
+                    self._sequence += 1
+                if self._callback:
+                    self._callback()
+        self._xlib.XCloseDisplay(self._display)
+
+def _load(name):
+    path = ctypes.util.find_library(name)
+    if not path:
+        raise OSError('lib%s not found' % name)
+    return ctypes.cdll.LoadLibrary(path)
+
+def _windows_counter():
+    return ctypes.windll.user32.GetClipboardSequenceNumber
+
+def _mac_counter():
+    # PyObjC is optional
+    try:
+        from AppKit import NSPasteboard
+    except ImportError:
+        raise OSError('PyObjC is not installed')
+    return NSPasteboard.generalPasteboard().changeCount
+
+def create(callback = None):
+    """Return the best Watcher this platform has, started. callback is
+    called from another thread after each change, if the watcher is
+    event_driven."""
+    if sys.platform == 'win32':
+        factories = [lambda: CounterWatcher(_windows_counter(), callback)]
+    elif sys.platform == 'darwin':
+        factories = [lambda: CounterWatcher(_mac_counter(), callback)]
+    else:
+        factories = [lambda: XFixesWatcher(callback)]
+    for factory in factories:
+        try:
+            watcher = factory()
+            break
+        except (OSError, AttributeError) as e:
+            print "Polling the clipboard: %s" % e
+    else:
+        watcher = Watcher(callback)
+    watcher.start()
+    return watcher
@@ -0,0 +1,137 @@
+"""
+    Cross-platform clipboard syncing tool
+    Copyright (C) 2013  Syncboard
+
+    This program is free software; you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation; either version 2 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License along
+    with this program; if not, write to the Free Software Foundation, Inc.,
+    51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+"""
+
+"""
+    Payload compression for frames sent over the wire.
+
+    Each peer lists the codecs it can decode when a connection is set up, and
+    the sender uses the first codec of its own preference list that the peer
+    also has. Compressed frames name their codec in the header flags, so a
+    peer that offers no codecs (or an older one that doesn't know about
+    compression) is simply never sent compressed frames.
+
+    zlib is always available; lz4 and zstd are used when their modules are
+    installed.
+"""
+
+import struct
+import zlib
+
+try:
+    import lz4.frame as _lz4
+except ImportError:
+    _lz4 = None
+
+try:
+    import zstandard as _zstd
+except ImportError:
+    _zstd = None
+
+# The low bits of a frame's flags hold the id of the codec its payload is
+# compressed with, or 0 if it isn't compressed.
+FLAG_MASK = 0x03
+
+# payloads smaller than this are not worth compressing
+THRESHOLD = 512
+# how much of a payload is compressed to judge whether the rest will compress
+SAMPLE_SIZE = 16 * 1024
+# compression is skipped unless it shrinks the sample to this fraction of its
+# size or less
+MAX_RATIO = 0.9
+
+# compressed payloads start with the size of the uncompressed data
+LENGTH = struct.Struct('!I')
+
+class Codec:
+    def __init__(self, name, codec_id, compress, decompress):
+        self.name = name
+        self.id = codec_id
+        self._compress = compress
+        self._decompress = decompress
+
+    def compress(self, data):
+        """Return the compressed form of data, a string or memoryview"""
+        if isinstance(data, memoryview):
+            data = data.tobytes()
+        return LENGTH.pack(len(data)) + self._compress(data)
+
+    def decompress(self, data, max_size):
+        """Return the data that compress() was given.
+
+        Raises ValueError if the data is corrupt, or would decompress to more
+        than max_size bytes.
+
+        """
+        if isinstance(data, memoryview):
+            data = data.tobytes()
+        if len(data) < LENGTH.size:
+            raise ValueError('compressed payload too short')
+        size, = LENGTH.unpack_from(data)
+        if size > max_size:
+            raise ValueError('compressed payload too large (%d bytes)' % size)
+        try:
+            result = self._decompress(data[LENGTH.size:], size)
+        except Exception as e:
+            raise ValueError('corrupt compressed payload: %s' % e)
+        if len(result) != size:
+            raise ValueError('compressed payload has the wrong size')
+        return result
+
+    def worth_using(self, data):
+        """Guess whether compressing data would save enough to be worth it,
+        by compressing a sample of it"""
+        if len(data) < THRESHOLD:
+            return False
+        sample = data[:SAMPLE_SIZE]
+        return len(self.compress(sample)) <= len(sample) * MAX_RATIO
+
+def _zlib_decompress(data, size):
+    d = zlib.decompressobj()
+    # never produce more than we were told to expect
+    return d.decompress(data, size + 1)
+
+_codecs = [Codec('zlib', 1, lambda data: zlib.compress(data, 6),
+                 _zlib_decompress)]
+if _lz4:
+    _codecs.append(Codec('lz4', 2, _lz4.compress,
+                         lambda data, size: _lz4.decompress(data)))
+if _zstd:
+    _codecs.append(Codec('zstd', 3,
+                         lambda data: _zstd.ZstdCompressor().compress(data),
+                         lambda data, size: _zstd.ZstdDecompressor()
+                             .decompress(data, max_output_size=size)))
+
+_by_id = dict((c.id, c) for c in _codecs)
+
+def names():
+    """Return the names of the available codecs, most preferred first"""
+    return [c.name for c in reversed(_codecs)]
+
+def choose(offered):
+    """Return our most preferred Codec from the list of names a peer offered,
+    or None if we have none in common"""
+    for c in reversed(_codecs):
+        if c.name in offered:
+            return c
+    return None
+
+def get(codec_id):
+    """Return the Codec with the given id. Raises KeyError if there is
+    none."""
+    return _by_id[codec_id]
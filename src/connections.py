@@ -17,35 +17,61 @@
     51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
 """
 
-from socket import gethostbyname
+from registry import Registry
 
 MAX_ALIAS_LENGTH = 50
 MAX_ADDRESS_LENGTH = 15
 
 class ConnectionManager:
+    """The connections the user knows about, by address. Threadsafe, since
+    the network reports status changes from its own thread."""
+
     def __init__(self):
-        self.connections = []
+        self._registry = Registry()
+
+    def get_connections(self):
+        return self._registry.entries()
 
     def get_connection(self, address):
-        for con in self.connections:
-            if con.address == address:
-                return con
-        return None
+        return self._registry.get(address)
 
     def new_connection(self, alias, address, status=None):
-        address = gethostbyname(address)
+        """address must already be resolved to canonical form"""
         if not status:
             #status = Connection.PENDING
             status = Connection.CONNECTED
-        if self.get_connection(address):
+        if not self._registry.add(Connection(alias, address, status), address):
             print "Error: connection to %s already exists" % address
-        else:
-            self.connections.append(Connection(alias, address, status))
 
     def del_connection(self, address):
         c = self.get_connection(address)
         if c:
-            self.connections.remove(c)
+            self._registry.remove(c)
+
+    def set_status(self, address, status):
+        """Change the status of the connection to address, and tell the
+        subscribers. Returns False if there is no such connection."""
+        c = self.get_connection(address)
+        if not c:
+            return False
+        c.status = status
+        self._registry.changed(c)
+        return True
+
+    def set_alias(self, address, alias):
+        """Change the alias of the connection to address, and tell the
+        subscribers. Returns False if there is no such connection."""
+        c = self.get_connection(address)
+        if not c:
+            return False
+        c.alias = alias
+        self._registry.changed(c)
+        return True
+
+    def subscribe(self, callback):
+        """Call callback(event, connection) whenever a connection is added,
+        removed or changes status. event is one of the Registry constants."""
+        self._registry.subscribe(callback)
 
 class Connection:
     NOT_CONNECTED, CONNECTED, PENDING, REQUEST = range(4)
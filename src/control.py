@@ -0,0 +1,302 @@
+"""
+    Cross-platform clipboard syncing tool
+    Copyright (C) 2013  Syncboard
+
+    This program is free software; you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation; either version 2 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License along
+    with this program; if not, write to the Free Software Foundation, Inc.,
+    51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+"""
+
+"""
+    Controlling a running Syncboard from scripts, over a Unix domain socket.
+
+    Each request is a connection. The client sends a line naming the
+    command and its argument, if any:
+
+        COPY <wire name>    followed by the data, up to the end of the
+                            client's side of the stream
+        PASTE <wire name>
+        STATUS
+
+    The server answers with "OK\n", followed for PASTE by the data and for
+    STATUS by a JSON object, up to the end of the stream, or with
+    "ERROR <message>\n".
+
+    The client half of this module doesn't import the network stack, so
+    that a command line call costs only milliseconds.
+"""
+
+from threading import Thread
+import errno
+import json
+import os
+import socket
+
+from clipitem import WIRE_NAMES, DATA_TYPES_BY_NAME
+from connections import Connection
+import state
+
+# how much is read or written at a time
+BUFFER_SIZE = 64 * 1024
+# the longest request line
+MAX_LINE = 1024
+# how often the server thread checks whether it has been stopped, in seconds
+STOP_INTERVAL = 0.5
+# how connection statuses are described by STATUS
+STATUS_NAMES = {
+    Connection.NOT_CONNECTED: 'not connected',
+    Connection.CONNECTED: 'connected',
+    Connection.PENDING: 'connecting',
+    Connection.REQUEST: 'requested',
+}
+
+COPY, PASTE, STATUS = 'COPY', 'PASTE', 'STATUS'
+DEFAULT_TYPE = 'text/plain'
+
+class ControlError(Exception):
+    """The server refused a request, or could not be reached"""
+    pass
+
+def default_path():
+    """Return where the control socket of the current user's Syncboard is"""
+    return os.path.join(os.path.dirname(state.default_path()), 'control')
+
+def available():
+    """Return whether the platform has Unix domain sockets"""
+    return hasattr(socket, 'AF_UNIX')
+
+class ControlServer:
+    """Serves requests on a Unix domain socket for a session.Session, each
+    one in a thread of its own, since PASTE can wait for a peer.
+
+    Only the user running it can connect, as the socket is made readable
+    and writable by nobody else.
+
+    """
+
+    def __init__(self, session, path):
+        """Raises socket.error if the socket can't be created, or another
+        instance is serving on it already"""
+        self._session = session
+        self._path = path
+        directory = os.path.dirname(path)
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory)
+        if os.path.exists(path):
+            # left behind by an instance that didn't exit cleanly, unless
+            # someone answers on it
+            try:
+                _connect(path).close()
+            except socket.error:
+                os.remove(path)
+            else:
+                raise socket.error(errno.EADDRINUSE,
+                                   '%s is in use by another instance' % path)
+        self._socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self._socket.bind(path)
+        os.chmod(path, 0600)
+        self._socket.listen(5)
+        self._socket.settimeout(STOP_INTERVAL)
+        self._running = False
+        self._thread = Thread(target=self._serve)
+        self._thread.daemon = True
+
+    def start(self):
+        self._running = True
+        self._thread.start()
+
+    def stop(self):
+        if self._running:
+            self._running = False
+            self._thread.join()
+        self._socket.close()
+        try:
+            os.remove(self._path)
+        except OSError:
+            pass
+
+    def _serve(self):
+        while self._running:
+            try:
+                client, _ = self._socket.accept()
+            except socket.timeout:
+                continue
+            except socket.error as e:
+                print "Control socket: %s" % e
+                continue
+            client.settimeout(None)
+            t = Thread(target=self._handle, args=(client,))
+            t.daemon = True
+            t.start()
+
+    def _handle(self, client):
+        try:
+            request = _read_line(client)
+            if request is None:
+                # only checking that we are here
+                return
+            line, data = request
+            command, _, argument = line.partition(' ')
+            if command == COPY:
+                self._copy(client, argument or DEFAULT_TYPE, data)
+            elif command == PASTE:
+                self._paste(client, argument or DEFAULT_TYPE)
+            elif command == STATUS:
+                self._status(client)
+            else:
+                _error(client, 'unknown command %r' % command)
+        except socket.error as e:
+            print "Control client: %s" % e
+        finally:
+            client.close()
+
+    def _copy(self, client, name, data):
+        # kept as a list of chunks, so joining them is the only copy
+        chunks = [data]
+        while True:
+            chunk = client.recv(BUFFER_SIZE)
+            if not chunk:
+                break
+            chunks.append(chunk)
+        data_type = DATA_TYPES_BY_NAME.get(name)
+        if data_type is None:
+            _error(client, 'unknown data type %s' % name)
+            return
+        self._session.set_clipboard_data(''.join(chunks), data_type)
+        client.sendall('OK\n')
+
+    def _paste(self, client, name):
+        data_type = DATA_TYPES_BY_NAME.get(name)
+        if data_type is None:
+            _error(client, 'unknown data type %s' % name)
+            return
+        data = self._session.get_clipboard_data(data_type)
+        if data is None:
+            _error(client, 'the clipboard has no %s' % name)
+            return
+        client.sendall('OK\n')
+        view = memoryview(data)
+        for offset in xrange(0, len(view), BUFFER_SIZE):
+            client.sendall(view[offset:offset + BUFFER_SIZE])
+
+    def _status(self, client):
+        item = self._session.get_clipboard_item()
+        status = {
+            'clipboard': [[WIRE_NAMES[t], item.size(t)]
+                          for t in item.data_types()],
+            'connections': sorted([c.address, c.alias,
+                                   STATUS_NAMES.get(c.status, str(c.status))]
+                                  for c in self._session.connections()),
+            'statistics': self._session.get_statistics(),
+        }
+        client.sendall('OK\n' + json.dumps(status))
+
+def _connect(path):
+    s = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        s.connect(path)
+    except socket.error:
+        s.close()
+        raise
+    return s
+
+def _read_line(sock):
+    """Return the first line from a socket, without its newline, and
+    whatever was read after it. Returns None if the socket was closed
+    before anything was sent."""
+    data = ''
+    while '\n' not in data:
+        if len(data) > MAX_LINE:
+            raise socket.error('line too long')
+        chunk = sock.recv(MAX_LINE)
+        if not chunk and not data:
+            return None
+        if not chunk:
+            raise socket.error('connection closed early')
+        data += chunk
+    line, _, rest = data.partition('\n')
+    return line, rest
+
+def _error(client, message):
+    client.sendall('ERROR %s\n' % message)
+
+def _request(path, command, argument = None):
+    """Connect and send a request line. Returns the socket."""
+    try:
+        s = _connect(path)
+    except socket.error as e:
+        raise ControlError('Syncboard is not running at %s: %s' %
+                           (path, e.strerror or e))
+    line = command if argument is None else '%s %s' % (command, argument)
+    s.sendall(line + '\n')
+    return s
+
+def _reply(s):
+    """Read the answer line, raising ControlError if it is an error.
+    Returns what came after it."""
+    try:
+        reply = _read_line(s)
+    except socket.error as e:
+        raise ControlError('no answer from Syncboard: %s' % e)
+    if reply is None:
+        raise ControlError('no answer from Syncboard')
+    line, rest = reply
+    if line != 'OK':
+        raise ControlError(line.partition(' ')[2] or line)
+    return rest
+
+def copy(stream, data_type = DEFAULT_TYPE, path = None):
+    """Set the shared clipboard to what can be read from a file object, in
+    the format with the given wire name, streaming it to the server"""
+    s = _request(path or default_path(), COPY, data_type)
+    try:
+        while True:
+            chunk = stream.read(BUFFER_SIZE)
+            if not chunk:
+                break
+            s.sendall(chunk)
+        s.shutdown(socket.SHUT_WR)
+        _reply(s)
+    finally:
+        s.close()
+
+def paste(stream, data_type = DEFAULT_TYPE, path = None):
+    """Write the shared clipboard, in the format with the given wire name, to
+    a file object as it arrives"""
+    s = _request(path or default_path(), PASTE, data_type)
+    try:
+        s.shutdown(socket.SHUT_WR)
+        stream.write(_reply(s))
+        while True:
+            chunk = s.recv(BUFFER_SIZE)
+            if not chunk:
+                break
+            stream.write(chunk)
+    finally:
+        s.close()
+
+def status(path = None):
+    """Return a dictionary describing the clipboard, the connections and
+    the traffic so far"""
+    s = _request(path or default_path(), STATUS)
+    try:
+        s.shutdown(socket.SHUT_WR)
+        chunks = [_reply(s)]
+        while True:
+            chunk = s.recv(BUFFER_SIZE)
+            if not chunk:
+                break
+            chunks.append(chunk)
+    finally:
+        s.close()
+    return json.loads(''.join(chunks))
@@ -0,0 +1,187 @@
+"""
+    Cross-platform clipboard syncing tool
+    Copyright (C) 2013  Syncboard
+
+    This program is free software; you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation; either version 2 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License along
+    with this program; if not, write to the Free Software Foundation, Inc.,
+    51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+"""
+
+"""
+    Running Syncboard without a GUI, on servers and in containers.
+
+    The daemon has no clipboard of its own to watch: it holds the shared
+    clipboard, relays it if asked to, and lets peers fetch from it. It
+    never imports wx, so it starts quickly and runs where there is no
+    display. Settings come from a config file, overridden by the command
+    line.
+
+    Config file, by default ~/.syncboard/syncboard.conf:
+
+        [syncboard]
+        port = 24749
+        peers = host-a host-b
+        relay = yes
+        announce = no
+        prefetch_size = 0
+        state = /var/lib/syncboard/state
+        control = /run/syncboard/control
+
+    Scripts talk to it through the control socket, with syncboard.py.
+"""
+
+from ConfigParser import RawConfigParser, Error as ConfigError
+from threading import Event
+import argparse
+import os
+import signal
+import sys
+
+from network import DEFAULT_PORT
+from session import Session
+import control
+import state
+
+SECTION = 'syncboard'
+# how often the main thread checks whether it has been told to stop, in
+# seconds. Waiting without a timeout would keep signals from being handled.
+STOP_INTERVAL = 0.5
+
+def default_config_path():
+    return os.path.join(os.path.dirname(state.default_path()),
+                        'syncboard.conf')
+
+def read_config(path):
+    """Return the settings in a config file as a dictionary of the keyword
+    arguments to Daemon. A missing file has none. Raises ValueError if the
+    file is malformed."""
+    parser = RawConfigParser()
+    try:
+        if not parser.read(path) or not parser.has_section(SECTION):
+            return {}
+        settings = {}
+        if parser.has_option(SECTION, 'port'):
+            settings['port'] = parser.getint(SECTION, 'port')
+        if parser.has_option(SECTION, 'peers'):
+            settings['peers'] = parser.get(SECTION, 'peers').replace(
+                ',', ' ').split()
+        for name in ('relay', 'announce'):
+            if parser.has_option(SECTION, name):
+                settings[name] = parser.getboolean(SECTION, name)
+        if parser.has_option(SECTION, 'prefetch_size'):
+            settings['prefetch_size'] = parser.getint(SECTION,
+                                                      'prefetch_size')
+        if parser.has_option(SECTION, 'state'):
+            settings['state_path'] = parser.get(SECTION, 'state') or None
+        if parser.has_option(SECTION, 'control'):
+            settings['control_path'] = (parser.get(SECTION, 'control') or
+                                        None)
+    except (ConfigError, ValueError) as e:
+        raise ValueError('%s: %s' % (path, e))
+    return settings
+
+def parse_args(argv):
+    """Return the Daemon settings from the config file and the command
+    line arguments (without the program name), which take precedence.
+    Exits with a usage message if they are wrong."""
+    parser = argparse.ArgumentParser(
+        prog='syncboard-daemon',
+        description='Share a clipboard with other computers, without a GUI.')
+    parser.add_argument('-c', '--config', default=default_config_path(),
+                        help='config file (default: %(default)s)')
+    parser.add_argument('-p', '--port', type=int,
+                        help='port to listen on and connect to (default: '
+                        '%d)' % DEFAULT_PORT)
+    parser.add_argument('peers', nargs='*', metavar='PEER',
+                        help='host to stay connected to, besides those in '
+                        'the config file and the saved state')
+    parser.add_argument('--relay', action='store_true', default=None,
+                        help='pass clipboards on between peers')
+    parser.add_argument('--announce', action='store_true', default=None,
+                        help='send clipboards only when peers paste them')
+    parser.add_argument('--prefetch-size', type=int,
+                        help='fetch announced clipboards up to this many '
+                        'bytes straight away')
+    parser.add_argument('--state', dest='state_path',
+                        help='file to keep connections and the clipboard '
+                        'in between runs (default: %s)' % state.default_path())
+    parser.add_argument('--no-state', action='store_true',
+                        help='forget everything on exit')
+    parser.add_argument('--control', dest='control_path',
+                        help='Unix domain socket to take commands on '
+                        '(default: %s)' % control.default_path())
+    parser.add_argument('--no-control', action='store_true',
+                        help="don't take commands")
+    args = parser.parse_args(argv)
+
+    try:
+        settings = read_config(args.config)
+    except ValueError as e:
+        parser.error(str(e))
+    settings.setdefault('state_path', state.default_path())
+    settings.setdefault('control_path', control.default_path())
+    for name in ('port', 'relay', 'announce', 'prefetch_size', 'state_path',
+                 'control_path'):
+        value = getattr(args, name)
+        if value is not None:
+            settings[name] = value
+    settings['peers'] = settings.get('peers', []) + args.peers
+    if args.no_state:
+        settings['state_path'] = None
+    if args.no_control:
+        settings['control_path'] = None
+    return settings
+
+class Daemon:
+    """A Session without a GUI, connected to a list of peers"""
+
+    def __init__(self, port = DEFAULT_PORT, peers = (), relay = False,
+                 announce = False, prefetch_size = 0, state_path = None,
+                 control_path = None):
+        self._peers = list(peers)
+        self.session = Session(relay=relay, announce=announce,
+                               prefetch_size=prefetch_size,
+                               state_path=state_path, port=port,
+                               control_path=control_path)
+        self._stop = Event()
+
+    def start(self):
+        for peer in self._peers:
+            self.session.new_connection(peer, peer)
+
+    def stop(self):
+        """Make run() return. Can be called from any thread, or a signal
+        handler."""
+        self._stop.set()
+
+    def run(self):
+        """Serve until stop() is called, and close the Session"""
+        try:
+            while not self._stop.is_set():
+                self._stop.wait(STOP_INTERVAL)
+        finally:
+            self.session.close()
+
+def main(argv = None):
+    settings = parse_args(sys.argv[1:] if argv is None else argv)
+    daemon = Daemon(**settings)
+    def stop(signum, frame):
+        daemon.stop()
+    signal.signal(signal.SIGINT, stop)
+    signal.signal(signal.SIGTERM, stop)
+    daemon.start()
+    daemon.run()
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
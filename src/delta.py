@@ -0,0 +1,199 @@
+"""
+    Cross-platform clipboard syncing tool
+    Copyright (C) 2013  Syncboard
+
+    This program is free software; you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation; either version 2 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License along
+    with this program; if not, write to the Free Software Foundation, Inc.,
+    51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+"""
+
+"""
+    Compact binary diffs between two versions of a clipboard.
+
+    A delta describes the target as a sequence of operations: copy a range of
+    bytes from the base, or insert literal bytes. The common prefix and
+    suffix of the two versions are found first; what lies between them is
+    matched line by line, so that a few scattered edits to a large block of
+    text turn into a handful of copies and some short inserts. Binary data
+    without line breaks still gets its common prefix and suffix copied.
+"""
+
+import struct
+
+# the delta starts with the length of the target
+LENGTH = struct.Struct('!I')
+# copy (offset in base, length) from the base
+COPY = 'C'
+COPY_ARGS = struct.Struct('!II')
+# insert (length) literal bytes, which follow
+INSERT = 'I'
+INSERT_ARGS = struct.Struct('!I')
+
+# copies shorter than this are sent as inserts instead, since the operation
+# itself costs about this much
+MIN_COPY = 32
+# prefixes and suffixes are compared in blocks of this size
+BLOCK_SIZE = 4096
+
+def make(base, target):
+    """Return a delta that turns base into target, or None if it would not be
+    smaller than target itself. Both must be strings."""
+    prefix = _common_prefix(base, target)
+    suffix = _common_suffix(base, target, prefix)
+
+    ops = []
+    if prefix:
+        ops.append((COPY, 0, prefix))
+    _diff_lines(base, prefix, len(base) - suffix,
+                target[prefix:len(target) - suffix], ops)
+    if suffix:
+        ops.append((COPY, len(base) - suffix, suffix))
+
+    delta = _encode(_merge(ops, base), len(target))
+    if len(delta) >= len(target):
+        return None
+    return delta
+
+def apply(base, delta):
+    """Return the target that delta was made from, given its base.
+
+    Raises ValueError if the delta is malformed or doesn't fit the base.
+
+    """
+    if isinstance(delta, memoryview):
+        delta = delta.tobytes()
+    if len(delta) < LENGTH.size:
+        raise ValueError('delta too short')
+    length, = LENGTH.unpack_from(delta)
+    pos = LENGTH.size
+    parts = []
+    size = 0
+    try:
+        while pos < len(delta):
+            op = delta[pos]
+            pos += 1
+            if op == COPY:
+                offset, n = COPY_ARGS.unpack_from(delta, pos)
+                pos += COPY_ARGS.size
+                if offset + n > len(base):
+                    raise ValueError('copy past the end of the base')
+                parts.append(base[offset:offset + n])
+            elif op == INSERT:
+                n, = INSERT_ARGS.unpack_from(delta, pos)
+                pos += INSERT_ARGS.size
+                if pos + n > len(delta):
+                    raise ValueError('insert past the end of the delta')
+                parts.append(delta[pos:pos + n])
+                pos += n
+            else:
+                raise ValueError('unknown delta operation %r' % op)
+            size += n
+            if size > length:
+                raise ValueError('delta produces too much data')
+    except struct.error:
+        raise ValueError('truncated delta')
+    if size != length:
+        raise ValueError('delta produces the wrong amount of data')
+    return ''.join(parts)
+
+def _common_prefix(a, b):
+    n = min(len(a), len(b))
+    i = 0
+    # skip over equal blocks, then narrow down within the first unequal one
+    while i + BLOCK_SIZE <= n and \
+            buffer(a, i, BLOCK_SIZE) == buffer(b, i, BLOCK_SIZE):
+        i += BLOCK_SIZE
+    while i < n and a[i] == b[i]:
+        i += 1
+    return i
+
+def _common_suffix(a, b, prefix):
+    # the suffix may not overlap the prefix in either string
+    n = min(len(a), len(b)) - prefix
+    i = 0
+    while i + BLOCK_SIZE <= n and \
+            buffer(a, len(a) - i - BLOCK_SIZE, BLOCK_SIZE) == \
+            buffer(b, len(b) - i - BLOCK_SIZE, BLOCK_SIZE):
+        i += BLOCK_SIZE
+    while i < n and a[len(a) - i - 1] == b[len(b) - i - 1]:
+        i += 1
+    return i
+
+def _diff_lines(base, start, end, target, ops):
+    """Append operations producing target to ops, copying lines found in
+    base[start:end]"""
+    if not target:
+        return
+    base_lines = base[start:end].splitlines(True)
+    if not base_lines:
+        ops.append((INSERT, target))
+        return
+
+    # offset of the first occurrence of each line in the base
+    offsets = {}
+    offset = start
+    for line in base_lines:
+        offsets.setdefault(line, offset)
+        offset += len(line)
+
+    # offset in the base just after the last line copied, where the next
+    # target line is most likely to continue from
+    expected = None
+    for line in target.splitlines(True):
+        n = len(line)
+        if expected is not None and \
+                buffer(base, expected, n) == line:
+            ops.append((COPY, expected, n))
+            expected += n
+        elif line in offsets:
+            ops.append((COPY, offsets[line], n))
+            expected = offsets[line] + n
+        else:
+            ops.append((INSERT, line))
+            expected = None
+
+def _merge(ops, base):
+    """Join adjacent operations, and turn copies too short to be worth it
+    into inserts"""
+    copies = []
+    for op in ops:
+        if copies and op[0] == COPY and copies[-1][0] == COPY and \
+                copies[-1][1] + copies[-1][2] == op[1]:
+            copies[-1] = (COPY, copies[-1][1], copies[-1][2] + op[2])
+        else:
+            copies.append(op)
+
+    # inserts collect their pieces in a list, joined when encoding
+    result = []
+    for op in copies:
+        if op[0] == COPY and op[2] < MIN_COPY:
+            op = (INSERT, base[op[1]:op[1] + op[2]])
+        if op[0] == INSERT:
+            if result and result[-1][0] == INSERT:
+                result[-1][1].append(op[1])
+            else:
+                result.append((INSERT, [op[1]]))
+        else:
+            result.append(op)
+    return result
+
+def _encode(ops, length):
+    parts = [LENGTH.pack(length)]
+    for op in ops:
+        if op[0] == COPY:
+            parts.append(COPY + COPY_ARGS.pack(op[1], op[2]))
+        else:
+            data = ''.join(op[1])
+            parts.append(INSERT + INSERT_ARGS.pack(len(data)))
+            parts.append(data)
+    return ''.join(parts)
@@ -29,8 +29,21 @@ from gui_status import StatusPanel
 from gui_clipboard import ClipboardPanel
 from gui_connections import ConnectionsPanel
 from session import Session
+import control
+import state
+from connections import Connection
 
 FRAME_SIZE = (550, 510)
+# how many recent clipboards the History menu lists
+HISTORY_MENU_ITEMS = 10
+# how much of a text clipboard a menu item shows
+HISTORY_LABEL_LENGTH = 40
+# status bar text for connection status changes
+STATUS_TEXT = {
+    Connection.PENDING: "Connecting to %s...",
+    Connection.CONNECTED: "Connected to %s",
+    Connection.NOT_CONNECTED: "Not connected to %s",
+}
 BGD_COLOR = (240, 240, 240)
 
 class MainFrame(wx.Frame):
@@ -38,7 +51,11 @@ class MainFrame(wx.Frame):
     def __init__(self, *args, **kwargs):
         wx.Frame.__init__(self, *args, **kwargs)
 
-        self.session = Session()
+        self.session = Session(progress_callback=self.on_progress,
+                               status_callback=self.on_connection_status,
+                               clipboard_callback=self.on_shared_clipboard,
+                               state_path=state.default_path(),
+                               control_path=control.default_path())
 
         self.SetBackgroundColour(BGD_COLOR)
 
@@ -54,17 +71,27 @@ class MainFrame(wx.Frame):
         exit_item = file_menu.Append(wx.ID_EXIT, text="E&xit")
         self.Bind(wx.EVT_MENU, self.on_quit, exit_item)
 
+        # filled in from the session's history whenever it is opened
+        self.history_menu = wx.Menu()
+        self.history_ids = [wx.NewId() for i in range(HISTORY_MENU_ITEMS)]
+        self.Bind(wx.EVT_MENU_OPEN, self.on_menu_open)
+        for i, menu_id in enumerate(self.history_ids):
+            self.Bind(wx.EVT_MENU, self.on_history, id=menu_id)
+
         help_menu = wx.Menu()
         about_item = help_menu.Append(wx.ID_ABOUT, text="&About",
                                       help="Information about this program")
         self.Bind(wx.EVT_MENU, self.on_about, about_item)
 
         menu_bar.Append(file_menu, "&File")
+        menu_bar.Append(self.history_menu, "Hi&story")
         menu_bar.Append(help_menu, "&Help")
         self.SetMenuBar(menu_bar)
 
         self.CreateStatusBar(style=0)
         Publisher().subscribe(self.change_statusbar, "change_statusbar")
+        Publisher().subscribe(self.show_connection_status,
+                              "connection_status")
 
         # Add panels
         connections_panel = ConnectionsPanel(self, self.session, BGD_COLOR)
@@ -103,6 +130,24 @@ class MainFrame(wx.Frame):
 
         self.SetSizer(main_sizer)
 
+    def on_progress(self, progress):
+        # called from the network thread
+        wx.CallAfter(Publisher().sendMessage, ("transfer_progress"), progress)
+
+    def on_shared_clipboard(self, item):
+        # called from the network thread
+        wx.CallAfter(Publisher().sendMessage, ("shared_clipboard"), item)
+
+    def on_connection_status(self, address, status):
+        # called from the network thread
+        wx.CallAfter(Publisher().sendMessage, ("connection_status"),
+                     (address, status))
+
+    def show_connection_status(self, msg):
+        address, status = msg.data
+        if status in STATUS_TEXT:
+            self.SetStatusText(STATUS_TEXT[status] % address)
+
     def new_timer(self, msg):
         self.timers.add(msg.data)
 
@@ -124,6 +169,25 @@ class MainFrame(wx.Frame):
         Publisher().sendMessage(("change_statusbar"), "")
         event.Skip()
 
+    def on_menu_open(self, event):
+        if event.GetMenu() is not self.history_menu:
+            event.Skip()
+            return
+        for item in self.history_menu.GetMenuItems():
+            self.history_menu.DestroyItem(item)
+        self.history = self.session.get_history()[:HISTORY_MENU_ITEMS]
+        if not self.history:
+            empty = self.history_menu.Append(wx.ID_ANY, "(Empty)")
+            empty.Enable(False)
+        for menu_id, entry in zip(self.history_ids, self.history):
+            self.history_menu.Append(menu_id, history_label(entry))
+
+    def on_history(self, event):
+        entry = self.history[self.history_ids.index(event.GetId())]
+        self.session.restore_history(entry)
+        Publisher().sendMessage(("change_statusbar"),
+                                "Shared clipboard set from history")
+
     def on_about(self, event):
         aboutbox = AboutDialog(self)
         aboutbox.ShowModal()
@@ -135,6 +199,22 @@ class MainFrame(wx.Frame):
         self.session.close()
         self.Close()
 
+def history_label(entry):
+    """Returns the text a history.HistoryEntry is shown with in menus"""
+    text = entry.get(info.TXT)
+    if text is not None:
+        label = text[:HISTORY_LABEL_LENGTH * 4].decode("utf-8", "replace")
+        label = " ".join(label.split())[:HISTORY_LABEL_LENGTH]
+    elif entry.size:
+        label = "%s, %d KB" % (entry.data_type(), entry.size / 1024)
+    else:
+        # not rendered yet
+        label = entry.data_type()
+    if not entry.local:
+        label += "  (shared)"
+    # & marks a menu accelerator
+    return label.replace("&", "&&") or "(Blank)"
+
 if __name__ == '__main__':
     app = wx.App(False)
     frame = MainFrame(None, title=info.NAME, size=FRAME_SIZE,
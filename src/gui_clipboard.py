@@ -17,9 +17,103 @@
     51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
 """
 
+from cStringIO import StringIO
+from threading import Thread
+import urllib
+import urlparse
+
 import wx
 from wx.lib.pubsub import Publisher
-from info import TXT
+from info import TXT, HTML, RTF, PNG, FILES
+from clipitem import ClipboardItem
+import clipwatch
+
+# names of the clipboard formats that wx has no data objects for
+if wx.Platform == "__WXMSW__":
+    CUSTOM_FORMATS = [(HTML, "HTML Format"), (RTF, "Rich Text Format")]
+elif wx.Platform == "__WXMAC__":
+    CUSTOM_FORMATS = [(HTML, "public.html"), (RTF, "public.rtf")]
+else:
+    CUSTOM_FORMATS = [(HTML, "text/html"), (RTF, "text/rtf")]
+
+# how often the clipboard is checked when there is no way to be told that
+# it changed, in milliseconds
+POLL_INTERVAL = 100
+# then, only the formats on offer are compared on most checks, and the
+# clipboard is read whole when they change or after this many checks, to
+# catch new contents in the same formats
+FULL_READ_POLLS = 10
+
+def read_clipboard():
+    """
+    Returns what is on the local clipboard as a ClipboardItem, and a
+    signature of its contents to tell when it changes. Images are only
+    converted to PNG if a peer asks for them. The clipboard must be open.
+    See probe_clipboard() for something cheaper to poll.
+    """
+    item = ClipboardItem()
+    signature = []
+    for data_type, name in CUSTOM_FORMATS:
+        data_format = wx.CustomDataFormat(name)
+        if wx.TheClipboard.IsSupported(data_format):
+            obj = wx.CustomDataObject(data_format)
+            if wx.TheClipboard.GetData(obj):
+                item.add(data_type, obj.GetData())
+                signature.append(hash(obj.GetData()))
+    if wx.TheClipboard.IsSupported(wx.DataFormat(wx.DF_BITMAP)):
+        obj = wx.BitmapDataObject()
+        if wx.TheClipboard.GetData(obj):
+            image = obj.GetBitmap().ConvertToImage()
+            item.add(PNG, render=lambda: _png(image))
+            signature.append(hash(image.GetData()))
+    if wx.TheClipboard.IsSupported(wx.DataFormat(wx.DF_FILENAME)):
+        obj = wx.FileDataObject()
+        if wx.TheClipboard.GetData(obj):
+            uris = "".join("file://%s\r\n" %
+                           urllib.pathname2url(f.encode("utf-8"))
+                           for f in obj.GetFilenames())
+            item.add(FILES, uris)
+            signature.append(uris)
+    text_obj = wx.TextDataObject()
+    if wx.TheClipboard.GetData(text_obj):
+        item.add(TXT, text_obj.GetText())
+        signature.append(text_obj.GetText())
+    return item, tuple(item.data_types() + signature)
+
+def probe_clipboard():
+    """
+    Returns a signature of the local clipboard that is cheap to get: the
+    formats it is offered in, without copying any of its contents. The
+    clipboard must be open.
+    """
+    formats = [wx.CustomDataFormat(name) for _, name in CUSTOM_FORMATS]
+    formats += [wx.DataFormat(f) for f in (wx.DF_BITMAP, wx.DF_FILENAME,
+                                           wx.DF_UNICODETEXT, wx.DF_TEXT)]
+    return tuple(wx.TheClipboard.IsSupported(f) for f in formats)
+
+def _png(image):
+    stream = StringIO()
+    image.SaveStream(stream, wx.BITMAP_TYPE_PNG)
+    return stream.getvalue()
+
+def data_object(data_type, data):
+    """Returns a wx.DataObject for a representation from a ClipboardItem"""
+    if data_type == TXT:
+        return wx.TextDataObject(data.decode("utf-8"))
+    if data_type == PNG:
+        image = wx.ImageFromStream(StringIO(data), wx.BITMAP_TYPE_PNG)
+        return wx.BitmapDataObject(wx.BitmapFromImage(image))
+    if data_type == FILES:
+        obj = wx.FileDataObject()
+        for line in data.splitlines():
+            if line and not line.startswith("#"):
+                path = urllib.url2pathname(urlparse.urlparse(line).path)
+                obj.AddFile(path.decode("utf-8"))
+        return obj
+    name = dict(CUSTOM_FORMATS)[data_type]
+    obj = wx.CustomDataObject(wx.CustomDataFormat(name))
+    obj.SetData(data)
+    return obj
 
 class ClipboardPanel(wx.Panel):
     """
@@ -46,11 +140,18 @@ class ClipboardPanel(wx.Panel):
 
         self.SetSizerAndFit(sizer)
 
-        #self.Bind(wx.EVT_IDLE, self.check_clipboard)
+        # tells us when the local clipboard may have changed, so that it is
+        # only read when it has
+        self.watcher = clipwatch.create(self.on_local_change)
         self.check_timer = wx.Timer(self, wx.ID_ANY)
         self.Bind(wx.EVT_TIMER, self.check_clipboard, self.check_timer)
-        self.check_timer.Start(100)
+        if not self.watcher.event_driven:
+            # poll the watcher's change counter, or failing that, the
+            # clipboard itself
+            self.check_timer.Start(POLL_INTERVAL)
         Publisher().sendMessage(("new_timer"), self.check_timer)
+        Publisher().subscribe(self.on_shared_change, "shared_clipboard")
+        self.Bind(wx.EVT_WINDOW_DESTROY, self.on_destroy)
         self.has_valid_data = False
 
         self.Bind(wx.EVT_TEXT, self.on_edit)
@@ -69,15 +170,24 @@ class ClipboardPanel(wx.Panel):
         self.text.SetValue("Copy/Paste Here")
         self.setting_message = False
 
-        self.local_prev = ""
+        # signature of the local clipboard when we last synced it
+        self.local_prev = None
         self.local_prev_type = "Uknown"
-        self.shared_prev = ""
-        text_obj = wx.TextDataObject()
+        # the shared ClipboardItem when the user last saw it, and when it
+        # was last synced with the local clipboard
+        self.shared_prev = None
+        self.synced_item = None
+        # the shared ClipboardItem whose formats are being fetched, to be put
+        # on the local clipboard once they arrive
+        self.fetching_item = None
         wx.TheClipboard.Open()
-        contains_text = wx.TheClipboard.GetData(text_obj)
+        self.local_seq = self.watcher.sequence()
+        self.local_probe = probe_clipboard()
+        self.local_item, self.local_prev = read_clipboard()
+        self.local_sig = self.local_prev
         wx.TheClipboard.Close()
-        if contains_text:
-            self.local_prev = text_obj.GetText()
+        # checks since the clipboard was last read whole
+        self.polls = 0
 
 ### For testing
 ##        self.test_timer = wx.Timer(self, wx.ID_ANY)
@@ -131,70 +241,128 @@ class ClipboardPanel(wx.Panel):
             self._set_message()
 
     def on_copy(self, event=None):
-        data = self.session.get_clipboard_data()
-        data_type = self.session.get_clipboard_data_type()
-        if data_type == TXT:
-            text_obj = wx.TextDataObject()
-            text_obj.SetText(data)
-
-            wx.TheClipboard.Open()
-            wx.TheClipboard.SetData(text_obj)
-            self.local_prev = data
-            Publisher().sendMessage(("user_copy"), TXT)
-            print "You copied: %s" % data
-            wx.TheClipboard.Close()
-
-            # TODO: Get this working so we don't remove clipboard data when
-            #       the program exits
-            # try:
-            #     with wx.Clipboard.Get() as clipboard:
-            #         clipboard.SetData(text_obj)
-            #         clipboard.Flush()
-            #         self.local_prev = data
-            #         Publisher().sendMessage(("user_copy"), TXT)
-            #         print "You copied: %s" % data
-            # except TypeError:
-            #     print "Error: Unable to write to clipboard"
-        else:
+        item = self.session.get_clipboard_item()
+        data_types = item.data_types()
+        if not data_types:
             print "Nothing on clipboard"
+            return
+        if item is self.fetching_item:
+            return
+        # only the richest format and the text are used
+        wanted = [t for t in data_types if t != TXT][:1]
+        if TXT in data_types:
+            wanted.append(TXT)
+        # what came with the clipboard goes on the local one right away.
+        # Formats that were too large to come with it are fetched in another
+        # thread, so the gui doesn't wait for the peer, and put on with
+        # the rest once they arrive.
+        ready = [(t, item.get(t)) for t in wanted if item.available(t)]
+        if ready:
+            self._copy_local(item, ready)
+        if len(ready) < len(wanted):
+            self.fetching_item = item
+            t = Thread(target=self._fetch, args=(item, wanted))
+            t.daemon = True
+            t.start()
+
+    def _fetch(self, item, wanted):
+        # not in the gui thread
+        fetched = [(t, self.session.get_clipboard_data(t)) for t in wanted]
+        wx.CallAfter(self._fetched, item, fetched)
+
+    def _fetched(self, item, fetched):
+        self.fetching_item = None
+        if self.session.get_clipboard_item() is not item:
+            # replaced while we waited
+            return
+        fetched = [(t, data) for t, data in fetched if data is not None]
+        if not fetched:
+            print "Could not get the clipboard from its owner"
+            # don't keep asking
+            self.synced_item = item
+            return
+        self._copy_local(item, fetched)
+
+    def _copy_local(self, item, representations):
+        """Puts (data type, data) pairs from the shared item on the local
+        clipboard"""
+        composite = wx.DataObjectComposite()
+        for data_type, data in representations:
+            composite.Add(data_object(data_type, data))
+        wx.TheClipboard.Open()
+        wx.TheClipboard.SetData(composite)
+        self.local_prev = read_clipboard()[1]
+        wx.TheClipboard.Close()
+        self.synced_item = item
+        copied = [t for t, _ in representations]
+        Publisher().sendMessage(("user_copy"), copied[0])
+        print "You copied: %s" % ", ".join(copied)
+
+        # TODO: Get this working so we don't remove clipboard data when
+        #       the program exits
+        # try:
+        #     with wx.Clipboard.Get() as clipboard:
+        #         clipboard.SetData(composite)
+        #         clipboard.Flush()
+        # except TypeError:
+        #     print "Error: Unable to write to clipboard"
 
     def on_paste(self, event=None):
-        text_obj = wx.TextDataObject()
         wx.TheClipboard.Open()
-        contains_text = wx.TheClipboard.GetData(text_obj)
+        item, signature = read_clipboard()
         wx.TheClipboard.Close()
-        if contains_text:
-            text = text_obj.GetText()
-            current = self.session.get_clipboard_data()
-            current_type = self.session.get_clipboard_data_type()
-            if current_type != TXT or text != current:
-                print "You pasted: %s" % text
-                self.session.set_clipboard_data(text, TXT)
-                Publisher().sendMessage(("user_paste"), TXT)
-            else:
-                print "Clipboard already synced"
-        else:
+        if not item.data_types():
             print "You pasted unsupported or invalid data"
+        elif signature == self.local_prev and self.synced_item:
+            print "Clipboard already synced"
+        else:
+            print "You pasted: %s" % ", ".join(item.data_types())
+            self.session.set_clipboard_item(item)
+            self.synced_item = self.session.get_clipboard_item()
+            self.local_prev = signature
+            Publisher().sendMessage(("user_paste"), item.data_type())
+
+    def on_local_change(self):
+        # called from the watcher's thread
+        wx.CallAfter(self.check_clipboard)
 
-    def check_clipboard(self, event):
-        if not wx.TheClipboard.IsOpened():
-            text_obj = wx.TextDataObject()
-            wx.TheClipboard.Open()
-            contains_text = wx.TheClipboard.GetData(text_obj)
-            contains_bmp = wx.TheClipboard.IsSupported(
-                wx.DataFormat(wx.DF_BITMAP))
-            wx.TheClipboard.Close()
-            new_type = "Unkown"
-            local = None
-            if contains_text:
-                local = text_obj.GetText()
-                self.has_valid_data = True
-                new_type = TXT
-            elif contains_bmp:
-                self.has_valid_data = False
-                new_type = "Bitmap"
+    def on_shared_change(self, msg):
+        self.check_clipboard()
+
+    def on_destroy(self, event):
+        if event.GetEventObject() is self:
+            self.watcher.stop()
+        event.Skip()
+
+    def check_clipboard(self, event=None):
+        if wx.TheClipboard.IsOpened():
+            if self.watcher.event_driven:
+                # nothing else is going to check again
+                wx.CallLater(50, self.check_clipboard)
+        else:
+            seq = self.watcher.sequence()
+            if seq is not None:
+                changed = seq != self.local_seq
+                self.local_seq = seq
+                if changed:
+                    wx.TheClipboard.Open()
+                    self.local_item, self.local_sig = read_clipboard()
+                    wx.TheClipboard.Close()
             else:
-                self.has_valid_data = False
+                # no counter to tell us, so probe it, and only read it if
+                # the probe changed, or it hasn't been read for a while
+                self.polls += 1
+                wx.TheClipboard.Open()
+                probe = probe_clipboard()
+                if probe != self.local_probe or self.polls >= FULL_READ_POLLS:
+                    self.local_probe = probe
+                    self.polls = 0
+                    self.local_item, self.local_sig = read_clipboard()
+                wx.TheClipboard.Close()
+            item, signature = self.local_item, self.local_sig
+            new_type = item.data_type()
+            self.has_valid_data = new_type is not None
+            if new_type is None:
                 new_type = "Unkown"
 
             if new_type != self.local_prev_type:
@@ -202,33 +370,21 @@ class ClipboardPanel(wx.Panel):
                 Publisher().sendMessage(("update_clipboard"), new_type)
                 self._set_message()
 
-            shared = self.session.get_clipboard_data()
-            shared_type = self.session.get_clipboard_data_type()
-            if shared != self.shared_prev:
+            # only look at what the shared clipboard holds, without
+            # fetching anything
+            shared = self.session.get_clipboard_item()
+            shared_type = shared.data_type()
+            if shared is not self.shared_prev:
                 self.shared_prev = shared
                 if shared_type == None: shared_type = "Empty"
                 print "new data from %s" % self.session.get_clipboard_data_owner()
                 Publisher().sendMessage(("update_shared_clipboard"), shared_type)
 
             if self.auto_sync:
-                if shared_type == TXT:
-                    # If both shared clipboard and local clipboard
-                    # contain different text.
-                    if contains_text and shared != local:
-                        # If previous local clipboard value is the same as the
-                        # current local clipboard value then it was the shared
-                        # clipboard that changed, so copy its value to local.
-                        if self.local_prev == local: # External update
-                            self.on_copy()
-                        else: # This user updated
-                            self.local_prev = local
-                            self.on_paste()
-                    # Local doesn't contain text but shared does so update local
-                    elif not contains_text:
-                        self.on_copy()
-                # Handles the case that there is no data on shared clipboard
-                # and nothing in the local clipboard and then the user copies
-                # something after enbaling auto sync.
-                elif contains_text:
-                    self.local_prev = local
+                if signature != self.local_prev and item.data_types():
+                    # This user updated
                     self.on_paste()
+                elif (shared is not self.synced_item and
+                        shared.data_types()):
+                    # External update, so copy it to the local clipboard
+                    self.on_copy()
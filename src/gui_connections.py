@@ -26,6 +26,7 @@ import wx.lib.scrolledpanel as scrolled
 import wx.lib.stattext as st
 from wx.lib.pubsub import Publisher
 from connections import MAX_ALIAS_LENGTH, MAX_ADDRESS_LENGTH, Connection
+from registry import Registry
 
 
 class NewConnectionDialog(wx.Dialog):
@@ -371,11 +372,6 @@ class ConnectionsPanel(wx.Panel):
         Publisher().subscribe(self.cancel_request, "cancel")
         Publisher().subscribe(self.edit_alias, "edit_alias")
 
-        self.sync_timer = wx.Timer(self, wx.ID_ANY)
-        self.Bind(wx.EVT_TIMER, self.on_sync, self.sync_timer)
-        self.sync_timer.Start(200)
-        Publisher().sendMessage(("new_timer"), self.sync_timer)
-
         self.sort_timer = wx.Timer(self, wx.ID_ANY)
         self.Bind(wx.EVT_TIMER, self.on_sort, self.sort_timer)
         self.sort_timer.Start(500)
@@ -384,6 +380,10 @@ class ConnectionsPanel(wx.Panel):
         self.rows = set()
         self.known_connections = set()
 
+        # rows are added as connections appear, rather than by polling
+        self.session.subscribe_connections(self.on_connection_event)
+        self.on_sync()
+
 ### For testing
     #     self.new_timer = wx.Timer(self, wx.ID_ANY)
     #     self.Bind(wx.EVT_TIMER, self.on_new_timer, self.new_timer)
@@ -398,7 +398,12 @@ class ConnectionsPanel(wx.Panel):
     #         c.status = Connection.REQUEST
 ###
 
-    def on_sync(self, event):
+    def on_connection_event(self, event, connection):
+        # may be called from any thread
+        if event == Registry.ADDED:
+            wx.CallAfter(self.on_sync)
+
+    def on_sync(self):
         for connection in self.session.connections():
             if connection not in self.known_connections:
                 self.add_connection(connection)
@@ -36,7 +36,7 @@ class LicenseDialog(wx.Dialog):
         
         text = wx.TextCtrl(self, style=wx.TE_MULTILINE, size=LICENSE_SIZE)
         text.SetEditable(False)
-        text.SetValue(info.LICENSE_TEXT)
+        text.SetValue(info.license_text())
 
         sizer = wx.BoxSizer(wx.VERTICAL)
         sizer.Add(text,
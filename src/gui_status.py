@@ -19,7 +19,8 @@
 
 import wx
 from wx.lib.pubsub import Publisher
-from info import TXT
+from info import DATA_TYPES
+from network import TransferProgress
 
 class StatusPanel(wx.Panel):
     """This Panel is for managing options"""
@@ -72,15 +73,30 @@ class StatusPanel(wx.Panel):
 
         flags = wx.SizerFlags().Proportion(0).Border(wx.TOP, 5)
         sizer.AddF(shared_sizer, flags)
+
+        transfer_sizer = wx.BoxSizer(wx.HORIZONTAL)
+        self.transfer_label = wx.StaticText(self, label="")
+        flags = wx.SizerFlags().Proportion(0)
+        transfer_sizer.AddF(self.transfer_label, flags)
+
+        self.transfer_gauge = wx.Gauge(self, range=100, size=(100, 12))
+        flags = wx.SizerFlags().Proportion(0).Border(wx.LEFT, 10)
+        transfer_sizer.AddF(self.transfer_gauge, flags)
+
+        flags = wx.SizerFlags().Proportion(0).Border(wx.TOP, 5)
+        sizer.AddF(transfer_sizer, flags)
         
         self.SetSizerAndFit(sizer)
 
         self.new.Hide()
+        self.transfer_label.Hide()
+        self.transfer_gauge.Hide()
 
         Publisher().subscribe(self.user_copy, "user_copy")
         Publisher().subscribe(self.user_paste, "user_paste")
         Publisher().subscribe(self.update_clipboard, "update_clipboard")
         Publisher().subscribe(self.update_shared_clipboard, "update_shared_clipboard")
+        Publisher().subscribe(self.transfer_progress, "transfer_progress")
 
         # Used to prevent "NEW" from poping up when the user pastes
         self.user_pasted = False
@@ -95,13 +111,29 @@ class StatusPanel(wx.Panel):
     def update_clipboard(self, msg):
         data_type = msg.data
         self.local_type.SetLabel(data_type)
-        if data_type == TXT:
+        if data_type in DATA_TYPES:
             color = self.OK_COLOR
         else:
             color = self.BAD_COLOR
 
         self.local_type.SetForegroundColour(color)
 
+    def transfer_progress(self, msg):
+        progress = msg.data
+        if progress.state == TransferProgress.ACTIVE:
+            if progress.outgoing:
+                label = "Sending"
+            else:
+                label = "Receiving"
+            self.transfer_label.SetLabel(label)
+            self.transfer_gauge.SetValue(int(progress.fraction() * 100))
+            self.transfer_label.Show()
+            self.transfer_gauge.Show()
+        else:
+            self.transfer_label.Hide()
+            self.transfer_gauge.Hide()
+        self.Layout()
+
     def update_shared_clipboard(self, msg):
         data_type = msg.data
         self.shared_type.SetLabel(data_type)
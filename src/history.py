@@ -0,0 +1,357 @@
+"""
+    Cross-platform clipboard syncing tool
+    Copyright (C) 2013  Syncboard
+
+    This program is free software; you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation; either version 2 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License along
+    with this program; if not, write to the Free Software Foundation, Inc.,
+    51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+"""
+
+"""
+    A history of recent clipboards.
+
+    The most recent clipboards are kept in a ring bounded by their number
+    and by the memory they take up. Large ones are written to an on-disk
+    store, where they are named by the digest of their content, and are
+    memory-mapped back when they are looked at, so a few screenshots don't
+    push everything else out.
+"""
+
+from collections import deque
+from threading import Lock, Thread
+import hashlib
+import mmap
+import os
+import shutil
+import tempfile
+import time
+
+from clipitem import ClipboardItem
+
+# how many clipboards to remember
+HISTORY_ITEMS = 50
+# how much memory the clipboards kept in memory may take up
+HISTORY_BYTES = 16 * 1024 * 1024
+# representations larger than this are kept on disk
+SPILL_SIZE = 256 * 1024
+# how many of the newest entries may leave representations to be rendered
+# by the item they came from when first needed. Older ones are rendered,
+# since the memory the item takes up until then can't be counted.
+UNRENDERED_ITEMS = 4
+
+class BlobStore:
+    """Content-addressed files in a directory, each counted by how many
+    history entries refer to it and removed when none do.
+
+    Not threadsafe; History serializes access to it.
+
+    """
+
+    def __init__(self, directory = None):
+        """The directory is created on first use if not given, and removed
+        by close()"""
+        self._directory = directory
+        self._temporary = directory is None
+        # hex digest -> number of references
+        self._refs = {}
+
+    def put(self, digest, data):
+        """Store data under its binary SHA-256 digest, unless it is there
+        already"""
+        name = digest.encode('hex')
+        if name not in self._refs:
+            path = self._path(name)
+            if not os.path.exists(path):
+                # written under a temporary name first, so the store never
+                # holds half a file
+                fd, tmp = tempfile.mkstemp(dir=self._directory)
+                with os.fdopen(fd, 'wb') as f:
+                    f.write(data)
+                os.rename(tmp, path)
+            self._refs[name] = 0
+        self._refs[name] += 1
+
+    def get(self, digest):
+        """Return the data with the given digest, memory-mapped read only.
+        Raises IOError if it isn't there."""
+        if self._directory is None:
+            # closed, or nothing was ever put
+            raise IOError('no such blob')
+        with open(self._path(digest.encode('hex')), 'rb') as f:
+            return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def release(self, digest):
+        name = digest.encode('hex')
+        self._refs[name] -= 1
+        if not self._refs[name]:
+            del self._refs[name]
+            try:
+                os.remove(self._path(name))
+            except OSError as e:
+                # still mapped, on Windows
+                print "Could not remove %s from history: %s" % (name, e)
+
+    def close(self):
+        if self._temporary and self._directory:
+            shutil.rmtree(self._directory, ignore_errors=True)
+            self._directory = None
+        self._refs = {}
+
+    def _path(self, name):
+        if self._directory is None:
+            self._directory = tempfile.mkdtemp(prefix='syncboard-')
+        elif not os.path.isdir(self._directory):
+            os.makedirs(self._directory)
+        return os.path.join(self._directory, name)
+
+class HistoryEntry:
+    """A clipboard as it was when it was added to the History"""
+
+    def __init__(self, local, when):
+        # whether it was copied here, rather than on another computer
+        self.local = local
+        self.time = when
+        # (data type, digest, data) for each representation, where data is
+        # None if it is on disk, and digest and data are None if it has yet
+        # to be rendered by _source
+        self._formats = []
+        self._source = None
+        # bytes kept in memory
+        self.memory = 0
+        self.size = 0
+        self._store = None
+        # the History the entry is in, until it is dropped
+        self._history = None
+        # mappings of the representations on disk that have been looked at,
+        # by digest
+        self._maps = {}
+
+    def data_types(self):
+        return [data_type for data_type, _, _ in self._formats]
+
+    def data_type(self):
+        """Return the preferred data type"""
+        return self._formats[0][0] if self._formats else None
+
+    def get(self, data_type):
+        """Return a representation, or None if the clipboard didn't have it.
+        Large ones are returned as read only mmaps, which can be used like
+        strings. Those of entries that have been dropped from the History
+        may not be there any more, in which case None is returned."""
+        for t, digest, data in self._formats:
+            if t == data_type:
+                if digest is None:
+                    return self._render(t)
+                if data is None:
+                    return self._map(digest)
+                return data
+        return None
+
+    def item(self):
+        """Return the entry as a ClipboardItem, for setting the clipboard to
+        it again"""
+        item = ClipboardItem()
+        for data_type in self.data_types():
+            # rendered here, since setting the clipboard needs it anyway
+            data = self.get(data_type)
+            if data is not None:
+                item.add(data_type, data[:])
+        return item
+
+    def _render(self, data_type):
+        source, history = self._source, self._history
+        if source is None:
+            return None
+        data = source.get(data_type)
+        if history is not None:
+            history._rendered(self)
+        return data
+
+    def _render_all(self):
+        for data_type, digest, _ in self._formats:
+            if digest is None:
+                self._render(data_type)
+
+    def _map(self, digest):
+        m = self._maps.get(digest)
+        if m is None:
+            try:
+                m = self._store.get(digest)
+            except (IOError, OSError):
+                # dropped, and removed from the store along with it
+                return None
+            self._maps[digest] = m
+        return m
+
+    def _key(self):
+        return [(t, digest or id(self._source))
+                for t, digest, _ in self._formats]
+
+class History:
+    """The last max_items clipboards, newest first. Representations larger
+    than spill_size go to a BlobStore in directory, and the rest take up
+    to max_bytes of memory; the oldest entries are dropped to stay within
+    both limits. Representations that have yet to be rendered are counted
+    once they are, and are rendered in the background once their entry is
+    older than the newest unrendered_items. Adding and dropping entries
+    take constant time.
+
+    Threadsafe.
+
+    """
+
+    def __init__(self, max_items = HISTORY_ITEMS, max_bytes = HISTORY_BYTES,
+                 spill_size = SPILL_SIZE, directory = None,
+                 unrendered_items = UNRENDERED_ITEMS):
+        self._max_items = max_items
+        self._max_bytes = max_bytes
+        self._spill_size = spill_size
+        self._max_unrendered = unrendered_items
+        self._store = BlobStore(directory)
+        # oldest first
+        self._entries = deque()
+        # the entries still holding on to their item, oldest first
+        self._unrendered = deque()
+        self._bytes = 0
+        self._lock = Lock()
+
+    def add(self, item, local = True):
+        """Add a clipitem.ClipboardItem, and return its HistoryEntry. Only
+        the representations that are available without fetching them are
+        kept. Ones that have yet to be rendered are left to the item to
+        render when they are first asked for, and are counted against
+        max_bytes from then on. Returns None, and adds nothing, if the item
+        is empty or the same as the newest entry."""
+        entry = HistoryEntry(local, time.time())
+        entry._source = item
+        formats = []
+        for data_type in item.data_types():
+            if item.rendered(data_type):
+                data = item.get(data_type)
+                formats.append((data_type, hashlib.sha256(data).digest(),
+                                data))
+            elif item.available(data_type):
+                formats.append((data_type, None, None))
+        if not formats:
+            return None
+        if all(digest is not None for _, digest, _ in formats):
+            # nothing left to render, so don't keep the item alive
+            entry._source = None
+        entry._formats = formats
+
+        with self._lock:
+            newest = self._entries[-1] if self._entries else None
+            if newest and newest._key() == entry._key():
+                return None
+            entry._formats = []
+            entry._store = self._store
+            entry._history = self
+            for data_type, digest, data in formats:
+                if digest is not None:
+                    data = self._keep(entry, digest, data)
+                entry._formats.append((data_type, digest, data))
+            self._entries.append(entry)
+            self._bytes += entry.memory
+            # pick up what has been rendered since, by peers fetching it
+            for e in list(self._unrendered):
+                self._settle(e)
+            if entry._source is not None:
+                self._unrendered.append(entry)
+            while len(self._unrendered) > self._max_unrendered:
+                t = Thread(target=self._unrendered.popleft()._render_all)
+                t.daemon = True
+                t.start()
+            self._trim()
+        return entry
+
+    def _keep(self, entry, digest, data):
+        """Account for a representation of entry, spilling it if it is
+        large. Returns what to keep in memory for it."""
+        entry.size += len(data)
+        if len(data) > self._spill_size:
+            self._store.put(digest, data)
+            return None
+        entry.memory += len(data)
+        return data
+
+    def _settle(self, entry):
+        """Take the representations of entry that its item has rendered
+        into account, and let go of the item once it has rendered them all.
+        The lock must be held, and entry must not have been dropped."""
+        formats = []
+        memory = entry.memory
+        for data_type, digest, data in entry._formats:
+            if digest is None and entry._source.rendered(data_type):
+                data = entry._source.get(data_type)
+                digest = hashlib.sha256(data).digest()
+                data = self._keep(entry, digest, data)
+            formats.append((data_type, digest, data))
+        entry._formats = formats
+        self._bytes += entry.memory - memory
+        if all(digest is not None for _, digest, _ in formats):
+            entry._source = None
+            if entry in self._unrendered:
+                self._unrendered.remove(entry)
+
+    def _rendered(self, entry):
+        """Called when a representation of entry has been rendered"""
+        with self._lock:
+            if entry._history is self and entry._source is not None:
+                self._settle(entry)
+                self._trim()
+
+    def _trim(self):
+        while (len(self._entries) > self._max_items or
+               self._bytes > self._max_bytes):
+            self._drop(self._entries.popleft())
+
+    def _drop(self, entry):
+        self._bytes -= entry.memory
+        for _, digest, data in entry._formats:
+            if digest is not None and data is None:
+                self._store.release(digest)
+        if entry in self._unrendered:
+            self._unrendered.remove(entry)
+        entry._source = None
+        entry._history = None
+        # mmaps still in use elsewhere stay valid until they are let go of
+        entry._maps = {}
+
+    def entries(self):
+        """Return a list of the entries, newest first"""
+        with self._lock:
+            return list(reversed(self._entries))
+
+    def latest(self):
+        with self._lock:
+            return self._entries[-1] if self._entries else None
+
+    def __len__(self):
+        with self._lock:
+            return len(self._entries)
+
+    def memory(self):
+        """Return how many bytes of clipboard data are kept in memory"""
+        with self._lock:
+            return self._bytes
+
+    def clear(self):
+        with self._lock:
+            while self._entries:
+                self._drop(self._entries.popleft())
+
+    def close(self):
+        """Forget everything, and remove the store if it was temporary"""
+        self.clear()
+        with self._lock:
+            self._store.close()
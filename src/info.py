@@ -21,13 +21,22 @@
     This file contains information about the application itself.
 """
 
-from os.path import join
+from os.path import join, dirname, abspath
 
-f = open(join(".." + "/" + "LICENSE"), "r")
-msg = f.read()
-f.close()
+# next to the src directory
+LICENSE_PATH = join(dirname(abspath(__file__)), "..", "LICENSE")
+
+_license_text = None
+
+def license_text():
+    """Returns the text of the license, which is only read when first asked
+    for, since nothing but the about box needs it"""
+    global _license_text
+    if _license_text is None:
+        with open(LICENSE_PATH, "r") as f:
+            _license_text = f.read()
+    return _license_text
 
-LICENSE_TEXT = msg
 DESCRIPTION_TEXT = "a cross-platform clipboard syncing tool"
       
 NAME = "Syncboard"
@@ -38,4 +47,9 @@ DEVELOPERS = [ "Brandon Edgren", "Nat Mote"]
 
 # Supported clipboard data types
 TXT = "Text"
-#BMP = "Bitmap"
+HTML = "HTML"
+RTF = "Rich Text"
+PNG = "PNG Image"
+FILES = "File List"
+# in the order applications usually prefer them
+DATA_TYPES = [HTML, RTF, PNG, FILES, TXT]
@@ -17,17 +17,83 @@
     51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
 """
 
-from select import select
-from socket import socket, AF_INET, SOCK_STREAM, timeout, error, gethostbyname
-from threading import Thread, Lock
+from socket import socket, AF_INET, SOCK_STREAM, SOL_SOCKET, SO_ERROR, \
+    SO_REUSEADDR, SO_KEEPALIVE, IPPROTO_TCP, timeout, error
+from threading import Thread, Lock, Event, Condition
+from collections import deque, OrderedDict
+import errno
+import hashlib
+import heapq
+import os
+import select
+import socket as _socket
 import random
 import time
 from Queue import Queue, Empty
-
-TIMEOUT = 0.05
+import struct
+import json
+
+import compression
+import delta
+import info
+from clipitem import ClipboardItem, WIRE_NAMES, DATA_TYPES_BY_NAME
+from resolver import Resolver
+from registry import Registry
+
+# how long to wait for an outgoing connection to be established
+CONNECT_TIMEOUT = 5.0
+# peers added with add_peer() are reconnected to after this many seconds at
+# first, doubling with every failure in a row up to RECONNECT_MAX_DELAY
+RECONNECT_MIN_DELAY = 0.5
+RECONNECT_MAX_DELAY = 60.0
+# peers we haven't heard from for this many seconds are pinged, and dropped
+# once they have been silent for HEARTBEAT_MISSES intervals
+HEARTBEAT_INTERVAL = 0.5
+HEARTBEAT_MISSES = 4
+# TCP keepalive settings, where the platform lets us change them: probe after
+# this many idle seconds, every KEEPALIVE_INTERVAL seconds, and give up after
+# KEEPALIVE_COUNT unanswered probes
+KEEPALIVE_IDLE = 10
+KEEPALIVE_INTERVAL = 5
+KEEPALIVE_COUNT = 3
+# smallest amount of data asked for in a single read
 RECV_SIZE = 4096
+# initial size of a connection's receive buffer
+RECV_BUFFER_SIZE = 64 * 1024
+# how much a single connection may read in one pass of the connection loop
+# before the other ready connections get their turn
+READ_BUDGET = 256 * 1024
+# clipboards larger than this are sent in chunks of this size
+CHUNK_SIZE = 64 * 1024
+# minimum time between progress reports for a single transfer, in seconds
+PROGRESS_INTERVAL = 0.1
+# how many content hashes to remember per peer as known to be held by it
+PEER_DIGESTS = 16
+# recently seen clipboards are kept by content hash, up to this many and this
+# many bytes, so that peers can refer to them by hash instead of resending
+CONTENT_CACHE_ITEMS = 16
+CONTENT_CACHE_BYTES = 64 * 1024 * 1024
+# clipboards at least this large are sent as a delta against the peer's
+# current clipboard, when that is smaller than sending them whole and no
+# larger than DELTA_MAX_SIZE
+DELTA_MIN_SIZE = 4096
+DELTA_MAX_SIZE = 64 * 1024
+# a DELTA frame must never be chunked
+assert DELTA_MAX_SIZE <= CHUNK_SIZE
+# in relay mode, how many peers each clipboard is pushed to. Pushing to a
+# few random peers per hop reaches every node of a connected overlay in a
+# number of hops logarithmic in its size, with high probability. The other
+# peers are only sent its digest, and ask for the content if they lack it.
+RELAY_FANOUT = 4
+# how long to wait for a peer to send a representation of its clipboard that
+# was too large to come with it
+FETCH_TIMEOUT = 10.0
+# how many clipboards to remember the senders of, to fetch from
+FETCH_ORIGINS = 16
 
 DEFAULT_PORT = 24749
+# the errno module doesn't have it everywhere
+ECANCELED = getattr(errno, 'ECANCELED', 125)
 
 class Network:
     """Manages all of the network activity for Syncboard.
@@ -36,9 +102,9 @@ class Network:
     n = Network()
     n.start()  # allows network activity to begin
 
-    n.set_clipboard(clipboard_data)
+    n.set_clipboard(clipboard_data)  # or a clipitem.ClipboardItem
 
-    clipboard_data = n.get_clipboard()
+    clipboard_data = n.get_clipboard()  # or get_clipboard(info.HTML) etc.
 
     n.connect(remote_address)
 
@@ -46,12 +112,19 @@ class Network:
 
     Implementation:
 
-    Two background threads -- one to accept new connections, and one to wait to
-    receive data.
+    A single background thread, run by ConnectionThread, accepts new
+    connections, establishes outgoing ones and moves data for all of them in
+    one event loop. The public methods hand work to it and may be called from
+    any thread.
     """
 
     def __init__(self, port = DEFAULT_PORT,
-                 con_callback = None, dis_callback = None):
+                 con_callback = None, dis_callback = None,
+                 progress_callback = None, relay = False, status_callback = None,
+                 heartbeat_interval = HEARTBEAT_INTERVAL,
+                 heartbeat_misses = HEARTBEAT_MISSES, tcp_keepalive = True,
+                 resolver = None, announce = False, prefetch_size = 0,
+                 clipboard_callback = None):
         """Initialize the network object, arranging for it to listen on the
         given port.
 
@@ -62,59 +135,290 @@ class Network:
         closes the connection. The argument will be the remote address, in
         canonical form. These callbacks may occur in any thread.
 
-        """
-        # UID used mostly for conflict resolution
-        self._uid = random.randint(0, 0xFFFFFFFF)
+        The progress callback, if given, is called with a TransferProgress as
+        large clipboards are sent to and received from peers. It is called
+        in the network thread.
 
-        self._port = port
+        If relay is true, clipboards received from one peer are passed on to
+        up to RELAY_FANOUT others, so that machines which are not directly
+        connected can share a clipboard through ones that are. The remaining
+        peers are sent its digest, and fetch the content if they haven't
+        received it by the time that arrives.
 
-        self._connection_thread = ConnectionThread(self._process_message, self._run_disconnect_callback)
+        The status callback, if given, is called with the address, port and
+        new status (one of the Peer constants) of peers added with add_peer()
+        as they are connected to and lost. It is called in the network
+        thread.
 
-        self._server_thread = Thread(target=self._accept_loop)
-        self._server_thread.daemon = True
+        Peers are pinged when they have been quiet for heartbeat_interval
+        seconds, and dropped, with a call to the disconnect callback, after
+        heartbeat_misses intervals without hearing from them. An interval of
+        0 turns this off. If tcp_keepalive is true, the operating system
+        also probes idle connections.
 
-        self._running = False
+        Host names are looked up with the given resolver.Resolver, or a
+        private one.
 
-        self._clipboard = ''
+        If announce is true, clipboards set here are announced to peers
+        with only their formats, sizes and digests, and every format is
+        fetched by a peer when it is first asked for with get_clipboard().
+        Formats of clipboards from peers that are no larger than
+        prefetch_size bytes are fetched as soon as they are announced.
 
-        # a queue of connections that need to be made. Contains Connection
-        # objects that must be added to the _connections set.
-        self._connect_queue = Queue()
-        # a queue of (address, port) pairs to be disconnected from
-        self._disconnect_queue = Queue()
-        # a queue of Message objects to be sent
-        self._send_queue = Queue()
+        The clipboard callback, if given, is called with the new
+        clipitem.ClipboardItem whenever a clipboard from a peer replaces
+        ours. It is called in the network thread.
+
+        """
+        # UID used mostly for conflict resolution
+        self._uid = random.randint(0, 0xFFFFFFFF)
+
+        self._port = port
+        self._resolver = resolver or Resolver()
+
+        # recent clipboard contents by digest
+        self._content = ContentCache()
+
+        self._connection_thread = ConnectionThread(self._process_message,
+                                                   self._run_disconnect_callback,
+                                                   self._on_new_connection,
+                                                   progress_callback,
+                                                   self._content,
+                                                   status_callback,
+                                                   heartbeat_interval,
+                                                   heartbeat_misses,
+                                                   tcp_keepalive)
+
+        # the clipboard, as a clipitem.ClipboardItem
+        self._item = ClipboardItem()
+        # Lamport clock. Clipboards are sent with the time they were set at
+        # as their sequence number, and the clock is moved past every
+        # clipboard we hear about, so a copy made after seeing another one
+        # always gets a later time.
+        self._clock = 0
+        # the clipboard as a Message, for its timestamp and digest, and to be
+        # sent as is. Every peer keeps the clipboard with the latest timestamp
+        # (see Message.get_timestamp()), so they all end up on the same one,
+        # no matter in which order they heard about them.
+        self._message = Message(self._uid, self._item.encode()[0])
+        # protects the clock, the clipboard and its message, and the origins
+        self._seq_lock = Lock()
+        self._relay = relay
+        self._announce = announce
+        self._prefetch_size = prefetch_size
+        self._clipboard_callback = clipboard_callback
+        # the Connections recent clipboards came in on, by digest. Their
+        # representations that were too large to be sent with them are
+        # fetched from there.
+        self._origins = OrderedDict()
+        # items waiting for representations to be fetched, and Connections
+        # waiting for us to pass them on, by (clipboard digest, data type)
+        self._fetching = {}
+        self._waiting = OrderedDict()
+        # protects the above two, and is notified when a representation
+        # arrives
+        self._fetched = Condition(Lock())
+        # the clipboard we last sent a WANT for, by id, and when, so that
+        # digests relayed by several peers don't each pull the content.
+        # Only used in the network thread.
+        self._wanted = (None, 0)
 
         self._on_connect_callback = con_callback
         self._on_disconnect_callback = dis_callback
 
     def start(self):
-        self._running = True
+        # bind to all network interfaces
+        self._connection_thread.listen(('', self._port))
         self._connection_thread.start()
-        self._server_thread.start()
 
     def set_clipboard(self, data):
-        """Threadsafe -- can be called from any thread"""
-        # no locking required since this is an atomic operation. We will need
-        # locking once we use the sequence number for messages, though.
-        self._clipboard = data
-        m = Message(self._uid, self._clipboard)
+        """Set the clipboard to a clipitem.ClipboardItem, or to text.
+
+        Representations larger than clipitem.INLINE_SIZE are left out of
+        what is sent to peers, and only sent to those that fetch them.
+
+        Threadsafe -- can be called from any thread
+
+        """
+        if isinstance(data, ClipboardItem):
+            item = data
+        else:
+            item = ClipboardItem(data)
+        if self._announce:
+            payload, left_out = item.encode(inline_size=0, always=())
+        else:
+            payload, left_out = item.encode()
+        m = Message(self._uid, payload)
+        # hash it here rather than in the network thread
+        digest = m.get_digest()
+        # likewise diff it against the clipboard peers most likely hold, which
+        # can take a while for large ones. The network thread only sends
+        # deltas worked out beforehand.
+        with self._seq_lock:
+            base_digest = self._message.get_digest()
+        if len(payload) >= DELTA_MIN_SIZE:
+            m.get_delta(base_digest, self._content)
+        for data_type, data in left_out.iteritems():
+            self._content.add((digest, data_type), data)
+        self._content.add(digest, payload)
+        with self._seq_lock:
+            self._clock += 1
+            m.set_sequence_number(self._clock)
+            self._item = item
+            self._message = m
         self._connection_thread.send(m)
 
-    def get_clipboard(self):
-        """Threadsafe -- can be called from any thread"""
-        # no locking required since this is an atomic operation
-        return self._clipboard
+    def get_clipboard(self, data_type = info.TXT, wait = FETCH_TIMEOUT):
+        """Return the clipboard in the given format, or None if it isn't
+        available in that format.
+
+        Representations that were too large to come with a clipboard from a
+        peer are fetched from it, waiting up to wait seconds for them. If
+        wait is 0, None is returned for them instead.
+
+        Threadsafe -- can be called from any thread
+
+        """
+        with self._seq_lock:
+            item = self._item
+            digest = self._message.get_digest()
+            origin = self._origin(self._message)
+        if (data_type in item and not item.available(data_type) and wait and
+                origin is not None and origin.peer_supports('fetch')):
+            self._fetch(item, digest, data_type, origin, wait)
+        return item.get(data_type)
+
+    def _fetch(self, item, digest, data_type, origin, wait):
+        """Fetch a representation of item from the Connection it came in
+        on, waiting up to wait seconds for it to arrive"""
+        key = (digest, data_type)
+        data = self._content.get(key)
+        if data is not None:
+            try:
+                item.set_data(data_type, data)
+                return
+            except ValueError:
+                pass
+        with self._fetched:
+            self._fetching[key] = item
+        self._connection_thread.send(self._fetch_message(digest, data_type),
+                                     origin)
+        deadline = time.time() + wait
+        with self._fetched:
+            while not item.available(data_type):
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    print "Timed out fetching %s" % data_type
+                    break
+                self._fetched.wait(remaining)
+            self._fetching.pop(key, None)
+
+    def get_clipboard_item(self):
+        """Return the clipboard as a clipitem.ClipboardItem. Threadsafe."""
+        return self._item
 
     def get_clipboard_data_type(self):
-        import info
-        return info.TXT
+        """Return the preferred format of the clipboard, or None if it is
+        empty"""
+        return self._item.data_type()
+
+    def get_statistics(self):
+        """Return a dictionary of traffic counters, totalled over all
+        connections so far. Threadsafe."""
+        return self._connection_thread.statistics.as_dict()
+
+    def get_state(self):
+        """Return what a Network needs to carry on where this one is, as a
+        JSON-serializable dictionary and a list of the strings it refers to
+        by index: our uid, the clock, and the clipboard with the formats of
+        it we hold. Threadsafe."""
+        with self._seq_lock:
+            m = self._message
+            item = self._item
+            clock = self._clock
+        blobs = [m.get_payload()]
+        formats = []
+        for data_type in item.data_types():
+            data = self._content.get((m.get_digest(), data_type))
+            if data is not None:
+                formats.append([WIRE_NAMES[data_type], len(blobs)])
+                blobs.append(data)
+        state = {'uid': self._uid, 'clock': clock, 'sender': m.get_uid(),
+                 'sequence': m.get_sequence_number(), 'formats': formats}
+        return state, blobs
+
+    def restore_state(self, state, blobs):
+        """Carry on from what get_state() returned, in an earlier run. Peers
+        that still hold the same clipboard are not sent it again, and don't
+        send it to us. Must be called before start().
+
+        Raises ValueError if the state is malformed.
+
+        """
+        try:
+            uid = int(state['uid'])
+            clock = int(state['clock'])
+            m = Message(int(state['sender']), blobs[0])
+            m.set_sequence_number(int(state['sequence']))
+            formats = [(DATA_TYPES_BY_NAME.get(name), blobs[i])
+                       for name, i in state['formats']]
+        except (KeyError, IndexError, TypeError) as e:
+            raise ValueError('malformed network state: %s' % e)
+        item = ClipboardItem.decode(m.get_payload())
+        digest = m.get_digest()
+        self._content.add(digest, m.get_payload())
+        for data_type, data in formats:
+            if data_type is not None:
+                item.set_data(data_type, data)
+                self._content.add((digest, data_type), data)
+        with self._seq_lock:
+            self._uid = uid
+            self._clock = max(clock, m.get_sequence_number())
+            self._item = item
+            self._message = m
 
     def connect(self, address, port = DEFAULT_PORT):
-        # TODO sync clipboard data when connection is established
-        s = socket(AF_INET, SOCK_STREAM)
-        s.connect((address, port))
-        self._connection_thread.add_connection(Connection(s))
+        """Connect to the peer at the given address.
+
+        The connection is established by the network thread, but this waits
+        for the outcome, raising socket.error (or socket.timeout) if it could
+        not be made.
+
+        """
+        host = self._resolver.resolve_wait(address)
+        request = ConnectRequest((host, port))
+        self._connection_thread.connect(request)
+        request.wait()
+
+    def add_peer(self, address, port = DEFAULT_PORT):
+        """Stay connected to the peer at the given address.
+
+        Returns straight away. The network thread connects in the background,
+        and whenever the connection fails or cannot be made, tries again
+        after a delay that grows exponentially with each failure in a row.
+        Adding a peer that is waiting for its next attempt makes it try again
+        right away.
+
+        The address is resolved in the background too; if that fails, the
+        peer is not added.
+
+        """
+        self._resolve(address, port, self._connection_thread.add_peer)
+
+    def remove_peer(self, address, port = DEFAULT_PORT):
+        """Stop reconnecting to a peer added with add_peer(), and disconnect
+        from it"""
+        self._resolve(address, port, self._connection_thread.remove_peer)
+
+    def _resolve(self, address, port, callback):
+        """Call callback((host, port)) once the address is resolved, in
+        whatever thread that happens"""
+        def resolved(host, err):
+            if err:
+                print "Could not resolve %s: %s" % (address, err)
+            else:
+                callback((host, port))
+        self._resolver.resolve(address, resolved)
 
     def disconnect(self, address, port = None):
         """Disconnect from the given peer.
@@ -128,46 +432,279 @@ class Network:
         are connections to multiple peers at the given address.
 
         """
-        self._connection_thread.schedule_disconnect(address, port)
+        self._resolve(address, port,
+                      self._connection_thread.schedule_disconnect)
 
     def stop(self):
-        self._running = False
-
-        # wait for the threads to cleanly exit
-        self._server_thread.join()
+        # wait for the thread to cleanly exit
         self._connection_thread.stop()
 
     def _run_disconnect_callback(self, *args):
         if self._on_disconnect_callback:
           self._on_disconnect_callback(*args)
 
-    def _process_message(self, message):
-        """Called when we receive a message over the wire"""
-        self._clipboard = message.get_payload()
-
-    def _accept_loop(self):
-        server_socket = socket(AF_INET, SOCK_STREAM)
-
-        # bind to all network interfaces
-        server_socket.bind(('', self._port))
-        # allow the OS to enqueue 5 waiting connections
-        server_socket.listen(5)
-        # timeout so we can check if we should shut down
-        server_socket.settimeout(TIMEOUT)
-
-        while self._running:
-            try:
-                client_socket, address = server_socket.accept()
-                if self._on_connect_callback:
-                    self._on_connect_callback(*address)
-            except timeout:
-                pass
+    def _process_message(self, message, conn):
+        """Called in the network thread when we receive a message over the
+        wire from the given Connection"""
+        msg_type = message.get_type()
+        if msg_type == Message.HELLO:
+            self._sync_with(conn)
+            return
+        if (msg_type in (Message.CLIPBOARD, Message.HAVE, Message.DELTA) and
+                not self._is_new(message)):
+            # we have had it already, through another peer, or a clipboard
+            # that was set later
+            return
+        if msg_type == Message.CLIPBOARD:
+            payload = message.get_payload()
+            self._content.add(message.get_digest(), payload)
+            self._accept_clipboard(message, payload, conn)
+        elif msg_type == Message.HAVE:
+            # the peer switched to a clipboard it thinks we have already
+            payload = self._content.get(message.get_digest())
+            if payload is not None:
+                self._accept_clipboard(message, payload, conn)
+            elif (self._wanted[0] != message.get_id() or
+                    time.time() - self._wanted[1] > FETCH_TIMEOUT):
+                self._wanted = (message.get_id(), time.time())
+                want = Message(message.get_uid(), message.get_digest(),
+                               Message.WANT)
+                want.set_sequence_number(message.get_sequence_number())
+                conn.send(want)
+        elif msg_type == Message.DELTA:
+            target = self._apply_delta(message)
+            if target is not None:
+                self._content.add(message.get_digest(), target)
+                self._accept_clipboard(message, target, conn)
             else:
-                c = Connection(client_socket)
-                # directly send the contents of our clipboard
-                c.send(Message(self._uid, self._clipboard))
-                self._connection_thread.add_connection(c)
-        server_socket.close()
+                want = Message(message.get_uid(), message.get_digest(),
+                               Message.WANT)
+                want.set_sequence_number(message.get_sequence_number())
+                conn.send(want)
+        elif msg_type == Message.WANT:
+            # we sent a HAVE or DELTA, but the peer doesn't have its content
+            # or base after all
+            payload = self._content.get(message.get_digest())
+            if payload is not None:
+                m = Message(message.get_uid(), payload)
+                m.set_sequence_number(message.get_sequence_number())
+                conn.send(m)
+        elif msg_type == Message.FETCH:
+            self._answer_fetch(message, conn)
+        elif msg_type == Message.BLOB:
+            self._receive_blob(message)
+
+    def _is_new(self, message):
+        """Return whether a clipboard message is later than our clipboard, and
+        move our clock past it"""
+        with self._seq_lock:
+            self._clock = max(self._clock, message.get_sequence_number())
+            return message.get_timestamp() > self._message.get_timestamp()
+
+    def _accept_clipboard(self, message, payload, conn):
+        """Switch to the clipboard a message from conn carried, and pass it on
+        to other peers if we relay"""
+        try:
+            item = ClipboardItem.decode(payload)
+        except ValueError as e:
+            raise ProtocolError(str(e))
+        m = Message(message.get_uid(), payload)
+        m.set_sequence_number(message.get_sequence_number())
+        m.set_digest(message.get_digest())
+        with self._seq_lock:
+            if m.get_timestamp() <= self._message.get_timestamp():
+                # the user copied something in the meantime
+                return
+            self._item = item
+            self._message = m
+            self._origins.pop(m.get_digest(), None)
+            self._origins[m.get_digest()] = conn
+            if len(self._origins) > FETCH_ORIGINS:
+                self._origins.popitem(last=False)
+        self._prefetch(item, m.get_digest(), conn)
+        if self._relay:
+            self._connection_thread.relay(m, conn)
+        if self._clipboard_callback:
+            self._clipboard_callback(item)
+
+    def _prefetch(self, item, digest, conn):
+        """Fill in the formats of a new clipboard that we have seen before,
+        and fetch those no larger than prefetch_size from conn"""
+        for data_type in item.data_types():
+            if item.available(data_type):
+                continue
+            data = self._content.get((digest, data_type))
+            if data is not None:
+                try:
+                    item.set_data(data_type, data)
+                    continue
+                except ValueError:
+                    pass
+            size = item.size(data_type)
+            if (size is not None and size <= self._prefetch_size and
+                    conn.peer_supports('fetch')):
+                conn.send(self._fetch_message(digest, data_type))
+
+    def _sync_with(self, conn):
+        """Called when the peer on conn has described its clipboard in its
+        HELLO. It is only sent ours if that is later."""
+        info = conn.peer_info
+        try:
+            clock = int(info.get('clock', 0))
+            seq, uid = info.get('stamp', (0, 0))
+            stamp = (int(seq), int(uid))
+        except (TypeError, ValueError):
+            raise ProtocolError('malformed HELLO')
+        with self._seq_lock:
+            self._clock = max(self._clock, clock)
+            m = self._message
+        if m.get_timestamp() > stamp:
+            # if the peer has the content after all, only its digest is sent
+            conn.send(m)
+
+    def _apply_delta(self, message):
+        """Return the clipboard a DELTA message describes, or None if we don't
+        have its base or the result doesn't match its digest"""
+        payload = message.get_payload_view()
+        base = self._content.get(payload[:DIGEST_SIZE].tobytes())
+        if base is None:
+            return None
+        try:
+            target = delta.apply(base, payload[DIGEST_SIZE:])
+        except ValueError as e:
+            print "Bad delta: %s" % e
+            return None
+        if hashlib.sha256(target).digest() != message.get_digest():
+            return None
+        return target
+
+    def _origin(self, message):
+        """Return the Connection to fetch representations of the clipboard
+        in message from, or None. That is the one it came in on, or, if
+        that has been closed since, a new connection to its sender."""
+        registry = self._connection_thread.registry
+        origin = self._origins.get(message.get_digest())
+        if origin is None or origin not in registry:
+            origin = registry.get_by_uid(message.get_uid())
+        return origin
+
+    def _fetch_message(self, digest, data_type):
+        """Return a FETCH message asking for a representation of the
+        clipboard with the given digest"""
+        return Message(self._uid, digest + WIRE_NAMES[data_type],
+                       Message.FETCH)
+
+    def _blob_message(self, digest, data_type, data):
+        """Return a BLOB message carrying a representation of the clipboard
+        with the given digest"""
+        name = WIRE_NAMES[data_type]
+        return Message(self._uid,
+                       BLOB_HEADER.pack(digest, len(name)) + name + data,
+                       Message.BLOB)
+
+    def _answer_fetch(self, message, conn):
+        """Send conn the representation a FETCH asks for if we have it, or
+        else ask the peer the clipboard came from, and pass it on once it
+        arrives"""
+        payload = message.get_payload_view()
+        digest = payload[:DIGEST_SIZE].tobytes()
+        data_type = DATA_TYPES_BY_NAME.get(payload[DIGEST_SIZE:].tobytes())
+        if len(digest) != DIGEST_SIZE or data_type is None:
+            # it asked for a format we don't know about
+            return
+        key = (digest, data_type)
+        data = self._content.get(key)
+        with self._seq_lock:
+            item = self._item
+            current = self._message.get_digest() == digest
+            origin = self._origins.get(digest)
+            if current:
+                origin = self._origin(self._message)
+        if data is None and current and item.available(data_type):
+            if not item.rendered(data_type):
+                # rendering a large image would hold up every connection
+                t = Thread(target=self._render_blob, args=(item, key, conn))
+                t.daemon = True
+                t.start()
+                return
+            data = item.get(data_type)
+            self._content.add(key, data)
+        if data is not None:
+            conn.send(self._blob_message(digest, data_type, data))
+            return
+        if origin is None or origin is conn:
+            # nobody to ask; the peer gives up after FETCH_TIMEOUT
+            return
+        with self._fetched:
+            first = key not in self._waiting
+            self._waiting.setdefault(key, []).append(conn)
+            if len(self._waiting) > FETCH_ORIGINS:
+                self._waiting.popitem(last=False)
+        if first:
+            self._connection_thread.send(self._fetch_message(digest,
+                                                             data_type),
+                                         origin)
+
+    def _render_blob(self, item, key, conn):
+        """Render a representation of item outside the network thread, and
+        send it to conn, which asked for it"""
+        digest, data_type = key
+        data = item.get(data_type)
+        if data is None:
+            return
+        self._content.add(key, data)
+        self._connection_thread.send(self._blob_message(digest, data_type,
+                                                        data), conn)
+
+    def _receive_blob(self, message):
+        """Store a representation a peer sent in reply to a FETCH, and pass
+        it on to whoever is waiting for it"""
+        payload = message.get_payload_view()
+        if len(payload) < BLOB_HEADER.size:
+            raise ProtocolError('short BLOB')
+        digest, length = BLOB_HEADER.unpack_from(payload)
+        start = BLOB_HEADER.size + length
+        data_type = DATA_TYPES_BY_NAME.get(
+            payload[BLOB_HEADER.size:start].tobytes())
+        if data_type is None:
+            return
+        data = payload[start:].tobytes()
+        key = (digest, data_type)
+        self._content.add(key, data)
+        with self._seq_lock:
+            items = [self._item] if self._message.get_digest() == digest \
+                else []
+        with self._fetched:
+            if key in self._fetching:
+                items.append(self._fetching.pop(key))
+            waiting = self._waiting.pop(key, [])
+            for item in items:
+                try:
+                    item.set_data(data_type, data)
+                except ValueError as e:
+                    print "Bad %s from peer: %s" % (data_type, e)
+            self._fetched.notify_all()
+        if waiting:
+            blob = Message(self._uid, message.get_payload(), Message.BLOB)
+            for c in waiting:
+                self._connection_thread.send(blob, c)
+
+    def _on_new_connection(self, conn, incoming):
+        """Called in the network thread when a connection to a peer has been
+        established, either by them or by us.
+
+        Rather than sending our clipboard straight away, both sides describe
+        theirs in their HELLO, and whichever has the later one sends it once
+        it hears from the other.
+
+        """
+        with self._seq_lock:
+            clock = self._clock
+            m = self._message
+        conn.send_hello(self._uid, clock=clock, stamp=m.get_timestamp(),
+                        digest=m.get_digest().encode('hex'))
+        if incoming and self._on_connect_callback:
+            self._on_connect_callback(*conn.get_peer_name())
 
 class ConnectionThread:
     """Manages the connection thread, and accepts messages from any thread on
@@ -177,25 +714,96 @@ class ConnectionThread:
 
     There should probably be only one instance of this object.
 
+    Implementation:
+
+    The thread sleeps in a Poller (epoll where available) until a socket is
+    ready or another thread hands it work. Work handed over through the
+    public methods is put on a queue, and a byte is written to a self-pipe
+    that the Poller also watches, so the thread wakes up immediately instead
+    of on a timer. When nothing is happening, it does not wake up at all.
+
     """
 
-    def __init__(self, msg_recv_callback, disconnect_callback):
+    def __init__(self, msg_recv_callback, disconnect_callback,
+                 connection_callback = None, progress_callback = None,
+                 content = None,
+                 status_callback = None,
+                 heartbeat_interval = HEARTBEAT_INTERVAL,
+                 heartbeat_misses = HEARTBEAT_MISSES, tcp_keepalive = False):
+        """The connection callback is called with each new Connection, and
+        whether the peer connected to us, as soon as the connection is
+        established and before anything is received on it.
+
+        The message callback is called with each message received and the
+        Connection it came in on.
+
+        The progress callback is called with a TransferProgress whenever a
+        chunked transfer to or from a peer advances, finishes or is
+        cancelled.
+
+        content is the ContentCache that clipboards are sent as deltas
+        against, if any.
+
+        The status callback is called with (host, port) and the new status
+        whenever a peer added with add_peer() changes status.
+
+        See Network for the heartbeat and keepalive settings.
+
+        """
         self._msg_recv_callback = msg_recv_callback
         self._disconnect_callback = disconnect_callback
+        # totals over all connections
+        self.statistics = Statistics()
+        self._connection_callback = connection_callback
+        self._progress_callback = progress_callback
+        self._content = content
+        self._status_callback = status_callback
+        self._heartbeat_interval = heartbeat_interval
+        self._heartbeat_misses = heartbeat_misses
+        self._tcp_keepalive = tcp_keepalive
 
         self._thread = Thread(target=self._loop)
         self._thread.daemon = True
 
-        # Queue of Message objects
+        # Queue of (Message, Connection) pairs, where the Connection is None
+        # for messages to all peers
         self._message_queue = Queue()
+        # the latest clipboard for all peers, if the thread hasn't got to it
+        # yet. Only the newest one is kept.
+        self._clipboard = None
+        self._clipboard_lock = Lock()
         # Queue of Connection objects to be added to _connections
         self._connection_queue = Queue()
         # Queue of (address, port) pairs indicating peers to disconnect from
         self._disconnect_queue = Queue()
+        # Queue of ConnectRequest objects for outgoing connections to start
+        self._connect_queue = Queue()
+        # Queue of ((host, port), add) pairs of peers to add to or remove from
+        # _peers
+        self._peer_queue = Queue()
 
         self._running = False
 
         self._connections = set()
+        # the same connections, by host, (host, port) and the peer's uid once
+        # it has said hello. May be read from any thread.
+        self.registry = Registry()
+        # Peers we stay connected to, by (host, port)
+        self._peers = {}
+        # ConnectRequests whose sockets are still connecting
+        self._connecting = set()
+        # listening socket, if we accept connections
+        self._listener = None
+        # heap of pending Timers
+        self._timers = []
+        # the Timer of the next heartbeat, while any peer can be pinged, so
+        # that an idle loop with no such peers never wakes up
+        self._heartbeat_timer = None
+
+        self._poller = Poller()
+        # used by other threads to wake the connection thread
+        self._wakeup_read, self._wakeup_write = wakeup_pair()
+        self._poller.register(self._wakeup_read)
 
     def start(self):
         self._running = True
@@ -203,202 +811,1725 @@ class ConnectionThread:
 
     def stop(self):
         self._running = False
+        self._wake()
         self._thread.join()
 
+    def listen(self, address):
+        """Accept connections on the given (host, port) address.
+
+        Must be called before start(). Socket errors, such as the port being
+        in use, are raised here.
+
+        """
+        listener = socket(AF_INET, SOCK_STREAM)
+        listener.setsockopt(SOL_SOCKET, SO_REUSEADDR, 1)
+        listener.bind(address)
+        # allow the OS to enqueue 5 waiting connections
+        listener.listen(5)
+        listener.setblocking(0)
+        self._listener = listener
+        self._poller.register(listener)
+
     def add_connection(self, connection):
         """Takes a Connection object"""
         self._connection_queue.put(connection)
+        self._wake()
 
-    def schedule_disconnect(self, address, port):
-        self._disconnect_queue.put((address, port))
+    def connect(self, request):
+        """Start establishing the outgoing connection described by the given
+        ConnectRequest. Its wait() method reports the outcome."""
+        self._connect_queue.put(request)
+        self._wake()
 
-    def send(self, message):
-        """Sends the given message to all peers"""
-        self._message_queue.put(message)
+    def add_peer(self, address):
+        """Keep a connection to the (host, port) address, reconnecting
+        whenever it fails, until remove_peer() is called"""
+        self._peer_queue.put((address, True))
+        self._wake()
+
+    def remove_peer(self, address):
+        self._peer_queue.put((address, False))
+        self._wake()
+
+    def schedule_disconnect(self, address):
+        """Disconnect from the peer at the (host, port) address, or any peer
+        on host if port is None. host must be in canonical form."""
+        self._disconnect_queue.put(address)
+        self._wake()
+
+    def send(self, message, conn = None):
+        """Sends the given message to the given Connection, or to all peers.
+
+        Clipboards for all peers are not queued: if the thread hasn't got to
+        the last one yet, the new one takes its place, since peers only need
+        the newest. Other messages are sent in order.
+
+        """
+        if conn is None and message.get_type() == Message.CLIPBOARD:
+            with self._clipboard_lock:
+                if self._clipboard is not None:
+                    self.statistics.coalesced += 1
+                self._clipboard = message
+        else:
+            self._message_queue.put((message, conn))
+        self._wake()
+
+    def relay(self, message, source, fanout = RELAY_FANOUT):
+        """Send the clipboard message to at most fanout peers, chosen at
+        random, other than the Connection it came in on, and a HAVE with its
+        digest to the rest. Those that don't have the content answer with a
+        WANT, so every peer gets it without all of them pushing it to each
+        other.
+
+        Must be called from the connection thread.
+
+        """
+        peers = [c for c in self._connections if c is not source]
+        push = peers
+        if len(peers) > fanout:
+            push = random.sample(peers, fanout)
+        have = Message(message.get_uid(), message.get_digest(), Message.HAVE)
+        have.set_sequence_number(message.get_sequence_number())
+        dead = []
+        for c in peers:
+            if c in push or not c.peer_supports('have'):
+                alive = c.send(message)
+            else:
+                alive = c.send(have)
+            if not alive:
+                dead.append(c)
+        for c in peers:
+            if c not in dead:
+                self._update_interest(c)
+                self._report_progress(c)
+        for c in dead:
+            self._drop_connection(c)
+
+    def _wake(self):
+        try:
+            self._wakeup_write.send('x')
+        except error as e:
+            # if the buffer is full, the thread is going to wake up anyway,
+            # and if it has stopped, there is nothing left to wake. That can
+            # happen when a name resolved late hands us work.
+            if e.errno not in (errno.EAGAIN, errno.EWOULDBLOCK, errno.EBADF):
+                raise
+
+    def call_later(self, delay, callback, *args):
+        """Run callback(*args) in the connection thread after delay seconds.
+
+        Must be called from the connection thread. Returns a Timer that can
+        be cancelled.
+
+        """
+        t = Timer(time.time() + delay, callback, args)
+        heapq.heappush(self._timers, t)
+        return t
 
     def _loop(self):
         while self._running:
             self._process_sends()
-            self._process_receive()
             self._process_new_conns()
+            self._process_connects()
+            self._process_peers()
             self._process_disconnects()
+            self._process_events()
+            self._process_timers()
 
+        # don't reconnect to anything while shutting down
+        self._peers.clear()
         while self._connections:
             # kinda gross, but we can't iterate over the elements since we
             # remove them in this loop, and we can't pop since we remove them in
             # the tear down method
             conn = iter(self._connections).next()
             self._tear_down_connection(conn)
+        for request in list(self._connecting):
+            self._finish_connect(request, error(ECANCELED,
+                                                'network stopped'))
+        try:
+            while True:
+                self._connect_queue.get_nowait().fail(
+                    error(ECANCELED, 'network stopped'))
+        except Empty:
+            pass
+        if self._listener:
+            self._poller.unregister(self._listener)
+            self._listener.close()
+
+        self._poller.close()
+        self._wakeup_read.close()
+        self._wakeup_write.close()
 
     def _process_sends(self):
+        dead = set()
+        sends = []
         try:
             while True:
                 # raises Empty when it's empty
-                message = self._message_queue.get_nowait()
-                for c in self._connections:
-                    c.send(message)
+                sends.append(self._message_queue.get_nowait())
         except Empty:
             pass
+        with self._clipboard_lock:
+            if self._clipboard is not None:
+                sends.append((self._clipboard, None))
+                self._clipboard = None
+        for message, conn in sends:
+            if conn is None:
+                targets = self._connections
+            elif conn in self._connections:
+                targets = [conn]
+            else:
+                # it has gone away since
+                targets = []
+            for c in targets:
+                if not c.send(message):
+                    dead.add(c)
+        for c in self._connections:
+            if c not in dead:
+                self._update_interest(c)
+                self._report_progress(c)
+        for c in dead:
+            self._drop_connection(c)
 
     def _process_new_conns(self):
         try:
             while True:
                 # raises Empty when it's empty
-                c = self._connection_queue.get_nowait()
-                self._connections.add(c)
+                self._add_connection(self._connection_queue.get_nowait())
         except Empty:
             pass
 
+    def _add_connection(self, c):
+        self._connections.add(c)
+        self.registry.add(c, *c.get_peer_name())
+        self._poller.register(c, c.wants_write())
+
+    def _process_connects(self):
+        try:
+            while True:
+                # raises Empty when it's empty
+                self._start_connect(self._connect_queue.get_nowait())
+        except Empty:
+            pass
+
+    def _start_connect(self, request):
+        try:
+            request.start()
+        except error as e:
+            request.fail(e)
+            return
+        self._connecting.add(request)
+        self._poller.register(request, True)
+        request.timer = self.call_later(
+            CONNECT_TIMEOUT, self._finish_connect, request,
+            timeout('timed out connecting to %s:%d' % request.address))
+
+    def _heartbeat(self):
+        """Ping peers we haven't heard from lately, and drop those that have
+        been silent for too long"""
+        now = time.time()
+        limit = self._heartbeat_interval * self._heartbeat_misses
+        dead = []
+        for c in self._connections:
+            if not c.peer_supports('ping'):
+                continue
+            silent = now - c.last_received
+            if silent > limit:
+                print "Peer %s:%d stopped responding" % c.get_peer_name()
+                dead.append(c)
+            elif silent >= self._heartbeat_interval:
+                if c.ping():
+                    self._update_interest(c)
+                else:
+                    dead.append(c)
+        for c in dead:
+            self._drop_connection(c)
+        self._heartbeat_timer = None
+        if self._pingable():
+            self._arm_heartbeat()
+
+    def _arm_heartbeat(self):
+        if self._heartbeat_interval and self._heartbeat_timer is None:
+            self._heartbeat_timer = self.call_later(self._heartbeat_interval,
+                                                    self._heartbeat)
+
+    def _pingable(self):
+        """Return whether any peer understands pings"""
+        return any(c.peer_supports('ping') for c in self._connections)
+
+    def _process_peers(self):
+        try:
+            while True:
+                # raises Empty when it's empty
+                address, add = self._peer_queue.get_nowait()
+                if add:
+                    self._add_peer(address)
+                else:
+                    self._remove_peer(address)
+        except Empty:
+            pass
+
+    def _add_peer(self, address):
+        peer = self._peers.get(address)
+        if peer is None:
+            peer = self._peers[address] = Peer(address)
+            self._connect_peer(peer)
+        elif peer.timer:
+            # waiting to retry; don't make the user wait
+            peer.timer.cancel()
+            self._connect_peer(peer)
+
+    def _remove_peer(self, address):
+        peer = self._peers.pop(address, None)
+        if peer is None:
+            return
+        if peer.timer:
+            peer.timer.cancel()
+        if peer.request in self._connecting:
+            self._finish_connect(peer.request,
+                                 error(ECANCELED, 'peer removed'))
+        if peer.connection in self._connections:
+            self._tear_down_connection(peer.connection)
+
+    def _connect_peer(self, peer):
+        peer.timer = None
+        peer.request = ConnectRequest(peer.address, self._peer_connected)
+        self._report_status(peer, Peer.CONNECTING)
+        self._start_connect(peer.request)
+
+    def _peer_connected(self, request):
+        """Called when a connection attempt to a Peer completes"""
+        peer = self._peers.get(request.address)
+        if peer is None or peer.request is not request:
+            # removed in the meantime
+            return
+        peer.request = None
+        if request.error:
+            self._retry_peer(peer)
+        else:
+            peer.connection = request.connection
+            peer.connected_at = time.time()
+            self._report_status(peer, Peer.CONNECTED)
+
+    def _retry_peer(self, peer):
+        peer.timer = self.call_later(peer.next_delay(), self._connect_peer,
+                                     peer)
+        self._report_status(peer, Peer.WAITING)
+
+    def _report_status(self, peer, status):
+        if self._status_callback:
+            self._status_callback(peer.address[0], peer.address[1], status)
+
+    def _finish_connect(self, request, err = None):
+        """Called when an outgoing connection has been established, or has
+        failed with the given error"""
+        self._connecting.remove(request)
+        self._poller.unregister(request)
+        request.timer.cancel()
+        if not err:
+            try:
+                c = Connection(request.take_socket(), self.statistics,
+                               self._content)
+            except error as e:
+                err = e
+        if err:
+            request.fail(err)
+        else:
+            self._new_connection(c, False)
+            request.succeed(c)
+
+    def _process_timers(self):
+        now = time.time()
+        while self._timers and self._timers[0].deadline <= now:
+            t = heapq.heappop(self._timers)
+            if not t.cancelled:
+                t.callback(*t.args)
+
+    def _next_timeout(self):
+        """Return how long the poller may sleep before a timer is due, or None
+        if there are no timers"""
+        while self._timers and self._timers[0].cancelled:
+            heapq.heappop(self._timers)
+        if not self._timers:
+            return None
+        return max(0, self._timers[0].deadline - time.time())
+
     def _process_disconnects(self):
         try:
             while True:
                 # raises Empty when it's empty
-                address, port = self._disconnect_queue.get_nowait()
-                # get canonical name
-                host = gethostbyname(address)
-
-                conn = None
-                for c in self._connections:
-
-                    # only enforce equal ports if a port was given
-                    if port is None:
-                        condition = c.get_peer_name()[0] == host
-                    else:
-                        condition = c.get_peer_name(0) == (host, port)
-
-                    if condition:
-                        conn = c
-                        break
+                host, port = self._disconnect_queue.get_nowait()
+                # only enforce equal ports if a port was given
+                conn = self.registry.get(host, port)
                 if conn:
                     self._tear_down_connection(conn)
         except Empty:
             pass
 
-    def _process_receive(self):
+    def _process_events(self):
         """Helper method for the connection loop.
 
-        Either processes the receipt of data from a single connection, or blocks
-        for TIMEOUT
-        seconds
+        Blocks until a connection is ready or another thread wakes us up, then
+        services every ready connection: queued data is written to those that
+        can take it, and each readable one may read up to READ_BUDGET bytes,
+        dispatching every complete message it received.
 
         """
-        # wait until a socket is ready to read
-        if self._connections:
-            readlist, _, _ = select(self._connections, [], [], TIMEOUT)
-            if readlist:
-                conn = readlist[0]
-
-                if conn.receive():
-                    self._msg_recv_callback(conn.get_next_message())
+        events = self._poller.poll(self._next_timeout())
+
+        for obj, readable, writable in events:
+            if obj is self._wakeup_read:
+                self._drain_wakeups()
+                continue
+            if obj is self._listener:
+                self._accept()
+                continue
+            if obj in self._connecting:
+                err = obj.get_error()
+                if err:
+                    self._finish_connect(obj, err)
+                elif writable:
+                    self._finish_connect(obj)
+                continue
+            # may have been dropped earlier in this pass
+            if obj not in self._connections:
+                continue
+            if writable:
+                if obj.flush():
+                    self._update_interest(obj)
                 else:
-                    if self._disconnect_callback:
-                        self._disconnect_callback(*conn.get_peer_name())
-                    self._tear_down_connection(conn)
-        else:
-            time.sleep(TIMEOUT)
+                    self._drop_connection(obj)
+                    continue
+            if readable:
+                # messages that arrived just before the peer hung up still
+                # count
+                alive = obj.receive(READ_BUDGET)
+                if not (self._dispatch_messages(obj) and alive):
+                    self._drop_connection(obj)
+                    continue
+                # replies to what it sent may not have been written in full
+                if obj.wants_write():
+                    self._update_interest(obj)
+            self._report_progress(obj)
+
+    def _accept(self):
+        """Accept every connection waiting on the listening socket"""
+        while True:
+            try:
+                client_socket, address = self._listener.accept()
+            except error as e:
+                if e.errno not in (errno.EAGAIN, errno.EWOULDBLOCK,
+                                   errno.ECONNABORTED, errno.EINTR):
+                    print "Error accepting connection: %s" % e
+                return
+            try:
+                c = Connection(client_socket, self.statistics,
+                               self._content)
+            except error as e:
+                # the peer went away already
+                client_socket.close()
+                continue
+            self._new_connection(c, True)
+
+    def _new_connection(self, c, incoming):
+        if self._tcp_keepalive:
+            c.set_keepalive(KEEPALIVE_IDLE, KEEPALIVE_INTERVAL,
+                            KEEPALIVE_COUNT)
+        if self._connection_callback:
+            self._connection_callback(c, incoming)
+        self._add_connection(c)
+
+    def _drain_wakeups(self):
+        try:
+            while self._wakeup_read.recv(4096):
+                pass
+        except error as e:
+            if e.errno not in (errno.EAGAIN, errno.EWOULDBLOCK):
+                raise
+
+    def _report_progress(self, conn):
+        for progress in conn.take_progress():
+            if self._progress_callback:
+                self._progress_callback(progress)
+
+    def _update_interest(self, conn):
+        """Only watch for writability while there is data waiting to go out"""
+        self._poller.modify(conn, conn.wants_write())
+
+    def _dispatch_messages(self, conn):
+        """Pass every complete message received on conn to the callback.
+
+        Returns False if the peer violated the protocol, in which case the
+        connection should be dropped.
+
+        """
+        try:
+            message = conn.get_next_message()
+            while message is not None:
+                if message.get_type() == Message.HELLO:
+                    self.registry.set_uid(conn, message.get_uid())
+                    if conn.peer_supports('ping'):
+                        self._arm_heartbeat()
+                self._msg_recv_callback(message, conn)
+                message = conn.get_next_message()
+        except ProtocolError as e:
+            print "Dropping connection: %s" % e
+            return False
+        return True
+
+    def _drop_connection(self, conn):
+        """Tear down a connection that failed, and report it"""
+        if self._disconnect_callback:
+            self._disconnect_callback(*conn.get_peer_name())
+        self._tear_down_connection(conn)
+        peer = self._peers.get(conn.get_peer_name())
+        if peer and peer.connection is conn:
+            peer.lost()
+            self._retry_peer(peer)
 
     def _tear_down_connection(self, conn):
+        self._poller.unregister(conn)
         conn.close()
         self._connections.remove(conn)
+        self.registry.remove(conn)
+        if self._heartbeat_timer and not self._pingable():
+            self._heartbeat_timer.cancel()
+            self._heartbeat_timer = None
+
+class Peer:
+    """A peer the connection thread stays connected to, see
+    ConnectionThread.add_peer()"""
+
+    # statuses reported to the status callback
+    CONNECTING, CONNECTED, WAITING = range(3)
+
+    def __init__(self, address):
+        self.address = address
+        # ConnectRequest in progress, if any
+        self.request = None
+        self.connection = None
+        self.connected_at = None
+        # Timer for the next attempt, while waiting for it
+        self.timer = None
+        # connection attempts that failed in a row
+        self.failures = 0
+
+    def lost(self):
+        """Note that the connection failed. A connection that did not last
+        long counts as a failure, so a peer that keeps dropping us right away
+        isn't reconnected to in a tight loop."""
+        if time.time() - self.connected_at > RECONNECT_MAX_DELAY:
+            self.failures = 0
+        self.connection = None
+
+    def next_delay(self):
+        """Return how long to wait before the next attempt. The delay is
+        randomized, so that peers that lost each other at the same moment
+        don't retry in lockstep."""
+        delay = min(RECONNECT_MAX_DELAY,
+                    RECONNECT_MIN_DELAY * 2 ** min(self.failures, 32))
+        self.failures += 1
+        return delay * random.uniform(0.5, 1.0)
+
+class Timer:
+    """A callback scheduled with ConnectionThread.call_later"""
+
+    def __init__(self, deadline, callback, args):
+        self.deadline = deadline
+        self.callback = callback
+        self.args = args
+        self.cancelled = False
+
+    def cancel(self):
+        self.cancelled = True
+
+    def __lt__(self, other):
+        return self.deadline < other.deadline
+
+class ConnectRequest:
+    """An outgoing connection being established by the connection thread.
+
+    Created in any thread and handed to ConnectionThread.connect(); the
+    connection thread starts a nonblocking connect, and completes the request
+    once the socket becomes writable or the attempt fails. Other threads can
+    block on wait() for the outcome; the connection thread can instead pass a
+    callback, which it calls with the request when it completes.
+
+    """
+
+    def __init__(self, address, callback = None):
+        self.address = address
+        self.callback = callback
+        self.connection = None
+        self.error = None
+        self.timer = None
+        self._socket = None
+        self._done = Event()
+
+    def start(self):
+        """Begin connecting without blocking"""
+        self._socket = socket(AF_INET, SOCK_STREAM)
+        self._socket.setblocking(0)
+        err = self._socket.connect_ex(self.address)
+        if err not in (0, errno.EINPROGRESS, errno.EWOULDBLOCK, errno.EALREADY):
+            raise error(err, os.strerror(err))
+
+    def fileno(self):
+        return self._socket.fileno()
+
+    def get_error(self):
+        """Return the error the connection attempt failed with, if any"""
+        err = self._socket.getsockopt(SOL_SOCKET, SO_ERROR)
+        if err:
+            return error(err, os.strerror(err))
+        return None
+
+    def take_socket(self):
+        """Return the connected socket, which the request no longer owns"""
+        sock, self._socket = self._socket, None
+        return sock
+
+    def succeed(self, connection):
+        self.connection = connection
+        self._done.set()
+        if self.callback:
+            self.callback(self)
+
+    def fail(self, err):
+        if self._socket:
+            self._socket.close()
+        self.error = err
+        self._done.set()
+        if self.callback:
+            self.callback(self)
+
+    def wait(self, timeout = None):
+        """Block until the connection is established, and return it. Raises
+        the error the attempt failed with."""
+        self._done.wait(timeout)
+        if self.error:
+            raise self.error
+        return self.connection
+
+def wakeup_pair():
+    """Return a connected pair of nonblocking sockets, (reader, writer).
+
+    Writing a byte to the writer makes the reader readable, which lets one
+    thread interrupt another that is waiting in a Poller. Sockets are used
+    rather than a pipe so that this also works with select on Windows.
+
+    """
+    if hasattr(_socket, 'socketpair'):
+        reader, writer = _socket.socketpair()
+    else:
+        listener = socket(AF_INET, SOCK_STREAM)
+        listener.bind(('127.0.0.1', 0))
+        listener.listen(1)
+        writer = socket(AF_INET, SOCK_STREAM)
+        writer.connect(listener.getsockname())
+        reader, _ = listener.accept()
+        listener.close()
+    reader.setblocking(0)
+    writer.setblocking(0)
+    return reader, writer
+
+class Poller:
+    """Waits for file descriptors to become readable or writable.
+
+    Uses epoll where it is available, and falls back to select elsewhere.
+    Registered objects are either file descriptors or have a fileno()
+    method. Every registered object is watched for reading; watching for
+    writing is turned on and off with modify().
+
+    """
+
+    def __init__(self):
+        # fileno -> (object, watching for writes)
+        self._objects = {}
+        if hasattr(select, 'epoll'):
+            self._epoll = select.epoll()
+        else:
+            self._epoll = None
+
+    def register(self, obj, write = False):
+        fd = self._fileno(obj)
+        self._objects[fd] = (obj, write)
+        if self._epoll:
+            self._epoll.register(fd, self._mask(write))
+
+    def modify(self, obj, write):
+        fd = self._fileno(obj)
+        if self._objects[fd][1] == write:
+            return
+        self._objects[fd] = (obj, write)
+        if self._epoll:
+            self._epoll.modify(fd, self._mask(write))
+
+    def unregister(self, obj):
+        fd = self._fileno(obj)
+        del self._objects[fd]
+        if self._epoll:
+            self._epoll.unregister(fd)
+
+    def poll(self, timeout = None):
+        """Wait until at least one registered object is ready, or until
+        timeout seconds have passed. A timeout of None waits forever.
+
+        Returns a list of (object, readable, writable) tuples. Errors and
+        hangups are reported as readable, so that the next read notices them.
+
+        """
+        try:
+            if self._epoll:
+                return self._poll_epoll(timeout)
+            return self._poll_select(timeout)
+        except (IOError, OSError, select.error) as e:
+            if e.args[0] == errno.EINTR:
+                return []
+            raise
+
+    def close(self):
+        if self._epoll:
+            self._epoll.close()
+
+    def _poll_epoll(self, timeout):
+        if timeout is None:
+            timeout = -1
+        events = []
+        for fd, mask in self._epoll.poll(timeout):
+            readable = mask & (select.EPOLLIN | select.EPOLLERR |
+                               select.EPOLLHUP)
+            writable = mask & select.EPOLLOUT
+            events.append((self._objects[fd][0], bool(readable),
+                           bool(writable)))
+        return events
+
+    def _poll_select(self, timeout):
+        readers = [obj for obj, _ in self._objects.itervalues()]
+        writers = [obj for obj, write in self._objects.itervalues() if write]
+        readable, writable, _ = select.select(readers, writers, [], timeout)
+        readable = set(readable)
+        writable = set(writable)
+        return [(obj, obj in readable, obj in writable)
+                for obj in readable | writable]
+
+    def _mask(self, write):
+        if write:
+            return select.EPOLLIN | select.EPOLLOUT
+        return select.EPOLLIN
+
+    @staticmethod
+    def _fileno(obj):
+        if isinstance(obj, (int, long)):
+            return obj
+        return obj.fileno()
 
 # TODO add locking if receives and get_next_messages are done in multiple
 # threads
 class Connection:
     """Manages a socket and other data specific to a connection.
 
-    Holds any data received that does not yet form a complete message.
+    Holds any data received that does not yet form a complete message, and
+    any data queued for sending that the socket has not accepted yet.
+
+    Outgoing clipboard messages are queued as OutgoingTransfers, and other
+    messages on a separate control queue. Whenever the socket can take more
+    data, the next control message goes first, and only then the next frame
+    of the current transfer, so control messages never wait for a large
+    clipboard to finish.
 
     """
 
-    def __init__(self, sock):
+    def __init__(self, sock, totals = None, content = None):
+        """totals is a Statistics object shared by several connections, which
+        this one adds its counts to, besides its own.
+
+        content is a ContentCache to look up the peer's current clipboard in,
+        so that new ones can be sent as deltas against it.
+
+        """
         self._socket = sock
         # use nonblocking i/o
         self._socket.setblocking(0)
-        self._raw_data = ''
+        # remember the peer's name, since it can't be asked for once the
+        # connection has failed
+        self._peer_name = sock.getpeername()
+        self._parser = MessageParser()
+        # clipboard being received in chunks, if any
+        self._incoming = None
+        # what the peer told us it supports in its HELLO, if it sent one
+        self.peer_info = None
+        # compression.Codec for frames we send, once the peer has said which
+        # ones it can decode
+        self._codec = None
+        # digests of clipboards the peer is known to hold, most recent last
+        self._peer_digests = OrderedDict()
+        self.statistics = Statistics()
+        self._totals = totals
+        self._content = content
+        # when we last received anything from the peer
+        self.last_received = time.time()
+        # our uid, as sent in our HELLO
+        self._uid = None
+
+        # buffers of the frame being written. Once a frame is started, it has
+        # to be written completely.
+        self._write_buffers = deque()
+        self._write_bytes = 0
+        # Messages other than clipboards, waiting to be written
+        self._control_queue = deque()
+        self._control_bytes = 0
+        # OutgoingTransfers waiting to be written, oldest first
+        self._transfers = deque()
+        # TransferProgress updates not yet reported
+        self._progress = []
 
     def get_peer_name(self):
-        return self._socket.getpeername()
+        return self._peer_name
+
+    def receive(self, budget = 0):
+        """Perform nonblocking receives on the underlying socket.
 
-    def receive(self):
-        """Perform a nonblocking receive on the underlying socket.
+        Reads until the socket has no more data available, or until at least
+        budget bytes have been read. With the default budget, reads once.
 
-        Return True if data was received, False otherwise. A False return code
-        generally means the connection has been severed.
+        Return False if the peer closed the connection or the socket failed,
+        True otherwise, including when a spurious wakeup found nothing to read.
 
         The received data is available through #get_next_message, if a complete
         message has been received.
 
         """
-        try:
-            new_data = self._socket.recv(RECV_SIZE)
-        except error as e:
-            return False
-
-        self._raw_data += new_data
-        return len(new_data) > 0
+        received = 0
+        while True:
+            try:
+                n = self._parser.receive(self._socket)
+            except error as e:
+                if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    return True
+                return False
+            if n == 0:
+                return False
+            received += n
+            self.last_received = time.time()
+            self._count('bytes_received', n)
+            if received >= budget:
+                return True
 
     def get_next_message(self):
         """Return the next available message, if there is one, or None, if none
-        is available"""
-        message, self._raw_data = Message.parse_message(self._raw_data)
+        is available.
+
+        Clipboards sent in chunks are reassembled here, and returned as a
+        single CLIPBOARD message once the last chunk has arrived.
+
+        Raises ProtocolError if the peer sent something that is not a valid
+        frame.
+
+        """
+        while True:
+            message = self._parser.next_message()
+            if message is None:
+                return None
+            msg_type = message.get_type()
+            if msg_type == Message.CHUNK:
+                message = self._receive_chunk(message)
+                if message is not None:
+                    if message.get_type() == Message.CLIPBOARD:
+                        self._remember(message.get_digest())
+                    return message
+            elif msg_type == Message.CANCEL:
+                if (self._incoming and
+                        self._incoming.id() == message.get_id()):
+                    self._report(self._incoming, TransferProgress.CANCELLED)
+                    self._incoming = None
+            elif msg_type == Message.PING:
+                self._queue_control(Message(message.get_uid(), '',
+                                            Message.PONG))
+            elif msg_type == Message.PONG:
+                # receiving it was the point
+                pass
+            else:
+                if msg_type == Message.HELLO:
+                    self._receive_hello(message)
+                elif msg_type in (Message.CLIPBOARD, Message.HAVE,
+                                  Message.DELTA):
+                    self._remember(message.get_digest())
+                elif msg_type == Message.WANT:
+                    # the peer has forgotten content we thought it held, and
+                    # maybe the base of a delta too, so stop relying on any
+                    self._peer_digests.clear()
+                return message
+
+    def _receive_hello(self, message):
+        try:
+            info = json.loads(message.get_payload())
+        except ValueError:
+            raise ProtocolError('malformed HELLO')
+        if not isinstance(info, dict):
+            raise ProtocolError('malformed HELLO')
+        self.peer_info = info
+        self._codec = compression.choose(info.get('compression', []))
+        digest = info.get('digest')
+        if digest is not None:
+            try:
+                self._remember(str(digest).decode('hex'))
+            except TypeError:
+                raise ProtocolError('malformed HELLO')
+
+    def peer_supports(self, capability):
+        """Return whether the peer said in its HELLO that it understands the
+        given part of the protocol"""
+        return (self.peer_info is not None and
+                capability in self.peer_info.get('capabilities', ()))
+
+    def send_hello(self, uid, **info):
+        """Queue a HELLO message telling the peer what we support. Any keyword
+        arguments are sent along with it; a hex digest, if given, tells the
+        peer which clipboard we hold."""
+        info['version'] = PROTOCOL_VERSION
+        info['capabilities'] = CAPABILITIES
+        info['compression'] = compression.names()
+        self._uid = uid
+        return self.send(Message(uid, json.dumps(info), Message.HELLO))
+
+    def ping(self):
+        """Ask the peer to reply with a PONG, so that we know it is still
+        there. Returns False if the connection has failed."""
+        return self.send(Message(self._uid, '', Message.PING))
+
+    def set_keepalive(self, idle, interval, count):
+        """Have the operating system probe the connection when it is idle, and
+        fail it if the peer stops answering. The timings are only changed
+        where the platform allows it."""
+        self._socket.setsockopt(SOL_SOCKET, SO_KEEPALIVE, 1)
+        for name, value in (('TCP_KEEPIDLE', idle),
+                            ('TCP_KEEPINTVL', interval),
+                            ('TCP_KEEPCNT', count)):
+            if hasattr(_socket, name):
+                self._socket.setsockopt(IPPROTO_TCP, getattr(_socket, name),
+                                        value)
+
+    def _receive_chunk(self, chunk):
+        payload = chunk.get_payload_view()
+        if len(payload) < CHUNK_HEADER.size:
+            raise ProtocolError('short chunk')
+        total, offset, digest = CHUNK_HEADER.unpack_from(payload)
+        data = payload[CHUNK_HEADER.size:]
+
+        if offset == 0:
+            if self._incoming:
+                # the sender moved on without finishing the last one
+                self._report(self._incoming, TransferProgress.CANCELLED)
+            if total > MAX_PAYLOAD_SIZE:
+                raise ProtocolError('transfer too large (%d bytes)' % total)
+            if chunk.get_flags() & CHUNK_OF_BLOB:
+                msg_type = Message.BLOB
+            else:
+                msg_type = Message.CLIPBOARD
+            self._incoming = IncomingTransfer(chunk.get_uid(),
+                                              chunk.get_sequence_number(),
+                                              total, digest, msg_type)
+        elif not self._incoming or self._incoming.id() != chunk.get_id():
+            raise ProtocolError('chunk of an unknown transfer')
+
+        transfer = self._incoming
+        transfer.add(offset, data, total, digest)
+        if not transfer.done():
+            self._report(transfer, TransferProgress.ACTIVE)
+            return None
+        self._incoming = None
+        self._report(transfer, TransferProgress.DONE)
+        message = transfer.message()
+        message.check_digest()
         return message
 
     def fileno(self):
         return self._socket.fileno()
 
     def send(self, message):
-        self._socket.sendall(message.raw())
+        """Queue the message and write as much as the socket will take without
+        blocking.
+
+        Anything left over is written by flush() once the socket becomes
+        writable. A new clipboard message cancels a clipboard transfer that
+        is part way through, and drops queued clipboards that have not
+        started going out, since the peer only needs the newest. Control
+        messages are never dropped, and go out in order.
+
+        Representations sent in reply to a FETCH are queued as transfers
+        too, but are not superseded.
+
+        Returns False if the connection has failed.
+
+        """
+        if message.get_type() == Message.BLOB:
+            self._transfers.append(OutgoingTransfer(message))
+        elif message.get_type() == Message.CLIPBOARD:
+            self._supersede_transfers()
+            if (message.get_digest() in self._peer_digests and
+                    self.peer_supports('have')):
+                # the peer has this content already, so just tell it to
+                # switch to it
+                have = Message(message.get_uid(), message.get_digest(),
+                               Message.HAVE)
+                have.set_sequence_number(message.get_sequence_number())
+                self._queue_control(have)
+                self._count('bytes_saved', len(message.get_payload_view()))
+            else:
+                delta_message = self._make_delta(message)
+                self._transfers.append(OutgoingTransfer(delta_message or
+                                                        message))
+        else:
+            self._queue_control(message)
+        return self.flush()
+
+    def _make_delta(self, message):
+        """Return a DELTA message describing the clipboard in message against
+        the one the peer has most recently, or None if that isn't possible or
+        wouldn't help"""
+        if (not self._content or not self._peer_digests or
+                not self.peer_supports('delta')):
+            return None
+        size = len(message.get_payload_view())
+        if size < DELTA_MIN_SIZE:
+            return None
+        base_digest = next(reversed(self._peer_digests))
+        d = message.known_delta(base_digest)
+        # the DELTA has to go out as a single frame, since chunks are put
+        # back together as a CLIPBOARD
+        if d is None or DIGEST_SIZE + len(d) > DELTA_MAX_SIZE:
+            return None
+        m = Message(message.get_uid(), base_digest + d, Message.DELTA)
+        m.set_sequence_number(message.get_sequence_number())
+        m.set_digest(message.get_digest())
+        self._count('bytes_saved', size - len(d))
+        return m
+
+    def _queue_control(self, message):
+        self._control_queue.append(message)
+        self._control_bytes += len(message.raw())
+
+    def _remember(self, digest):
+        """Note that the peer holds the clipboard with the given digest"""
+        self._peer_digests.pop(digest, None)
+        self._peer_digests[digest] = True
+        if len(self._peer_digests) > PEER_DIGESTS:
+            self._peer_digests.popitem(last=False)
+
+    def _count(self, counter, n):
+        for stats in (self.statistics, self._totals):
+            if stats:
+                setattr(stats, counter, getattr(stats, counter) + n)
+
+    def wants_write(self):
+        """Return True if there is queued data waiting to be written"""
+        return bool(self._write_buffers or self._control_queue or
+                    self._transfers)
+
+    def pending_bytes(self):
+        return (self._write_bytes + self._control_bytes +
+                sum(t.remaining() for t in self._transfers))
+
+    def flush(self):
+        """Write queued data until the socket would block.
+
+        Returns False if the connection has failed.
+
+        """
+        while self._write_buffers or self._next_frame():
+            data = self._write_buffers[0]
+            try:
+                sent = self._socket.send(data)
+            except error as e:
+                if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR):
+                    return True
+                return False
+            self._write_bytes -= sent
+            self._count('bytes_sent', sent)
+            if sent < len(data):
+                self._write_buffers[0] = data[sent:]
+                return True
+            self._write_buffers.popleft()
+        return True
+
+    def take_progress(self):
+        """Return the TransferProgress updates since the last call"""
+        progress, self._progress = self._progress, []
+        return progress
+
+    def _next_frame(self):
+        """Move the next frame to be sent to the write buffers. Returns False
+        if there is nothing left to send."""
+        if self._control_queue:
+            message = self._control_queue.popleft()
+            self._control_bytes -= len(message.raw())
+            buffers = [memoryview(message.raw(self._codec))]
+        elif self._transfers:
+            transfer = self._transfers[0]
+            buffers = transfer.next_frame(self._codec)
+            if transfer.done():
+                self._transfers.popleft()
+                if transfer.message.get_type() != Message.BLOB:
+                    self._remember(transfer.message.get_digest())
+                state = TransferProgress.DONE
+            else:
+                state = TransferProgress.ACTIVE
+            if transfer.chunked:
+                self._report(transfer, state)
+        else:
+            return False
+        for b in buffers:
+            self._write_buffers.append(b)
+            self._write_bytes += len(b)
+        return True
+
+    def _supersede_transfers(self):
+        """Drop the clipboards waiting to be sent, now that a newer one is
+        to go out, and cancel the one part way through"""
+        kept = deque()
+        for transfer in self._transfers:
+            if transfer.message.get_type() == Message.BLOB:
+                # asked for, and not made out of date by a new clipboard
+                kept.append(transfer)
+            elif transfer.started():
+                # the rest of its current frame is already in the write
+                # buffers; tell the peer not to expect the remaining chunks
+                cancel = Message(transfer.message.get_uid(), '',
+                                 Message.CANCEL)
+                cancel.set_sequence_number(
+                    transfer.message.get_sequence_number())
+                self._queue_control(cancel)
+                self._report(transfer, TransferProgress.CANCELLED)
+                self._count('superseded', 1)
+            else:
+                self._count('superseded', 1)
+        self._transfers = kept
+
+    def _report(self, transfer, state):
+        if state == TransferProgress.ACTIVE and not transfer.should_report():
+            return
+        self._progress.append(TransferProgress(
+            self._peer_name, isinstance(transfer, OutgoingTransfer),
+            transfer.id(), transfer.transferred(), transfer.total, state))
 
     def close(self):
         self._socket.close()
 
-# TODO fill out the rest of the implementation of this class -- implement the
-# more complicated protocol, and then modify the Network class accordingly
+class Statistics:
+    """Traffic counters, for one connection or totalled over several"""
+
+    def __init__(self):
+        self.bytes_sent = 0
+        self.bytes_received = 0
+        # clipboard bytes that did not have to be sent, because the peer
+        # already had the content
+        self.bytes_saved = 0
+        # clipboards queued for a peer that were dropped, or cancelled part
+        # way through, because a newer one replaced them while the peer was
+        # behind
+        self.superseded = 0
+        # clipboards replaced by a newer one before the network thread got
+        # to send them to anyone. Only counted in the totals.
+        self.coalesced = 0
+
+    def as_dict(self):
+        return dict(self.__dict__)
+
+class ContentCache:
+    """Recently seen clipboard contents, by digest, least recently used
+    first. Bounded by both the number of items and their total size.
+
+    Threadsafe.
+
+    """
+
+    def __init__(self, max_items = CONTENT_CACHE_ITEMS,
+                 max_bytes = CONTENT_CACHE_BYTES):
+        self._items = OrderedDict()
+        self._bytes = 0
+        self._max_items = max_items
+        self._max_bytes = max_bytes
+        self._lock = Lock()
+
+    def add(self, digest, payload):
+        with self._lock:
+            if digest in self._items:
+                self._items[digest] = self._items.pop(digest)
+                return
+            if len(payload) > self._max_bytes:
+                return
+            self._items[digest] = payload
+            self._bytes += len(payload)
+            while (len(self._items) > self._max_items or
+                   self._bytes > self._max_bytes):
+                _, old = self._items.popitem(last=False)
+                self._bytes -= len(old)
+
+    def get(self, digest):
+        """Return the content with the given digest, or None"""
+        with self._lock:
+            payload = self._items.pop(digest, None)
+            if payload is not None:
+                self._items[digest] = payload
+            return payload
+
+class TransferProgress:
+    """Reports how far a clipboard transfer to or from a peer has got.
+
+    Only clipboards large enough to be sent in chunks are reported.
+
+    """
+    ACTIVE, DONE, CANCELLED = range(3)
+
+    def __init__(self, peer, outgoing, transfer_id, transferred, total,
+                 state):
+        # (address, port) of the peer
+        self.peer = peer
+        self.outgoing = outgoing
+        # (uid, sequence number) of the clipboard message
+        self.transfer_id = transfer_id
+        self.transferred = transferred
+        self.total = total
+        self.state = state
+
+    def fraction(self):
+        if not self.total:
+            return 1.0
+        return float(self.transferred) / self.total
+
+    def __str__(self):
+        direction = "to" if self.outgoing else "from"
+        return "%d/%d bytes %s %s:%d" % ((self.transferred, self.total,
+                                          direction) + tuple(self.peer))
+
+class Transfer:
+    """Base class for clipboards being sent to or received from a peer"""
+
+    def __init__(self, total):
+        self.total = total
+        self._last_report = 0
+
+    def should_report(self):
+        """Rate limits progress updates to one per PROGRESS_INTERVAL"""
+        now = time.time()
+        if now - self._last_report < PROGRESS_INTERVAL:
+            return False
+        self._last_report = now
+        return True
+
+class OutgoingTransfer(Transfer):
+    """A clipboard message, or a BLOB, on its way to one peer.
+
+    Payloads of up to CHUNK_SIZE bytes go out as a single frame.
+    Larger ones are sent as a series of CHUNK frames, so that other frames
+    can be interleaved with them and the transfer can be cancelled part way
+    through. Chunks are cut from the payload as they are needed, without
+    copying it.
+
+    """
+
+    def __init__(self, message):
+        self.message = message
+        self._payload = message.get_payload_view()
+        Transfer.__init__(self, len(self._payload))
+        self.chunked = self.total > CHUNK_SIZE
+        self._offset = 0
+        self._finished = False
+        # codec the chunks are compressed with, if any
+        self._codec = None
+
+    def id(self):
+        return self.message.get_id()
+
+    def started(self):
+        return self._offset > 0 and not self._finished
+
+    def done(self):
+        return self._finished
+
+    def transferred(self):
+        return self._offset
+
+    def remaining(self):
+        return self.total - self._offset
+
+    def next_frame(self, codec = None):
+        """Return the buffers making up the next frame to send, compressing
+        it with the given compression.Codec if that helps"""
+        if not self.chunked:
+            self._offset = self.total
+            self._finished = True
+            return [memoryview(self.message.raw(codec))]
+
+        if self._offset == 0 and codec and codec.worth_using(self._payload):
+            # decided once for the whole transfer, from its start
+            self._codec = codec
+
+        end = min(self._offset + CHUNK_SIZE, self.total)
+        chunk_header = CHUNK_HEADER.pack(self.total, self._offset,
+                                         self.message.get_digest())
+        data = self._payload[self._offset:end]
+        self._offset = end
+        self._finished = end == self.total
+
+        flags = 0
+        if self.message.get_type() == Message.BLOB:
+            flags = CHUNK_OF_BLOB
+        if self._codec:
+            compressed = self._codec.compress(chunk_header + data.tobytes())
+            if len(compressed) < len(chunk_header) + len(data):
+                flags |= self._codec.id
+                chunk_header = ''
+                data = memoryview(compressed)
+        header = HEADER.pack(MAGIC, PROTOCOL_VERSION, Message.CHUNK, flags,
+                             self.message.get_uid(),
+                             self.message.get_sequence_number(),
+                             len(chunk_header) + len(data))
+        return [memoryview(header + chunk_header), data]
+
+class IncomingTransfer(Transfer):
+    """A clipboard, or a BLOB, being received from a peer in chunks"""
+
+    def __init__(self, uid, seq, total, digest, msg_type = None):
+        Transfer.__init__(self, total)
+        self.uid = uid
+        self.seq = seq
+        self.digest = digest
+        self.msg_type = msg_type or Message.CLIPBOARD
+        # grown as chunks arrive, rather than allocated for the total the
+        # peer announced up front
+        self._data = bytearray()
+        self._received = 0
+
+    def id(self):
+        return (self.uid, self.seq)
+
+    def add(self, offset, data, total, digest):
+        """Store a chunk. Chunks must arrive in order."""
+        end = offset + len(data)
+        if (offset != self._received or total != self.total or end > total or
+                digest != self.digest):
+            raise ProtocolError('chunk out of order')
+        self._data += data
+        self._received = end
+
+    def done(self):
+        return self._received == self.total
+
+    def transferred(self):
+        return self._received
+
+    def message(self):
+        m = Message(self.uid, memoryview(self._data), self.msg_type)
+        m.set_sequence_number(self.seq)
+        m.set_digest(self.digest)
+        return m
+
+class ProtocolError(Exception):
+    """Raised when a peer sends data that does not follow the wire format"""
+    pass
+
+# Every frame on the wire starts with a fixed size header:
+#   magic (2 bytes), protocol version, message type, flags, one byte of
+#   padding, uid of the sender, sequence number, payload length
+# All fields are in network byte order. The payload follows immediately.
+MAGIC = 'SB'
+PROTOCOL_VERSION = 1
+# optional message types we understand, as announced in HELLO
+CAPABILITIES = ['have', 'delta', 'ping', 'fetch']
+HEADER = struct.Struct('!2sBBBxIII')
+HEADER_SIZE = HEADER.size
+# refuse clipboards larger than this; a peer announcing more is broken
+MAX_PAYLOAD_SIZE = 1 << 30
+# no frame is larger than a chunk with its CHUNK header, plus what a codec
+# may add to incompressible data. Checked before anything is allocated for
+# a frame, so a forged header can't make us allocate much.
+MAX_FRAME_SIZE = CHUNK_SIZE + 1024
+# clipboards are identified by the SHA-256 digest of their content
+DIGEST_SIZE = 32
+# CHUNK payloads start with the total size of the clipboard being sent, the
+# offset of this chunk in it and the digest of the whole clipboard
+CHUNK_HEADER = struct.Struct('!II%ds' % DIGEST_SIZE)
+# set in the flags of CHUNK frames that carry a BLOB rather than a clipboard
+CHUNK_OF_BLOB = 0x04
+# BLOB payloads start with the digest of the clipboard the data belongs to
+# and the length of the name of its format, which follows
+BLOB_HEADER = struct.Struct('!%dsB' % DIGEST_SIZE)
+
 class Message:
     """A record type representing a message to be passed over the wire
     """
 
+    # message types
+    CLIPBOARD = 0
+    # part of a clipboard that is too large to send in one frame
+    CHUNK = 1
+    # the rest of the chunked clipboard with this uid and sequence number
+    # will not be sent
+    CANCEL = 2
+    # sent by both sides when a connection is established. The payload is a
+    # JSON object describing what the sender supports.
+    HELLO = 3
+    # the sender's clipboard is now the content with the digest in the
+    # payload, which the receiver is believed to have already
+    HAVE = 4
+    # reply to a HAVE or DELTA for content the receiver doesn't have after
+    # all
+    WANT = 5
+    # the sender's clipboard changed to the content with the given digest.
+    # The payload is the digest of the base clipboard, followed by a delta
+    # (see delta.py) that turns it into the new one.
+    DELTA = 6
+    # asks the peer to reply with a PONG, to check that it is still there
+    PING = 7
+    PONG = 8
+    # asks for a representation of a clipboard that was too large to be sent
+    # with it (see clipitem.py). The payload is the digest of the clipboard
+    # followed by the wire name of the format.
+    FETCH = 9
+    # reply to a FETCH. The payload starts with a BLOB_HEADER and the name of
+    # the format, followed by the data. Like clipboards, BLOBs are sent with
+    # their digest in front, and in chunks if they are large.
+    BLOB = 10
+
     @staticmethod
     def parse_message(raw_message):
         """Return a Message object representing the data contained in the
         argument, plus any left data left over at the end.
 
-        Return (None, raw_message) if the argument does not represent a valid Message
+        Return (None, raw_message) if the argument does not contain a complete
+        Message yet. Raises ProtocolError if it can never form a valid one.
+        """
+        if len(raw_message) < HEADER_SIZE:
+            return (None, raw_message)
+        header = Message.parse_header(raw_message)
+        end = HEADER_SIZE + header[-1]
+        if len(raw_message) < end:
+            return (None, raw_message)
+        m = Message.from_header(header, raw_message[HEADER_SIZE:end])
+        return (m, raw_message[end:])
+
+    @staticmethod
+    def parse_header(data, offset=0):
+        """Decode and validate the frame header at the given offset.
+
+        Returns a tuple of (type, flags, uid, sequence number, payload length).
+
         """
-        # TODO use a not stub value
-        m = Message(0)
-        m.set_payload(raw_message)
-        return (m, '')
+        magic, version, msg_type, flags, uid, seq, length = \
+            HEADER.unpack_from(data, offset)
+        if magic != MAGIC:
+            raise ProtocolError('bad magic %r' % magic)
+        if version != PROTOCOL_VERSION:
+            raise ProtocolError('unsupported protocol version %d' % version)
+        if length > MAX_FRAME_SIZE:
+            raise ProtocolError('frame too large (%d bytes)' % length)
+        return (msg_type, flags, uid, seq, length)
+
+    @staticmethod
+    def from_header(header, payload):
+        """Build a Message from a decoded header and the frame's payload.
+
+        Compressed payloads are decompressed, and digests are taken off
+        clipboard payloads and checked. Raises ProtocolError if any of that
+        fails.
 
-    def __init__(self, uid = None, payload=''):
+        """
+        msg_type, flags, uid, seq, _ = header
+        m = Message(uid, payload, msg_type)
+        m.set_sequence_number(seq)
+        m.set_flags(flags)
+        if flags & compression.FLAG_MASK:
+            m._decompress()
+        if msg_type in (Message.CLIPBOARD, Message.BLOB):
+            m.split_digest()
+        elif msg_type == Message.DELTA:
+            # the digest is of the clipboard after applying the delta
+            m.split_digest(False)
+        elif msg_type in (Message.HAVE, Message.WANT):
+            m.set_digest(m.get_payload_view().tobytes())
+        return m
+
+    def _decompress(self):
+        codec_id = self._flags & compression.FLAG_MASK
+        try:
+            codec = compression.get(codec_id)
+            payload = codec.decompress(self.get_payload_view(),
+                                       MAX_FRAME_SIZE)
+        except KeyError:
+            raise ProtocolError('unknown compression codec %d' % codec_id)
+        except ValueError as e:
+            raise ProtocolError(str(e))
+        self.set_payload(payload)
+        self.set_flags(self._flags & ~compression.FLAG_MASK)
+
+    def __init__(self, uid = None, payload='', msg_type = CLIPBOARD):
         self._uid = uid
         self._payload = payload
-
-    def raw(self):
+        self._type = msg_type
+        self._seq = 0
+        self._flags = 0
+        self._digest = None
+        # cached results of raw() by codec id, since a message is usually
+        # sent to several peers
+        self._raw = {}
+        # deltas against other clipboards, by their digest
+        self._deltas = {}
+
+    def raw(self, codec = None):
         """Return a representation of this Message suitable for sending over the
-        wire"""
+        wire.
+
+        If a compression.Codec is given, the payload is compressed with it,
+        unless that would not make it noticeably smaller.
+
+        """
         if not self._uid:
             raise RuntimeError('no uid set')
-
-        return self._payload
+        key = codec and codec.id
+        if key not in self._raw:
+            self._raw[key] = self._encode(codec)
+        return self._raw[key]
+
+    def _encode(self, codec):
+        payload = self.get_payload_view()
+        if self._type in (Message.CLIPBOARD, Message.DELTA, Message.BLOB):
+            # clipboards are sent with their digest in front
+            payload = self.get_digest() + payload.tobytes()
+        flags = self._flags
+        if codec and codec.worth_using(payload):
+            compressed = codec.compress(payload)
+            if len(compressed) < len(payload):
+                payload = compressed
+                flags |= codec.id
+        if isinstance(payload, memoryview):
+            payload = payload.tobytes()
+        header = HEADER.pack(MAGIC, PROTOCOL_VERSION, self._type, flags,
+                             self._uid, self._seq, len(payload))
+        return header + payload
 
     def set_payload(self, payload):
         self._payload = payload
+        self._raw = {}
+        self._digest = None
+        self._deltas = {}
 
     def get_payload(self):
+        """Return the payload as a string.
+
+        Payloads of received messages start out as views into the receive
+        buffer; the first call copies the data out and releases the view.
+
+        """
+        if isinstance(self._payload, memoryview):
+            self._payload = self._payload.tobytes()
         return self._payload
 
+    def get_payload_view(self):
+        """Return the payload as a memoryview, without copying it"""
+        if isinstance(self._payload, memoryview):
+            return self._payload
+        if isinstance(self._payload, unicode):
+            self._payload = self._payload.encode('utf-8')
+        return memoryview(self._payload)
+
     def set_uid(self, uid):
-        self._uid
+        self._uid = uid
+        self._raw = {}
 
     def get_uid(self):
         return self._uid
 
     def set_sequence_number(self, n):
-        self._seq = n;
+        self._seq = n
+        self._raw = {}
 
     def get_sequence_number(self):
         return self._seq
 
+    def get_digest(self):
+        """Return the SHA-256 digest of the payload, which identifies the
+        content of a clipboard"""
+        if self._digest is None:
+            self._digest = hashlib.sha256(self.get_payload_view()).digest()
+        return self._digest
+
+    def set_digest(self, digest):
+        if len(digest) != DIGEST_SIZE:
+            raise ProtocolError('bad digest')
+        self._digest = str(digest)
+
+    def check_digest(self):
+        """Raise ProtocolError unless the digest matches the payload"""
+        if hashlib.sha256(self.get_payload_view()).digest() != self._digest:
+            raise ProtocolError('clipboard does not match its digest')
+
+    def split_digest(self, check = True):
+        """Take the digest off the front of a received clipboard payload, and
+        check it unless told not to"""
+        payload = self.get_payload_view()
+        self.set_payload(payload[DIGEST_SIZE:])
+        self.set_digest(payload[:DIGEST_SIZE].tobytes())
+        if check:
+            self.check_digest()
+
+    def get_delta(self, base_digest, content):
+        """Return a delta turning the clipboard with the given digest into
+        this one, or None if the base isn't in the ContentCache or the delta
+        wouldn't be smaller. Deltas are remembered, since several peers
+        usually have the same base."""
+        if base_digest not in self._deltas:
+            base = content.get(base_digest)
+            if base is None:
+                return None
+            self._deltas[base_digest] = delta.make(base, self.get_payload())
+        return self._deltas[base_digest]
+
+    def known_delta(self, base_digest):
+        """Return the delta against the given base if get_delta has already
+        worked it out, or None"""
+        return self._deltas.get(base_digest)
+
+    def get_id(self):
+        """Return (uid, sequence number), which identifies a clipboard"""
+        return (self._uid, self._seq)
+
+    def get_timestamp(self):
+        """Return (sequence number, uid), which orders clipboards: the
+        sequence number is the sender's Lamport clock, and the uid breaks
+        ties between clipboards set at the same time"""
+        return (self._seq, self._uid)
+
+    def set_type(self, msg_type):
+        self._type = msg_type
+        self._raw = {}
+
+    def get_type(self):
+        return self._type
+
+    def set_flags(self, flags):
+        self._flags = flags
+        self._raw = {}
+
+    def get_flags(self):
+        return self._flags
+
     def __str__(self):
-        return self._payload
+        return self.get_payload()
+
+class MessageParser:
+    """Incrementally extracts Messages from a stream of bytes.
+
+    Received data is written straight into a preallocated bytearray, either
+    by receive(), which reads from a socket with recv_into, or by feed().
+    Complete frames are taken out one at a time with next_message(), and
+    their payloads are memoryview slices of the buffer rather than copies.
+
+    The header of a partially received frame is decoded only once. Once a
+    header announces a large payload, the buffer is grown to hold the whole
+    frame and reads ask for everything still missing, so a large clipboard
+    takes a handful of reads rather than one per RECV_SIZE bytes.
+
+    The buffer is never resized or rewritten in place while payloads handed
+    out from it may still be in use; a new one is allocated instead, and the
+    old one is freed when the last view into it goes away.
+
+    """
+
+    def __init__(self):
+        self._buffer = bytearray(RECV_BUFFER_SIZE)
+        # buffered, unconsumed data is _buffer[_start:_end]
+        self._start = 0
+        self._end = 0
+        # decoded header of the frame currently being received, if any
+        self._header = None
+        # whether a payload view into _buffer has been handed out
+        self._exported = False
+
+    def buffered(self):
+        """Return the number of received bytes not yet returned as a Message"""
+        return self._end - self._start
+
+    def read_size(self):
+        """Return how many bytes the next read should ask for.
+
+        This is RECV_SIZE, unless the frame currently being received still
+        needs more than that.
+
+        """
+        size = RECV_SIZE
+        if self._header is not None:
+            size = max(size, self._header[-1] - self.buffered())
+        return size
+
+    def receive(self, sock):
+        """Read once from sock into the buffer, without blocking.
+
+        Returns the number of bytes read; 0 means the peer closed the
+        connection. Socket errors are passed on to the caller.
+
+        """
+        size = self.read_size()
+        self._reserve(size)
+        n = sock.recv_into(memoryview(self._buffer)[self._end:], size)
+        self._end += n
+        return n
+
+    def feed(self, data):
+        self._reserve(len(data))
+        self._buffer[self._end:self._end + len(data)] = data
+        self._end += len(data)
+
+    def next_message(self):
+        """Return the next complete Message, or None if more data is needed.
+
+        The payload of the returned Message is a view into the receive
+        buffer. Raises ProtocolError if the buffered data is not a valid
+        frame.
+
+        """
+        if self._header is None:
+            if self.buffered() < HEADER_SIZE:
+                return None
+            self._header = Message.parse_header(self._buffer, self._start)
+            self._start += HEADER_SIZE
+
+        length = self._header[-1]
+        if self.buffered() < length:
+            return None
+
+        end = self._start + length
+        payload = memoryview(self._buffer)[self._start:end]
+        self._exported = True
+        m = Message.from_header(self._header, payload)
+        self._header = None
+        self._start = end
+        if self._start == self._end:
+            self._reset()
+        return m
+
+    def _reserve(self, n):
+        """Make room for n more bytes after the buffered data"""
+        if self._end + n <= len(self._buffer):
+            return
+        buffered = self.buffered()
+        new_buffer = bytearray(max(RECV_BUFFER_SIZE, buffered + n))
+        new_buffer[:buffered] = \
+            memoryview(self._buffer)[self._start:self._end]
+        self._buffer = new_buffer
+        self._start = 0
+        self._end = buffered
+        self._exported = False
+
+    def _reset(self):
+        """Start over at the beginning of the buffer. Only valid when all of
+        the buffered data has been consumed."""
+        if self._exported or len(self._buffer) > RECV_BUFFER_SIZE:
+            # drop any oversized buffer kept from a large frame, and don't
+            # overwrite payloads that were handed out
+            self._buffer = bytearray(RECV_BUFFER_SIZE)
+            self._exported = False
+        self._start = 0
+        self._end = 0
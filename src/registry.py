@@ -0,0 +1,154 @@
+"""
+    Cross-platform clipboard syncing tool
+    Copyright (C) 2013  Syncboard
+
+    This program is free software; you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation; either version 2 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License along
+    with this program; if not, write to the Free Software Foundation, Inc.,
+    51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+"""
+
+"""
+    An index of peers, used both for the connections the user manages and
+    for the sockets the network thread holds.
+"""
+
+from threading import RLock
+
+class Registry:
+    """A set of entries, each found in constant time by its address, by its
+    (address, port) pair, or by the uid of the peer, once that is known.
+
+    Entries can be any objects. Addresses must be in canonical form. At most
+    one entry may have a given (address, port) pair, where the port may be
+    None, and at most one a given uid.
+
+    Listeners added with subscribe() are told about every change, in the
+    thread that made it.
+
+    Threadsafe.
+
+    """
+
+    ADDED, CHANGED, REMOVED = range(3)
+
+    def __init__(self):
+        self._lock = RLock()
+        # address -> {port: entry}
+        self._by_address = {}
+        self._by_uid = {}
+        # entry -> [address, port, uid]
+        self._keys = {}
+        self._listeners = []
+
+    def add(self, entry, address, port = None, uid = None):
+        """Add an entry. Returns False, and does nothing, if there is one for
+        that address and port already."""
+        with self._lock:
+            by_port = self._by_address.setdefault(address, {})
+            if port in by_port:
+                return False
+            by_port[port] = entry
+            self._keys[entry] = [address, port, None]
+            if uid is not None:
+                self._set_uid(entry, uid)
+        self._notify(Registry.ADDED, entry)
+        return True
+
+    def remove(self, entry):
+        """Remove an entry. Returns False if it wasn't there."""
+        with self._lock:
+            keys = self._keys.pop(entry, None)
+            if keys is None:
+                return False
+            address, port, uid = keys
+            by_port = self._by_address[address]
+            del by_port[port]
+            if not by_port:
+                del self._by_address[address]
+            if uid is not None:
+                del self._by_uid[uid]
+        self._notify(Registry.REMOVED, entry)
+        return True
+
+    def set_uid(self, entry, uid):
+        """Record the uid of the peer an entry stands for"""
+        with self._lock:
+            if entry not in self._keys:
+                return
+            self._set_uid(entry, uid)
+        self._notify(Registry.CHANGED, entry)
+
+    def _set_uid(self, entry, uid):
+        keys = self._keys[entry]
+        if keys[2] is not None:
+            del self._by_uid[keys[2]]
+        # a peer we were connected to before may still be listed under it
+        old = self._by_uid.get(uid)
+        if old is not None:
+            self._keys[old][2] = None
+        self._by_uid[uid] = entry
+        keys[2] = uid
+
+    def changed(self, entry):
+        """Tell listeners that something about an entry changed"""
+        if entry in self:
+            self._notify(Registry.CHANGED, entry)
+
+    def get(self, address, port = None):
+        """Return the entry for the given address and port, or None.
+
+        If no port is given, return the entry for the address without a
+        port, or else any entry for the address.
+
+        """
+        with self._lock:
+            by_port = self._by_address.get(address)
+            if not by_port:
+                return None
+            if port is not None or None in by_port:
+                return by_port.get(port)
+            return next(by_port.itervalues())
+
+    def get_all(self, address):
+        """Return a list of the entries for the given address"""
+        with self._lock:
+            return self._by_address.get(address, {}).values()
+
+    def get_by_uid(self, uid):
+        with self._lock:
+            return self._by_uid.get(uid)
+
+    def entries(self):
+        """Return a list of all the entries"""
+        with self._lock:
+            return self._keys.keys()
+
+    def __contains__(self, entry):
+        with self._lock:
+            return entry in self._keys
+
+    def __len__(self):
+        with self._lock:
+            return len(self._keys)
+
+    def subscribe(self, callback):
+        """Call callback(event, entry) after every change, where event is
+        ADDED, CHANGED or REMOVED"""
+        with self._lock:
+            self._listeners.append(callback)
+
+    def _notify(self, event, entry):
+        with self._lock:
+            listeners = list(self._listeners)
+        for callback in listeners:
+            callback(event, entry)
@@ -0,0 +1,153 @@
+"""
+    Cross-platform clipboard syncing tool
+    Copyright (C) 2013  Syncboard
+
+    This program is free software; you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation; either version 2 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License along
+    with this program; if not, write to the Free Software Foundation, Inc.,
+    51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+"""
+
+"""
+    Host name resolution off the GUI and network threads.
+
+    Looking up a name can block for seconds when the resolver is slow, so
+    lookups run in a small pool of worker threads and their results are
+    cached: successful ones for TTL seconds, failures for NEGATIVE_TTL
+    seconds, so a mistyped name isn't looked up over and over.
+"""
+
+from socket import gethostbyname, inet_aton, error, timeout
+from threading import Thread, Lock, Event
+from Queue import Queue
+import time
+
+# how long to remember an address. gethostbyname doesn't tell us the real
+# TTL of the record, so this is a compromise.
+TTL = 300.0
+# how long to remember that a name could not be resolved
+NEGATIVE_TTL = 30.0
+# the most lookups that run at the same time
+WORKERS = 4
+
+class Resolver:
+    """Resolves host names to IPv4 addresses in canonical form, without
+    blocking the caller.
+
+    Threadsafe.
+
+    """
+
+    def __init__(self, workers = WORKERS, ttl = TTL,
+                 negative_ttl = NEGATIVE_TTL, lookup = gethostbyname):
+        """lookup is the blocking function that does the actual work"""
+        self._max_workers = workers
+        self._ttl = ttl
+        self._negative_ttl = negative_ttl
+        self._lookup = lookup
+
+        self._lock = Lock()
+        # name -> (address, error, expiry time)
+        self._cache = {}
+        # name -> callbacks waiting for a lookup in progress
+        self._pending = {}
+        # names to be looked up by the workers
+        self._queue = Queue()
+        self._workers = []
+
+    def resolve(self, name, callback):
+        """Resolve name, and call callback(address, error) with the result;
+        one of them is None.
+
+        Cached results and names that are already addresses are passed to
+        the callback right away, in this thread. Otherwise it is called from
+        a worker thread once the lookup is done. Concurrent requests for the
+        same name share a single lookup.
+
+        """
+        address = _literal(name)
+        if address:
+            callback(address, None)
+            return
+        with self._lock:
+            entry = self._cache.get(name)
+            if entry and entry[2] > time.time():
+                hit = entry
+            else:
+                hit = None
+                if name in self._pending:
+                    self._pending[name].append(callback)
+                    return
+                self._pending[name] = [callback]
+                self._queue.put(name)
+                if len(self._workers) < self._max_workers:
+                    self._start_worker()
+        if hit:
+            callback(hit[0], hit[1])
+
+    def resolve_wait(self, name, wait = None):
+        """Resolve name, blocking until the result is in. Raises the error the
+        lookup failed with, or socket.timeout after wait seconds."""
+        done = Event()
+        result = []
+        def finished(address, err):
+            result.append((address, err))
+            done.set()
+        self.resolve(name, finished)
+        if not done.wait(wait):
+            raise timeout('timed out resolving %s' % name)
+        address, err = result[0]
+        if err:
+            raise err
+        return address
+
+    def cached(self, name):
+        """Return the address name resolved to, if we know it, or None"""
+        address = _literal(name)
+        if address:
+            return address
+        with self._lock:
+            entry = self._cache.get(name)
+            if entry and entry[2] > time.time():
+                return entry[0]
+        return None
+
+    def _start_worker(self):
+        t = Thread(target=self._work)
+        t.daemon = True
+        self._workers.append(t)
+        t.start()
+
+    def _work(self):
+        while True:
+            name = self._queue.get()
+            try:
+                address, err = self._lookup(name), None
+                expiry = time.time() + self._ttl
+            except error as e:
+                address, err = None, e
+                expiry = time.time() + self._negative_ttl
+            with self._lock:
+                self._cache[name] = (address, err, expiry)
+                callbacks = self._pending.pop(name)
+            for callback in callbacks:
+                callback(address, err)
+
+def _literal(name):
+    """Return name if it is already a dotted quad IPv4 address"""
+    try:
+        inet_aton(name)
+    except (error, TypeError):
+        return None
+    if name.count('.') == 3:
+        return name
+    return None
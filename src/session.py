@@ -23,13 +23,63 @@
     functionality.
 """
 
+from socket import error
+import control
+from clipitem import ClipboardItem
 from connections import ConnectionManager, Connection
-from network import Network
+from history import History
+from network import Network, Peer, DEFAULT_PORT
+from resolver import Resolver
+from state import StateFile
+
+# Connection status for each network.Peer status
+PEER_STATUS = {
+    Peer.CONNECTING: Connection.PENDING,
+    Peer.CONNECTED: Connection.CONNECTED,
+    Peer.WAITING: Connection.NOT_CONNECTED,
+}
 
 class Session:
-    def __init__(self):
-        # TODO: consider saving and loading the connections list to a file
-        #       to preserve the list between sessions
+    def __init__(self, progress_callback=None, relay=False,
+                 status_callback=None, announce=False, prefetch_size=0,
+                 clipboard_callback=None, state_path=None,
+                 port=DEFAULT_PORT, control_path=None):
+        """
+            progress_callback, if given, is called with a
+            network.TransferProgress as large clipboards are sent and
+            received. It is called from the network thread.
+
+            If relay is True, clipboards received from one connection are
+            passed on to others, so that more than two computers can share
+            a clipboard without all being connected to each other.
+
+            status_callback, if given, is called with an address and its
+            new Connection status whenever that changes as the network
+            connects to the address, loses it, and reconnects. It is called
+            from the network thread.
+
+            If announce is True, clipboards set here are only announced to
+            the other computers, which fetch them from this one when
+            get_clipboard_data is called there. Announced clipboards up to
+            prefetch_size bytes are fetched straight away.
+
+            clipboard_callback, if given, is called with the new
+            clipitem.ClipboardItem whenever another computer changes the
+            shared clipboard. It is called from the network thread.
+
+            If state_path is given, the connections and the clipboard are
+            saved to that file whenever they change, and loaded from it
+            here. Every saved connection is then reconnected to at once,
+            and peers that still hold the saved clipboard aren't sent it
+            again.
+
+            The network listens on the given port, and other computers are
+            expected to listen on the same one.
+
+            If control_path is given, scripts can set and read the shared
+            clipboard through a control.ControlServer on a Unix domain
+            socket there, where the platform has them.
+        """
         self._con_mgr = ConnectionManager()
 
         # The data on the common clipboard.
@@ -40,35 +90,127 @@ class Session:
         # None will mean that this client is owner, otherwise it should be a
         # Connection object.
         self._data_owner = None
-
-        # TODO add command line switch to change port, which would be passed in
-        # here
-        self._network = Network(con_callback=self._new_connection_request,
-                                dis_callback=self._disconnect_request)
+        self._status_callback = status_callback
+        self._clipboard_callback = clipboard_callback
+        # looks up addresses the user enters, without blocking the gui
+        self._resolver = Resolver()
+        # recent clipboards, from here and from other computers
+        self._history = History()
+        self._state = None
+        saved = None
+        if state_path:
+            self._state = StateFile(state_path, self._get_state)
+            saved = self._state.load()
+
+        self._port = port
+        self._network = Network(port=port,
+                                con_callback=self._new_connection_request,
+                                dis_callback=self._disconnect_request,
+                                progress_callback=progress_callback,
+                                relay=relay,
+                                status_callback=self._peer_status,
+                                resolver=self._resolver,
+                                announce=announce,
+                                prefetch_size=prefetch_size,
+                                clipboard_callback=self._shared_clipboard)
+        if saved:
+            self._restore(*saved)
         self._network.start()
+        # all at once; the network connects to them side by side
+        for conn in self._con_mgr.get_connections():
+            self._network.add_peer(conn.address, self._port)
+        if self._state:
+            self._con_mgr.subscribe(self._connections_changed)
+        self._control = None
+        if control_path and control.available():
+            try:
+                self._control = control.ControlServer(self, control_path)
+                self._control.start()
+            except (error, OSError) as e:
+                print "Not serving the control socket: %s" % e
+                self._control = None
+
+    def _restore(self, state, blobs):
+        try:
+            self._network.restore_state(state['network'], blobs)
+        except (KeyError, ValueError) as e:
+            print "Not restoring the clipboard: %s" % e
+        else:
+            self._history.add(self._network.get_clipboard_item(),
+                              local=False)
+        for alias, address in state.get('connections', []):
+            self._con_mgr.new_connection(alias, address, Connection.PENDING)
+
+    def _get_state(self):
+        network, blobs = self._network.get_state()
+        connections = sorted([c.alias, c.address]
+                             for c in self._con_mgr.get_connections())
+        return {'connections': connections, 'network': network}, blobs
+
+    def _connections_changed(self, event, conn):
+        self._state.changed()
+
+    def _state_changed(self):
+        if self._state:
+            self._state.changed()
 
     def _new_connection_request(self, address, port):
         conn = self._con_mgr.get_connection(address)
         if conn:
             #conn.status = Connection.REQUEST
-            conn.status = Connection.CONNECTED
+            self._set_status(address, Connection.CONNECTED)
         else:
             #self._con_mgr.new_connection("", address, Connection.REQUEST)
             self._con_mgr.new_connection("", address, Connection.CONNECTED)
 
+    def _shared_clipboard(self, item):
+        self._history.add(item, local=False)
+        self._state_changed()
+        if self._clipboard_callback:
+            self._clipboard_callback(item)
+
     def _disconnect_request(self, address, port):
-        conn = self._con_mgr.get_connection(address)
-        if conn:
-            conn.status = Connection.NOT_CONNECTED
+        self._set_status(address, Connection.NOT_CONNECTED)
+
+    def _peer_status(self, address, port, status):
+        self._set_status(address, PEER_STATUS[status])
+
+    def _set_status(self, address, status):
+        if self._con_mgr.set_status(address, status):
+            if self._status_callback:
+                self._status_callback(address, status)
 
-    def get_clipboard_data(self):
-        self._clipboard_data = self._network.get_clipboard()
+    def get_clipboard_data(self, data_type=None):
+        """
+            Returns the shared clipboard in the given format, or in its
+            preferred one. Formats that were too large to be sent with the
+            clipboard are fetched from the peer it came from, which can take
+            a while. Returns None if the clipboard doesn't have the format.
+        """
+        if data_type is None:
+            data_type = self._network.get_clipboard_data_type()
+        self._clipboard_data = self._network.get_clipboard(data_type)
         return self._clipboard_data
 
     def get_clipboard_data_type(self):
         self._data_type = self._network.get_clipboard_data_type()
         return self._data_type
 
+    def get_clipboard_item(self):
+        """
+            Returns the shared clipboard as a clipitem.ClipboardItem, without
+            fetching anything. A new item means the clipboard changed.
+        """
+        return self._network.get_clipboard_item()
+
+    def get_statistics(self):
+        """
+            Returns a dictionary of network traffic counters, including how
+            many clipboard bytes did not need to be sent because the peer
+            already had them.
+        """
+        return self._network.get_statistics()
+
     def get_clipboard_data_owner(self):
         return self._data_owner
 
@@ -76,16 +218,33 @@ class Session:
         """
             This is called (by the gui) when the user pastes to the app.
         """
-        self._clipboard_data = data
-        self._network.set_clipboard(self._clipboard_data)
-        self._data_type = data_type
+        self.set_clipboard_item(ClipboardItem(data, data_type))
+
+    def set_clipboard_item(self, item):
+        """
+            Like set_clipboard_data, for a clipitem.ClipboardItem holding the
+            data in several formats.
+        """
+        self._network.set_clipboard(item)
+        self._history.add(item)
+        self._state_changed()
+        self._data_type = item.data_type()
+        self._clipboard_data = None
         self._data_owner = None
 
     def connections(self):
         """
             Returns a list of all the connections
         """
-        return self._con_mgr.connections
+        return self._con_mgr.get_connections()
+
+    def subscribe_connections(self, callback):
+        """
+            Calls callback(event, connection) whenever a Connection is
+            added, removed or changes, where event is one of the
+            registry.Registry constants. It may be called from any thread.
+        """
+        self._con_mgr.subscribe(callback)
 
     def get_connection(self, address):
         """
@@ -104,9 +263,23 @@ class Session:
             New Connection on both ends.
             Connection on this end status: PENDING
             Conneciton on other end status: REQUEST
+
+            The network keeps trying to connect in the background, and
+            reconnects whenever the connection is lost, until the
+            connection is cancelled, disconnected or deleted. Its status
+            follows along.
+
+            The address is resolved in the background, and the Connection
+            only appears once that has succeeded.
         """
-        self._network.connect(address)
-        self._con_mgr.new_connection(alias, address)
+        def resolved(host, err):
+            if err:
+                print "Error: could not resolve %s: %s" % (address, err)
+                return
+            if not self._con_mgr.get_connection(host):
+                self._con_mgr.new_connection(alias, host, Connection.PENDING)
+            self._network.add_peer(host, self._port)
+        self._resolver.resolve(address, resolved)
 
     def accept_connection(self, address):
         """
@@ -125,7 +298,7 @@ class Session:
         conn = self.get_connection(address)
         if conn:
             print "Connection from %s accepted" % address
-            conn.status = Connection.CONNECTED
+            self._set_status(address, Connection.CONNECTED)
         else:
             print "Error: no connection from %s exists" % address
 
@@ -142,12 +315,11 @@ class Session:
             Connection on this end status: PENDING
             Conneciton on other end status: REQUEST
         """
-        self._network.connect(address)
         conn = self.get_connection(address)
         if conn:
             print "Request to connect to %s sent" % address
-            #conn.status = Connection.PENDING
-            conn.status = Connection.CONNECTED
+            self._set_status(address, Connection.PENDING)
+            self._network.add_peer(address, self._port)
         else:
             print "Error: no connection to %s exists" % address
 
@@ -164,11 +336,12 @@ class Session:
             Connection on this end status: NOT_CONNECTED
             Conneciton on other end status: NOT_CONNECTED
         """
+        self._network.remove_peer(address, self._port)
         self._network.disconnect(address)
         conn = self.get_connection(address)
         if conn:
             print "Disconnected from %s" % address
-            conn.status = Connection.NOT_CONNECTED
+            self._set_status(address, Connection.NOT_CONNECTED)
         else:
             print "Error: no connection to %s exists" % address    
 
@@ -186,10 +359,11 @@ class Session:
             Connection on this end status: NOT_CONNECTED
             Conneciton on other end status: NOT_CONNECTED
         """
+        self._network.remove_peer(address, self._port)
         conn = self.get_connection(address)
         if conn:
             print "Request to %s canceled" % address
-            conn.status = Connection.NOT_CONNECTED
+            self._set_status(address, Connection.NOT_CONNECTED)
         else:
             print "Error: no connection to %s exists" % address
 
@@ -202,6 +376,9 @@ class Session:
         if conn:
             if conn.status == Connection.CONNECTED:
                 self.disconnect(address)
+            else:
+                # stop trying to reconnect
+                self._network.remove_peer(address, self._port)
             self._con_mgr.del_connection(address)
         else:
             print "Error: no connection to %s exists" % address
@@ -214,9 +391,27 @@ class Session:
         conn = self.get_connection(address)
         if conn:
             print "Updated alias of %s to %s" % (address, new_alias)
-            conn.alias = new_alias
+            self._con_mgr.set_alias(address, new_alias)
         else:
             print "Error: no connection to %s exists" % address
 
+    def get_history(self):
+        """
+            Returns a list of history.HistoryEntry objects for the recent
+            clipboards, newest first.
+        """
+        return self._history.entries()
+
+    def restore_history(self, entry):
+        """
+            Sets the shared clipboard back to a HistoryEntry.
+        """
+        self.set_clipboard_item(entry.item())
+
     def close(self):
+        if self._control:
+            self._control.stop()
         self._network.stop()
+        if self._state:
+            self._state.close()
+        self._history.close()
@@ -0,0 +1,197 @@
+"""
+    Cross-platform clipboard syncing tool
+    Copyright (C) 2013  Syncboard
+
+    This program is free software; you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation; either version 2 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License along
+    with this program; if not, write to the Free Software Foundation, Inc.,
+    51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+"""
+
+"""
+    Saving what a Session knows between runs.
+
+    The connections, and the clipboard along with the clocks that order it,
+    are kept in one small file, so that a restarted Session reconnects to
+    the same peers and doesn't need them to resend a clipboard it already
+    holds. The file is replaced atomically and carries a checksum, so a
+    crash while it is written leaves the previous one in place, and a
+    damaged one is ignored rather than loaded.
+"""
+
+from threading import Thread, Lock, Event
+import hashlib
+import json
+import os
+import struct
+import sys
+import tempfile
+import zlib
+
+# the file starts with a magic string, the length of the JSON state that
+# follows and the CRC-32 of everything after the header. The binary blobs
+# the state refers to by index come after the JSON.
+MAGIC = 'SBS1'
+STATE_HEADER = struct.Struct('!4sIi')
+BLOB_HEADER = struct.Struct('!I')
+# changes are saved this many seconds after the first one, so a burst of
+# them is written once
+SAVE_DELAY = 1.0
+
+def default_path():
+    """Return where the state is kept for the current user"""
+    if sys.platform == 'win32' and os.environ.get('APPDATA'):
+        base = os.path.join(os.environ['APPDATA'], 'Syncboard')
+    else:
+        base = os.path.join(os.path.expanduser('~'), '.syncboard')
+    return os.path.join(base, 'state')
+
+def encode(state, blobs = ()):
+    """Return the file contents for a JSON-serializable state and a list of
+    binary strings"""
+    body = json.dumps(state, separators=(',', ':'), sort_keys=True)
+    parts = [body]
+    for blob in blobs:
+        parts.append(BLOB_HEADER.pack(len(blob)))
+        parts.append(blob)
+    rest = ''.join(parts)
+    return STATE_HEADER.pack(MAGIC, len(body), zlib.crc32(rest)) + rest
+
+def decode(data):
+    """Return the (state, blobs) in file contents. Raises ValueError if they
+    are damaged."""
+    if len(data) < STATE_HEADER.size:
+        raise ValueError('state file is truncated')
+    magic, length, crc = STATE_HEADER.unpack_from(data)
+    if magic != MAGIC:
+        raise ValueError('not a state file')
+    rest = buffer(data, STATE_HEADER.size)
+    if zlib.crc32(rest) != crc:
+        raise ValueError('state file is damaged')
+    offset = STATE_HEADER.size + length
+    state = json.loads(data[STATE_HEADER.size:offset])
+    blobs = []
+    while offset < len(data):
+        if offset + BLOB_HEADER.size > len(data):
+            raise ValueError('state file is truncated')
+        size, = BLOB_HEADER.unpack_from(data, offset)
+        offset += BLOB_HEADER.size
+        if offset + size > len(data):
+            raise ValueError('state file is truncated')
+        blobs.append(data[offset:offset + size])
+        offset += size
+    return state, blobs
+
+class StateFile:
+    """A file holding a state, rewritten only when it changes.
+
+    If get_state is given, changed() arranges for it to be called, and what
+    it returns saved, SAVE_DELAY seconds later in a thread of its own.
+    close() saves any change that is still waiting.
+
+    Threadsafe.
+
+    """
+
+    def __init__(self, path, get_state = None, delay = SAVE_DELAY):
+        self._path = path
+        self._get_state = get_state
+        self._delay = delay
+        self._lock = Lock()
+        # digest of what the file holds, as far as we know
+        self._written = None
+        self._dirty = Event()
+        self._stop = Event()
+        self._thread = None
+
+    def load(self):
+        """Return the (state, blobs) saved in the file, or None if there is
+        none or it is damaged"""
+        try:
+            with open(self._path, 'rb') as f:
+                data = f.read()
+        except IOError:
+            return None
+        try:
+            state, blobs = decode(data)
+        except ValueError as e:
+            print "Ignoring %s: %s" % (self._path, e)
+            return None
+        with self._lock:
+            self._written = hashlib.sha256(data).digest()
+        return state, blobs
+
+    def save(self, state, blobs = ()):
+        """Write a state to the file, unless it holds that already. Returns
+        whether the file was written."""
+        data = encode(state, blobs)
+        digest = hashlib.sha256(data).digest()
+        with self._lock:
+            if digest == self._written:
+                return False
+            directory = os.path.dirname(self._path) or '.'
+            if not os.path.isdir(directory):
+                os.makedirs(directory)
+            # written and synced under another name, so that the file is
+            # always either the old state or the new one
+            fd, tmp = tempfile.mkstemp(dir=directory, prefix='.state-')
+            try:
+                with os.fdopen(fd, 'wb') as f:
+                    f.write(data)
+                    f.flush()
+                    os.fsync(f.fileno())
+                if sys.platform == 'win32' and os.path.exists(self._path):
+                    # rename doesn't replace files there
+                    os.remove(self._path)
+                os.rename(tmp, self._path)
+            except (IOError, OSError):
+                if os.path.exists(tmp):
+                    os.remove(tmp)
+                raise
+            self._written = digest
+        return True
+
+    def changed(self):
+        """Save the state from get_state soon"""
+        with self._lock:
+            if self._stop.is_set():
+                return
+            if self._thread is None:
+                self._thread = Thread(target=self._run)
+                self._thread.daemon = True
+                self._thread.start()
+        self._dirty.set()
+
+    def close(self):
+        """Save a change that is still waiting, and stop the thread"""
+        with self._lock:
+            self._stop.set()
+            thread = self._thread
+        if thread:
+            self._dirty.set()
+            thread.join()
+
+    def _run(self):
+        while True:
+            self._dirty.wait()
+            # let a burst of changes settle, unless we are closing
+            self._stop.wait(self._delay)
+            self._dirty.clear()
+            self._flush()
+            if self._stop.is_set():
+                return
+
+    def _flush(self):
+        try:
+            self.save(*self._get_state())
+        except (IOError, OSError) as e:
+            print "Could not save %s: %s" % (self._path, e)
@@ -0,0 +1,88 @@
+"""
+    Cross-platform clipboard syncing tool
+    Copyright (C) 2013  Syncboard
+
+    This program is free software; you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation; either version 2 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License along
+    with this program; if not, write to the Free Software Foundation, Inc.,
+    51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+"""
+
+"""
+    Command line access to the shared clipboard of a running Syncboard,
+    through its control socket:
+
+        echo hello | python syncboard.py copy
+        python syncboard.py paste -t text/html > page.html
+        python syncboard.py status
+
+    Data is streamed between the socket and stdin or stdout. Nothing here
+    imports the network stack or wx, so each call takes milliseconds.
+"""
+
+import argparse
+import json
+import sys
+
+import control
+
+def main(argv = None):
+    parser = argparse.ArgumentParser(
+        prog='syncboard',
+        description='Use the shared clipboard of a running Syncboard.')
+    parser.add_argument('-s', '--socket', default=control.default_path(),
+                        help='control socket (default: %(default)s)')
+    commands = parser.add_subparsers(dest='command')
+    for name, text in (('copy', 'set the clipboard to stdin'),
+                       ('paste', 'write the clipboard to stdout')):
+        command = commands.add_parser(name, help=text)
+        command.add_argument('-t', '--type', default=control.DEFAULT_TYPE,
+                             help='format, as a MIME type '
+                             '(default: %(default)s)')
+    command = commands.add_parser('status', help='show the clipboard and '
+                                  'the connections')
+    command.add_argument('--json', action='store_true',
+                         help='print the status as JSON')
+    args = parser.parse_args(sys.argv[1:] if argv is None else argv)
+
+    try:
+        if args.command == 'copy':
+            control.copy(sys.stdin, args.type, args.socket)
+        elif args.command == 'paste':
+            control.paste(sys.stdout, args.type, args.socket)
+            sys.stdout.flush()
+        else:
+            print_status(control.status(args.socket), args.json)
+    except control.ControlError as e:
+        print >>sys.stderr, "syncboard: %s" % e
+        return 1
+    return 0
+
+def print_status(status, as_json = False):
+    if as_json:
+        print json.dumps(status, indent=2, sort_keys=True)
+        return
+    if status['clipboard']:
+        print "Clipboard:"
+        for name, size in status['clipboard']:
+            print "  %-14s %s" % (name, "?" if size is None else
+                                  "%d bytes" % size)
+    else:
+        print "Clipboard: empty"
+    print "Connections:"
+    for address, alias, state in status['connections']:
+        print "  %-15s %-20s %s" % (address, alias, state)
+    if not status['connections']:
+        print "  none"
+
+if __name__ == '__main__':
+    sys.exit(main())
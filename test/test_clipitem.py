@@ -0,0 +1,80 @@
+"""
+    Cross-platform clipboard syncing tool
+    Copyright (C) 2013  Syncboard
+
+    This program is free software; you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation; either version 2 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License along
+    with this program; if not, write to the Free Software Foundation, Inc.,
+    51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+"""
+
+import unittest
+
+import info
+from clipitem import ClipboardItem, INLINE_SIZE
+
+class TestClipboardItem(unittest.TestCase):
+    def test_round_trip(self):
+        item = ClipboardItem(u'caf\xe9')
+        item.add(info.HTML, '<b>cafe</b>')
+        decoded = ClipboardItem.decode(item.encode()[0])
+        self.assertEqual(decoded.data_types(), [info.TXT, info.HTML])
+        self.assertEqual(decoded.get(info.TXT), u'caf\xe9'.encode('utf-8'))
+        self.assertEqual(decoded.get(info.HTML), '<b>cafe</b>')
+
+    def test_large_left_out(self):
+        png = 'p' * (INLINE_SIZE + 1)
+        item = ClipboardItem()
+        item.add(info.PNG, png)
+        item.add(info.TXT, 't' * (INLINE_SIZE + 1))
+        payload, left_out = item.encode()
+        self.assertEqual(left_out, {info.PNG: png})
+        # text always goes along
+        self.assertTrue(len(payload) < 2 * INLINE_SIZE)
+
+        decoded = ClipboardItem.decode(payload)
+        self.assertFalse(decoded.available(info.PNG))
+        self.assertEqual(decoded.get(info.PNG), None)
+        self.assertEqual(decoded.size(info.PNG), len(png))
+        self.assertRaises(ValueError, decoded.set_data, info.PNG, 'x' * len(png))
+        decoded.set_data(info.PNG, png)
+        self.assertEqual(decoded.get(info.PNG), png)
+
+    def test_lazy_render(self):
+        calls = []
+        def render():
+            calls.append(1)
+            return 'image'
+        item = ClipboardItem()
+        item.add(info.PNG, render=render)
+        payload, left_out = item.encode()
+        self.assertEqual(calls, [])
+        self.assertEqual(left_out, {})
+        self.assertTrue(item.available(info.PNG))
+        self.assertEqual(item.get(info.PNG), 'image')
+        self.assertEqual(item.get(info.PNG), 'image')
+        self.assertEqual(calls, [1])
+
+        # unrendered items never look the same as each other
+        other = ClipboardItem()
+        other.add(info.PNG, render=render)
+        self.assertNotEqual(other.encode()[0], payload)
+
+    def test_unknown_format_skipped(self):
+        item = ClipboardItem('text')
+        payload = item.encode()[0].replace('text/plain', 'text/xxxxx')
+        self.assertEqual(ClipboardItem.decode(payload).data_types(), [])
+
+    def test_malformed(self):
+        payload = ClipboardItem('text').encode()[0]
+        for bad in ('', payload[:-1], payload + 'x', '\0\0\0\x02{}'):
+            self.assertRaises(ValueError, ClipboardItem.decode, bad)
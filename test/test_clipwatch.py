@@ -0,0 +1,47 @@
+"""
+    Cross-platform clipboard syncing tool
+    Copyright (C) 2013  Syncboard
+
+    This program is free software; you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation; either version 2 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License along
+    with this program; if not, write to the Free Software Foundation, Inc.,
+    51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+"""
+
+import os
+import unittest
+
+import clipwatch
+
+class TestClipwatch(unittest.TestCase):
+    def test_counter(self):
+        counts = iter([1, 1, 2])
+        w = clipwatch.CounterWatcher(counts.next)
+        self.assertEqual([w.sequence() for i in range(3)], [1, 1, 2])
+        self.assertFalse(w.event_driven)
+
+    def test_create(self):
+        w = clipwatch.create()
+        try:
+            self.assertTrue(isinstance(w, clipwatch.Watcher))
+            if w.event_driven:
+                self.assertEqual(w.sequence(), 0)
+        finally:
+            w.stop()
+
+    def test_no_display(self):
+        display = os.environ.pop('DISPLAY', None)
+        try:
+            self.assertRaises(OSError, clipwatch.XFixesWatcher)
+        finally:
+            if display is not None:
+                os.environ['DISPLAY'] = display
@@ -0,0 +1,95 @@
+"""
+    Cross-platform clipboard syncing tool
+    Copyright (C) 2013  Syncboard
+
+    This program is free software; you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation; either version 2 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License along
+    with this program; if not, write to the Free Software Foundation, Inc.,
+    51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+"""
+
+from cStringIO import StringIO
+import os
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import unittest
+
+import control
+import info
+from control import ControlError
+from session import Session
+
+IMPORT_SCRIPT = """
+import sys
+sys.path.insert(0, %r)
+import syncboard
+print ' '.join(m for m in ('network', 'session', 'wx') if m in sys.modules)
+"""
+
+@unittest.skipUnless(control.available(), 'no Unix domain sockets')
+class TestControl(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'control')
+        self.session = Session(port=random.randint(20000, 30000),
+                               control_path=self.path)
+
+    def tearDown(self):
+        self.session.close()
+        shutil.rmtree(self.directory)
+
+    def test_copy_paste(self):
+        data = ''.join(chr(random.getrandbits(8)) for i in xrange(300000))
+        control.copy(StringIO(data), 'image/png', self.path)
+        self.assertEqual(self.session.get_clipboard_data(info.PNG), data)
+
+        self.session.set_clipboard_data('from the session', info.TXT)
+        out = StringIO()
+        control.paste(out, path=self.path)
+        self.assertEqual(out.getvalue(), 'from the session')
+
+    def test_errors(self):
+        self.assertRaises(ControlError, control.paste, StringIO(),
+                          'text/html', self.path)
+        self.assertRaises(ControlError, control.copy, StringIO('x'),
+                          'text/unknown', self.path)
+        self.assertRaises(ControlError, control.status,
+                          self.path + '.missing')
+
+    def test_status(self):
+        self.session.set_clipboard_data('four', info.TXT)
+        status = control.status(self.path)
+        self.assertEqual(status['clipboard'], [['text/plain', 4]])
+        self.assertEqual(status['connections'], [])
+        self.assertTrue('bytes_sent' in status['statistics'])
+
+    def test_one_instance(self):
+        other = Session(port=random.randint(20000, 30000),
+                        control_path=self.path)
+        other.close()
+        # the first one still answers
+        control.status(self.path)
+        self.session.close()
+        self.assertFalse(os.path.exists(self.path))
+        self.session = Session(port=random.randint(20000, 30000),
+                               control_path=self.path)
+        control.status(self.path)
+
+    def test_client_imports(self):
+        src = os.path.dirname(os.path.abspath(control.__file__))
+        output = subprocess.check_output(
+            [sys.executable, '-c', IMPORT_SCRIPT % src], cwd=self.directory)
+        self.assertEqual(output.strip(), '')
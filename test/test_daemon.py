@@ -0,0 +1,104 @@
+"""
+    Cross-platform clipboard syncing tool
+    Copyright (C) 2013  Syncboard
+
+    This program is free software; you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation; either version 2 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License along
+    with this program; if not, write to the Free Software Foundation, Inc.,
+    51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+"""
+
+import os
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import unittest
+
+import control
+import daemon
+from daemon import Daemon, parse_args
+
+# the daemon has to start in well under this many seconds. Timings are
+# only checked against it loosely, as a loaded machine can be much slower.
+STARTUP_BUDGET = 0.1
+# startup is timed this many times, and the fastest has to be within the
+# budget, so a busy machine doesn't fail the test
+STARTUP_RUNS = 5
+
+IMPORT_SCRIPT = """
+import sys, time
+start = time.time()
+sys.path.insert(0, %r)
+import daemon
+print time.time() - start
+print ' '.join(m for m in ('wx', 'gui', 'clipwatch') if m in sys.modules)
+"""
+
+class TestDaemon(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_import_time(self):
+        # from elsewhere, so nothing is found relative to the working
+        # directory by accident
+        src = os.path.dirname(os.path.abspath(daemon.__file__))
+        times = []
+        for i in range(STARTUP_RUNS):
+            output = subprocess.check_output(
+                [sys.executable, '-c', IMPORT_SCRIPT % src],
+                cwd=self.directory)
+            elapsed, _, loaded = output.partition('\n')
+            # nothing that needs a display
+            self.assertEqual(loaded.strip(), '')
+            times.append(float(elapsed))
+        self.assertTrue(min(times) < STARTUP_BUDGET, times)
+
+    def test_start_time(self):
+        times = []
+        for i in range(STARTUP_RUNS):
+            start = time.time()
+            d = Daemon(port=random.randint(20000, 30000), peers=['127.0.0.1'])
+            d.start()
+            times.append(time.time() - start)
+            d.stop()
+            d.run()
+        self.assertTrue(min(times) < STARTUP_BUDGET, times)
+
+    def test_settings(self):
+        config = os.path.join(self.directory, 'syncboard.conf')
+        with open(config, 'w') as f:
+            f.write('[syncboard]\nport = 1234\npeers = a, b\nrelay = yes\n'
+                    'state = %s\n' % os.path.join(self.directory, 'state'))
+        settings = parse_args(['-c', config, '--port', '4321', 'c'])
+        self.assertEqual(settings, {
+            'port': 4321, 'peers': ['a', 'b', 'c'], 'relay': True,
+            'state_path': os.path.join(self.directory, 'state'),
+            'control_path': control.default_path()})
+        settings = parse_args(['-c', config + '.missing', '--no-state',
+                               '--no-control'])
+        self.assertEqual(settings, {'peers': [], 'state_path': None,
+                                    'control_path': None})
+
+        with open(config, 'w') as f:
+            f.write('[syncboard]\nport = many\n')
+        stderr = sys.stderr
+        sys.stderr = open(os.devnull, 'w')
+        try:
+            self.assertRaises(SystemExit, parse_args, ['-c', config])
+        finally:
+            sys.stderr = stderr
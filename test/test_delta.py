@@ -0,0 +1,71 @@
+"""
+    Cross-platform clipboard syncing tool
+    Copyright (C) 2013  Syncboard
+
+    This program is free software; you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation; either version 2 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License along
+    with this program; if not, write to the Free Software Foundation, Inc.,
+    51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+"""
+
+import random
+import unittest
+
+import delta
+
+class TestDelta(unittest.TestCase):
+    def setUp(self):
+        self.lines = ['%d %08x\n' % (i, random.getrandbits(32))
+                      for i in range(10000)]
+        self.base = ''.join(self.lines)
+
+    def check(self, target):
+        d = delta.make(self.base, target)
+        self.assertNotEqual(d, None)
+        self.assertTrue(len(d) < len(target))
+        self.assertEqual(delta.apply(self.base, d), target)
+        self.assertEqual(delta.apply(self.base, memoryview(d)), target)
+        return d
+
+    def test_append(self):
+        self.check(self.base + 'appended')
+
+    def test_prepend(self):
+        self.check('prepended' + self.base)
+
+    def test_scattered_edits(self):
+        lines = list(self.lines)
+        for i in (10, 2000, 2001, 7000):
+            lines[i] = 'edited %d\n' % i
+        del lines[5000:5100]
+        lines.insert(9000, 'inserted\n')
+        d = self.check(''.join(lines))
+        self.assertTrue(len(d) < 500)
+
+    def test_binary(self):
+        base = ''.join(chr(random.getrandbits(8)) for i in range(10000))
+        target = base[:3000] + 'x' + base[3001:]
+        d = delta.make(base, target)
+        self.assertEqual(delta.apply(base, d), target)
+
+    def test_unrelated(self):
+        self.assertEqual(delta.make(self.base, 'something else'), None)
+
+    def test_malformed(self):
+        d = delta.make(self.base, self.base + 'appended')
+        for bad in (d[:-1], d[:2], d + 'C', 'X' + d[1:]):
+            self.assertRaises(ValueError, delta.apply, self.base, bad)
+        # copying from past the end of the base
+        self.assertRaises(ValueError, delta.apply, 'short', d)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,179 @@
+"""
+    Cross-platform clipboard syncing tool
+    Copyright (C) 2013  Syncboard
+
+    This program is free software; you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation; either version 2 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License along
+    with this program; if not, write to the Free Software Foundation, Inc.,
+    51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+"""
+
+import os
+import tempfile
+import shutil
+import time
+import unittest
+
+import info
+from clipitem import ClipboardItem
+from history import History
+
+class TestHistory(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.history = History(max_items=3, max_bytes=1000, spill_size=100,
+                               directory=self.directory)
+
+    def tearDown(self):
+        self.history.close()
+        shutil.rmtree(self.directory)
+
+    def test_ring(self):
+        for i in range(5):
+            self.history.add(ClipboardItem('copy %d' % i))
+        entries = self.history.entries()
+        self.assertEqual([e.get(info.TXT) for e in entries],
+                         ['copy 4', 'copy 3', 'copy 2'])
+        self.assertEqual(self.history.memory(), 18)
+
+    def test_repeat_ignored(self):
+        self.assertNotEqual(self.history.add(ClipboardItem('a')), None)
+        self.assertEqual(self.history.add(ClipboardItem('a')), None)
+        self.history.add(ClipboardItem('b'))
+        self.history.add(ClipboardItem('a'))
+        self.assertEqual(len(self.history), 3)
+
+    def test_memory_bound(self):
+        for i in range(3):
+            self.history.add(ClipboardItem('%d' % i * 90))
+        self.history.add(ClipboardItem('x' * 100))
+        self.assertTrue(self.history.memory() <= 1000)
+        self.history = History(max_bytes=150, spill_size=100,
+                               directory=self.directory)
+        self.history.add(ClipboardItem('a' * 90))
+        self.history.add(ClipboardItem('b' * 90))
+        self.assertEqual([e.get(info.TXT) for e in self.history.entries()],
+                         ['b' * 90])
+
+    def test_spill(self):
+        png = 'p' * 1000
+        item = ClipboardItem()
+        item.add(info.PNG, png)
+        item.add(info.TXT, 'small')
+        entry = self.history.add(item)
+        self.assertEqual(self.history.memory(), 5)
+        self.assertEqual(len(os.listdir(self.directory)), 1)
+        self.assertEqual(entry.get(info.PNG)[:], png)
+        restored = entry.item()
+        self.assertEqual(restored.data_types(), [info.PNG, info.TXT])
+        self.assertEqual(restored.get(info.PNG), png)
+
+        # the same image again is stored once, and removed with the last
+        # entry that refers to it
+        self.history.add(ClipboardItem('between'))
+        self.history.add(item)
+        self.assertEqual(len(os.listdir(self.directory)), 1)
+        for i in range(3):
+            self.history.add(ClipboardItem('later %d' % i))
+        self.assertEqual(os.listdir(self.directory), [])
+
+    def test_lazy_render(self):
+        rendered = []
+        def render():
+            rendered.append(True)
+            return 'p' * 1000
+        item = ClipboardItem()
+        item.add(info.PNG, render=render)
+        item.add(info.TXT, 'screenshot')
+        entry = self.history.add(item)
+        self.assertEqual(rendered, [])
+        self.assertEqual(entry.data_types(), [info.PNG, info.TXT])
+        self.assertEqual(self.history.add(item), None)
+        self.assertEqual(rendered, [])
+
+        restored = entry.item()
+        self.assertEqual(restored.get(info.PNG), 'p' * 1000)
+        self.assertEqual(entry.get(info.PNG)[:], 'p' * 1000)
+        self.assertEqual(rendered, [True])
+        # once rendered it is spilled like any other large representation,
+        # and the item is let go of
+        self.assertEqual(entry.size, 1010)
+        self.assertEqual(len(os.listdir(self.directory)), 1)
+        self.assertEqual(entry._source, None)
+
+    def test_rendered_counted(self):
+        item = ClipboardItem()
+        item.add(info.HTML, render=lambda: 'h' * 90)
+        self.history.add(item)
+        self.assertEqual(self.history.memory(), 0)
+        # rendered for a peer, rather than through the history
+        item.get(info.HTML)
+        self.history.add(ClipboardItem('next'))
+        self.assertEqual(self.history.memory(), 94)
+
+    def test_old_items_rendered(self):
+        rendered = []
+        def render():
+            rendered.append(True)
+            return 'p' * 50
+        history = History(max_items=10, unrendered_items=1,
+                          directory=self.directory)
+        item = ClipboardItem()
+        item.add(info.PNG, render=render)
+        entry = history.add(item)
+        self.assertTrue(entry._source is item)
+        history.add(ClipboardItem('next'))
+        self.assertEqual(rendered, [])
+        newer = ClipboardItem()
+        newer.add(info.PNG, render=lambda: 'q' * 50)
+        history.add(newer)
+        # an item is only held on to while its entry is among the newest
+        for i in range(100):
+            if entry._source is None:
+                break
+            time.sleep(0.01)
+        self.assertEqual(entry._source, None)
+        self.assertEqual(rendered, [True])
+        self.assertEqual(entry.get(info.PNG), 'p' * 50)
+        self.assertEqual(history.memory(), 50 + 4)
+        history.close()
+
+    def test_mapped_once(self):
+        item = ClipboardItem()
+        item.add(info.PNG, 'p' * 1000)
+        entry = self.history.add(item)
+        self.assertTrue(entry.get(info.PNG) is entry.get(info.PNG))
+
+    def test_dropped_blob(self):
+        item = ClipboardItem()
+        item.add(info.PNG, 'p' * 1000)
+        entry = self.history.add(item)
+        for i in range(3):
+            self.history.add(ClipboardItem('later %d' % i))
+        self.assertEqual(entry.get(info.PNG), None)
+        self.assertEqual(entry.item().data_types(), [])
+
+    def test_unfetched_skipped(self):
+        item = ClipboardItem()
+        item.add(info.PNG, 'p' * 100000)
+        item.add(info.TXT, 'text')
+        received = ClipboardItem.decode(item.encode()[0])
+        entry = self.history.add(received)
+        self.assertEqual(entry.data_types(), [info.TXT])
+
+    def test_temporary_store(self):
+        history = History(spill_size=10)
+        history.add(ClipboardItem('x' * 100))
+        directory = history._store._directory
+        self.assertTrue(os.path.isdir(directory))
+        history.close()
+        self.assertFalse(os.path.exists(directory))
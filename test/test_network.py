@@ -18,10 +18,17 @@
 """
 
 import random
+import socket
+import threading
 import time
 import unittest
 
-from network import Network
+import delta
+import info
+import network
+from clipitem import ClipboardItem, INLINE_SIZE
+from network import Network, Message, MessageParser, ProtocolError, \
+    Connection, TransferProgress, ContentCache, Peer, READ_BUDGET
 
 WAIT_TIME = 0.1
 
@@ -55,6 +62,155 @@ class TestSimple(unittest.TestCase):
 
         self.assertEqual(self.n2.get_clipboard(), m2)
 
+    def test_latency(self):
+        # sends are handed to the connection thread without waiting for a
+        # poll timeout. With a long heartbeat the loop has nothing to wake up
+        # for on its own, so only the wakeup pipe can get the clipboard out.
+        port = random.randint(20000, 30000)
+        n3 = Network(port, heartbeat_interval = 60)
+        n3.start()
+        try:
+            time.sleep(WAIT_TIME)
+            self.n1.connect('localhost', port)
+            time.sleep(WAIT_TIME)
+            best = None
+            for i in range(3):
+                m = 'fast %d' % i
+                start = time.time()
+                n3.set_clipboard(m)
+                while self.n1.get_clipboard() != m:
+                    self.assertTrue(time.time() - start < 5)
+                    time.sleep(0.001)
+                elapsed = time.time() - start
+                best = elapsed if best is None else min(best, elapsed)
+            self.assertTrue(best < 0.5)
+        finally:
+            n3.stop()
+
+    def test_dedup(self):
+        m = 'x' * 100000
+        self.n2.set_clipboard(m)
+        time.sleep(WAIT_TIME)
+        self.assertEqual(self.n1.get_clipboard(), m)
+
+        self.n2.set_clipboard('other')
+        time.sleep(WAIT_TIME)
+        # n2 sent the content, so n1 only has to refer to it
+        self.n1.set_clipboard(m)
+        time.sleep(WAIT_TIME)
+        self.assertEqual(self.n2.get_clipboard(), m)
+        self.assertTrue(self.n1.get_statistics()['bytes_saved'] >= len(m))
+        self.assertTrue(self.n1.get_statistics()['bytes_sent'] < len(m))
+
+    def test_dedup_evicted(self):
+        m = 'y' * 1000
+        self.n2.set_clipboard(m)
+        time.sleep(WAIT_TIME)
+        self.n2.set_clipboard('other')
+        time.sleep(WAIT_TIME)
+
+        # n2 forgot the content, so it asks for it when n1 refers to it
+        self.n2._content = ContentCache()
+        self.n1.set_clipboard(m)
+        time.sleep(WAIT_TIME)
+        self.assertEqual(self.n2.get_clipboard(), m)
+
+    def test_delta(self):
+        lines = ['line %d %08x\n' % (i, random.getrandbits(32))
+                 for i in range(20000)]
+        m = ''.join(lines)
+        self.n2.set_clipboard(m)
+        time.sleep(WAIT_TIME)
+        self.assertEqual(self.n1.get_clipboard(), m)
+
+        sent = self.n2.get_statistics()['bytes_sent']
+        lines[5000] = 'changed\n'
+        m = ''.join(lines)
+        self.n2.set_clipboard(m)
+        time.sleep(WAIT_TIME)
+        self.assertEqual(self.n1.get_clipboard(), m)
+        self.assertTrue(self.n2.get_statistics()['bytes_sent'] - sent < 1000)
+
+    def test_delta_chunk_boundary(self):
+        # a delta that is just too large to go out as a single frame, once
+        # the base digest is in front of it, is sent as a whole clipboard
+        lines = ['line %d %08x\n' % (i, random.getrandbits(32))
+                 for i in range(20000)]
+        m = ''.join(lines)
+        base = ClipboardItem(m).encode()[0]
+        target_size = network.CHUNK_SIZE - network.DIGEST_SIZE + 1
+        length = target_size
+        for i in range(10):
+            lines[5000] = 'x' * length + '\n'
+            d = delta.make(base, ClipboardItem(''.join(lines)).encode()[0])
+            if len(d) == target_size:
+                break
+            length += target_size - len(d)
+        self.assertEqual(len(d), target_size)
+
+        self.n2.set_clipboard(m)
+        time.sleep(WAIT_TIME)
+        self.n2.set_clipboard(''.join(lines))
+        time.sleep(WAIT_TIME)
+        self.assertEqual(self.n1.get_clipboard(), ''.join(lines))
+
+    def _wait_for(self, n, m):
+        start = time.time()
+        while n.get_clipboard(wait = 0) != m:
+            self.assertTrue(time.time() - start < 10)
+            time.sleep(WAIT_TIME)
+
+    def test_delta_large(self):
+        # large clipboards are diffed by set_clipboard, so the network thread
+        # can send a delta without holding up other connections
+        lines = ['line %d %08x\n' % (i, random.getrandbits(32))
+                 for i in range(150000)]
+        self.n2.set_clipboard(''.join(lines))
+        self._wait_for(self.n1, ''.join(lines))
+
+        sent = self.n2.get_statistics()['bytes_sent']
+        lines[5000] = 'changed\n'
+        lines[100000] = 'changed\n'
+        self.n2.set_clipboard(''.join(lines))
+        base = self.n1._message.get_digest()
+        self.assertTrue(self.n2._message.known_delta(base) is not None)
+        self._wait_for(self.n1, ''.join(lines))
+        self.assertTrue(self.n2.get_statistics()['bytes_sent'] - sent < 1000)
+
+    def test_delta_base_evicted(self):
+        m = 'z%d\n' * 5000 % tuple(range(5000))
+        self.n2.set_clipboard(m)
+        time.sleep(WAIT_TIME)
+
+        # n1 forgot the base, so it asks for the whole clipboard
+        self.n1._content = ContentCache()
+        m += 'more'
+        self.n2.set_clipboard(m)
+        time.sleep(WAIT_TIME)
+        self.assertEqual(self.n1.get_clipboard(), m)
+
+    def test_concurrent_copies(self):
+        # both copy before hearing of the other's copy
+        self.n1.set_clipboard('from 1')
+        self.n2.set_clipboard('from 2')
+        time.sleep(WAIT_TIME)
+        self.assertEqual(self.n1.get_clipboard(), self.n2.get_clipboard())
+
+    def test_older_ignored(self):
+        self.n2.set_clipboard('new')
+        time.sleep(WAIT_TIME)
+        self.assertEqual(self.n1.get_clipboard(), 'new')
+
+        # a clipboard set before that arrives late
+        m = Message(self.n2._uid, 'old')
+        self.n1._process_message(m, None)
+        self.assertEqual(self.n1.get_clipboard(), 'new')
+
+        # copying afterwards wins, even though n1 has not copied before
+        self.n1.set_clipboard('newer')
+        time.sleep(WAIT_TIME)
+        self.assertEqual(self.n2.get_clipboard(), 'newer')
+
     def test_disconnect_from_client(self):
         self.n2.set_clipboard('test')
         time.sleep(WAIT_TIME)
@@ -93,6 +249,156 @@ class TestSimple(unittest.TestCase):
         time.sleep(WAIT_TIME)
         self.assertEqual(self.n2.get_clipboard(), 'asdf 5')
 
+    def test_registry(self):
+        registry = self.n1._connection_thread.registry
+        conn = registry.get_by_uid(self.n2._uid)
+        self.assertNotEqual(conn, None)
+        self.assertEqual(registry.get(*conn.get_peer_name()), conn)
+
+        self.n2.disconnect('localhost')
+        time.sleep(WAIT_TIME)
+        self.assertEqual(registry.get_by_uid(self.n2._uid), None)
+        self.assertEqual(len(registry), 0)
+
+    def test_reconnect_in_sync(self):
+        m = ''.join(chr(random.getrandbits(8)) for i in xrange(100000))
+        self.n2.set_clipboard(m)
+        time.sleep(WAIT_TIME)
+        self.n2.disconnect('localhost')
+        time.sleep(WAIT_TIME)
+
+        sent = [n.get_statistics()['bytes_sent'] for n in (self.n1, self.n2)]
+        self.n1.connect('localhost', self.port2)
+        time.sleep(WAIT_TIME)
+        # neither side is behind, so only the handshake goes over the wire
+        for n, before in zip((self.n1, self.n2), sent):
+            self.assertTrue(n.get_statistics()['bytes_sent'] - before < 1000)
+        self.assertEqual(self.n1.get_clipboard(), m)
+
+    def test_restart_in_sync(self):
+        m = ''.join(chr(random.getrandbits(8)) for i in xrange(100000))
+        item = ClipboardItem(m)
+        item.add(info.PNG, 'p' * (INLINE_SIZE + 1))
+        self.n2.set_clipboard(item)
+        time.sleep(WAIT_TIME)
+        state, blobs = self.n2.get_state()
+        self.n2.stop()
+        time.sleep(WAIT_TIME)
+
+        self.n2 = Network(self.port2)
+        self.n2.restore_state(state, blobs)
+        self.n2.start()
+        self.assertEqual(self.n2.get_clipboard(info.PNG, wait=0),
+                         'p' * (INLINE_SIZE + 1))
+        self.n2.connect('localhost', self.port1)
+        time.sleep(WAIT_TIME)
+        # the clipboard is still current on both sides, so it isn't resent
+        for n in (self.n1, self.n2):
+            self.assertTrue(n.get_statistics()['bytes_sent'] < 1000)
+        self.assertEqual(self.n1.get_clipboard(), m)
+
+        self.n2.set_clipboard('after the restart')
+        time.sleep(WAIT_TIME)
+        self.assertEqual(self.n1.get_clipboard(), 'after the restart')
+
+    def test_reconnect_stale(self):
+        self.n2.disconnect('localhost')
+        time.sleep(WAIT_TIME)
+        self.n2.set_clipboard('copied while apart')
+        time.sleep(WAIT_TIME)
+
+        # the side that connects is sent nothing, but sends its clipboard
+        self.n2.connect('localhost', self.port1)
+        time.sleep(WAIT_TIME)
+        self.assertEqual(self.n1.get_clipboard(), 'copied while apart')
+
+    def test_large_clipboard(self):
+        m = ''.join(chr(random.randint(0, 255)) for i in xrange(300000)) * 20
+        self.n2.set_clipboard(m)
+        time.sleep(WAIT_TIME * 5)
+
+        self.assertEqual(self.n1.get_clipboard(), m)
+
+    def test_clipboard_callback(self):
+        items = []
+        n3 = Network(self.port1 + 1, clipboard_callback=items.append)
+        n3.start()
+        try:
+            time.sleep(WAIT_TIME)
+            n3.connect('localhost', self.port2)
+            self.n2.set_clipboard('tell me')
+            time.sleep(WAIT_TIME)
+            self.assertEqual([i.get(info.TXT) for i in items], ['tell me'])
+            n3.set_clipboard('not me')
+            time.sleep(WAIT_TIME)
+            self.assertEqual(len(items), 1)
+        finally:
+            n3.stop()
+
+    def test_coalesced(self):
+        n3 = Network(self.port1 + 1)
+        for i in range(5):
+            n3.set_clipboard('copy %d' % i)
+        self.assertEqual(n3.get_statistics()['coalesced'], 4)
+        n3.start()
+        try:
+            n3.connect('localhost', self.port2)
+            time.sleep(WAIT_TIME)
+            self.assertEqual(self.n2.get_clipboard(), 'copy 4')
+        finally:
+            n3.stop()
+
+    def test_formats(self):
+        png = ''.join(chr(random.getrandbits(8)) for i in xrange(200000))
+        item = ClipboardItem()
+        item.add(info.PNG, png)
+        item.add(info.HTML, '<i>small</i>')
+        item.add(info.TXT, 'small')
+        sent = self.n2.get_statistics()['bytes_sent']
+        self.n2.set_clipboard(item)
+        time.sleep(WAIT_TIME)
+
+        # the image stays behind until it is pasted
+        self.assertTrue(self.n2.get_statistics()['bytes_sent'] - sent <
+                        INLINE_SIZE)
+        self.assertEqual(self.n1.get_clipboard_data_type(), info.PNG)
+        self.assertEqual(self.n1.get_clipboard(info.HTML), '<i>small</i>')
+        self.assertEqual(self.n1.get_clipboard(), 'small')
+        self.assertEqual(self.n1.get_clipboard(info.PNG, 0), None)
+        self.assertEqual(self.n1.get_clipboard(info.RTF), None)
+        self.assertEqual(self.n1.get_clipboard(info.PNG), png)
+        self.assertTrue(self.n2.get_statistics()['bytes_sent'] - sent >
+                        len(png))
+
+    def test_lazy_render(self):
+        calls = []
+        def render():
+            calls.append(threading.current_thread())
+            return 'rendered'
+        item = ClipboardItem()
+        item.add(info.PNG, render=render)
+        self.n2.set_clipboard(item)
+        time.sleep(WAIT_TIME)
+        self.assertEqual(calls, [])
+        self.assertEqual(self.n1.get_clipboard(info.PNG), 'rendered')
+        self.assertEqual(len(calls), 1)
+        # not in the network thread, where it would hold up every peer
+        self.assertTrue(calls[0] is not self.n2._connection_thread._thread)
+
+    def test_fetch_after_reconnect(self):
+        png = 'x' * (INLINE_SIZE * 2)
+        item = ClipboardItem()
+        item.add(info.PNG, png)
+        self.n2.set_clipboard(item)
+        time.sleep(WAIT_TIME)
+        self.n2.disconnect('localhost')
+        time.sleep(WAIT_TIME)
+        self.assertEqual(self.n1.get_clipboard(info.PNG, 0.5), None)
+
+        self.n1.connect('localhost', self.port2)
+        time.sleep(WAIT_TIME)
+        self.assertEqual(self.n1.get_clipboard(info.PNG), png)
+
     def tearDown(self):
         # give it enough time to execute before tearing down
         time.sleep(WAIT_TIME)
@@ -120,3 +426,542 @@ class TestConnect(unittest.TestCase):
 
         n1.stop()
         n2.stop()
+
+    def test_connect_refused(self):
+        n = Network(random.randint(20000, 30000))
+        n.start()
+        # nothing listens on this port
+        s = socket.socket()
+        s.bind(('localhost', 0))
+        port = s.getsockname()[1]
+        s.close()
+        self.assertRaises(socket.error, n.connect, 'localhost', port)
+        n.stop()
+
+    def test_single_thread(self):
+        before = threading.active_count()
+        n = Network(random.randint(20000, 30000))
+        n.start()
+        self.assertEqual(threading.active_count(), before + 1)
+        n.stop()
+
+class TestPeers(unittest.TestCase):
+    def setUp(self):
+        self.min_delay = network.RECONNECT_MIN_DELAY
+        network.RECONNECT_MIN_DELAY = 0.05
+        self.port1, self.port2 = random.sample(range(20000, 30000), 2)
+        self.statuses = []
+        self.n1 = Network(self.port1, status_callback=self.on_status)
+        self.n1.start()
+        self.n2 = None
+
+    def tearDown(self):
+        network.RECONNECT_MIN_DELAY = self.min_delay
+        self.n1.stop()
+        if self.n2:
+            self.n2.stop()
+
+    def on_status(self, address, port, status):
+        self.statuses.append(status)
+
+    def start_n2(self):
+        self.n2 = Network(self.port2)
+        self.n2.start()
+
+    def test_add_peer_returns_immediately(self):
+        start = time.time()
+        self.n1.add_peer('localhost', self.port2)
+        self.assertTrue(time.time() - start < WAIT_TIME)
+
+    def test_retry_until_up(self):
+        self.n1.add_peer('localhost', self.port2)
+        time.sleep(WAIT_TIME)
+        self.assertTrue(Peer.WAITING in self.statuses)
+        self.assertFalse(Peer.CONNECTED in self.statuses)
+
+        self.start_n2()
+        self.n2.set_clipboard('hello')
+        time.sleep(WAIT_TIME * 5)
+        self.assertEqual(self.statuses[-1], Peer.CONNECTED)
+        self.assertEqual(self.n1.get_clipboard(), 'hello')
+
+    def test_reconnect_after_drop(self):
+        self.start_n2()
+        self.n1.add_peer('localhost', self.port2)
+        time.sleep(WAIT_TIME)
+        self.assertEqual(self.statuses[-1], Peer.CONNECTED)
+
+        self.n2.stop()
+        time.sleep(WAIT_TIME)
+        self.assertNotEqual(self.statuses[-1], Peer.CONNECTED)
+
+        self.start_n2()
+        self.n2.set_clipboard('back')
+        time.sleep(WAIT_TIME * 5)
+        self.assertEqual(self.statuses[-1], Peer.CONNECTED)
+        self.assertEqual(self.n1.get_clipboard(), 'back')
+
+    def test_remove_peer(self):
+        self.n1.add_peer('localhost', self.port2)
+        time.sleep(WAIT_TIME)
+        self.n1.remove_peer('localhost', self.port2)
+        time.sleep(WAIT_TIME)
+        count = len(self.statuses)
+        time.sleep(WAIT_TIME * 3)
+        # no more attempts
+        self.assertEqual(len(self.statuses), count)
+
+    def test_backoff(self):
+        peer = Peer(('localhost', self.port2))
+        delays = [peer.next_delay() for i in range(20)]
+        self.assertTrue(delays[0] <= network.RECONNECT_MIN_DELAY)
+        self.assertTrue(delays[5] > delays[0])
+        self.assertTrue(max(delays) <= network.RECONNECT_MAX_DELAY)
+
+class TestHeartbeat(unittest.TestCase):
+    def setUp(self):
+        self.port1, self.port2 = random.sample(range(20000, 30000), 2)
+        self.dropped = []
+        self.n1 = Network(self.port1, dis_callback=self.on_disconnect,
+                          heartbeat_interval=0.05, heartbeat_misses=4)
+        self.n1.start()
+
+    def tearDown(self):
+        self.n1.stop()
+
+    def on_disconnect(self, address, port):
+        self.dropped.append((address, port))
+
+    def test_idle_peer_kept(self):
+        n2 = Network(self.port2, heartbeat_interval=0.05, heartbeat_misses=4)
+        n2.start()
+        n2.connect('localhost', self.port1)
+        # idle for many heartbeat intervals
+        time.sleep(WAIT_TIME * 5)
+        self.assertEqual(self.dropped, [])
+        n2.set_clipboard('still here')
+        time.sleep(WAIT_TIME)
+        self.assertEqual(self.n1.get_clipboard(), 'still here')
+        n2.stop()
+
+    def test_idle_without_peers(self):
+        # nothing to ping, so nothing wakes the network thread
+        timers = lambda: [t for t in self.n1._connection_thread._timers
+                          if not t.cancelled]
+        time.sleep(WAIT_TIME)
+        self.assertEqual(timers(), [])
+        n2 = Network(self.port2, heartbeat_interval=0.05, heartbeat_misses=4)
+        n2.start()
+        n2.connect('localhost', self.port1)
+        time.sleep(WAIT_TIME)
+        self.assertEqual(len(timers()), 1)
+        n2.stop()
+        time.sleep(WAIT_TIME)
+        self.assertEqual(timers(), [])
+
+    def test_silent_peer_dropped(self):
+        # a peer that says hello, then vanishes without closing the
+        # connection
+        listener = socket.socket()
+        listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        listener.bind(('localhost', self.port2))
+        listener.listen(1)
+        self.n1.connect('localhost', self.port2)
+        peer, _ = listener.accept()
+        hello = Message(1, '{"capabilities": ["ping"]}', Message.HELLO)
+        peer.sendall(hello.raw())
+
+        start = time.time()
+        while not self.dropped and time.time() - start < 2:
+            time.sleep(0.01)
+        self.assertEqual(len(self.dropped), 1)
+        self.assertTrue(time.time() - start < 0.5)
+        peer.close()
+        listener.close()
+
+class TestRelay(unittest.TestCase):
+    def setUp(self):
+        ports = random.sample(range(20000, 30000), 5)
+        self.nodes = [Network(port, relay=True) for port in ports]
+        for n in self.nodes:
+            n.start()
+        time.sleep(WAIT_TIME)
+        # a ring: every node only knows its two neighbours
+        for i, n in enumerate(self.nodes):
+            n.connect('localhost', ports[(i + 1) % len(ports)])
+        time.sleep(WAIT_TIME)
+
+    def tearDown(self):
+        for n in self.nodes:
+            n.stop()
+
+    def test_relay(self):
+        for i, n in enumerate(self.nodes):
+            m = 'from %d' % i
+            n.set_clipboard(m)
+            time.sleep(WAIT_TIME)
+            for other in self.nodes:
+                self.assertEqual(other.get_clipboard(), m)
+
+    def test_concurrent_copies(self):
+        for i, n in enumerate(self.nodes):
+            n.set_clipboard('from %d' % i)
+        time.sleep(WAIT_TIME * 2)
+        clipboards = set(n.get_clipboard() for n in self.nodes)
+        self.assertEqual(len(clipboards), 1)
+
+    def test_sent_once(self):
+        sent = [n.get_statistics()['bytes_sent'] for n in self.nodes]
+        m = ''.join(chr(random.getrandbits(8)) for i in range(100000))
+        self.nodes[0].set_clipboard(m)
+        time.sleep(WAIT_TIME * 3)
+        for n, before in zip(self.nodes, sent):
+            self.assertEqual(n.get_clipboard(), m)
+            # each node passes it on to at most its two neighbours, and copies
+            # coming back around the ring are only referred to by hash
+            self.assertTrue(n.get_statistics()['bytes_sent'] - before <
+                            2.1 * len(m))
+
+    def test_fetch_through_relays(self):
+        png = ''.join(chr(random.getrandbits(8)) for i in range(100000))
+        item = ClipboardItem()
+        item.add(info.PNG, png)
+        self.nodes[0].set_clipboard(item)
+        time.sleep(WAIT_TIME)
+        # two hops away from the node that copied it, either way round
+        self.assertEqual(self.nodes[2].get_clipboard(info.PNG), png)
+
+class TestRelayTopology(unittest.TestCase):
+    def start(self, count):
+        ports = random.sample(range(20000, 30000), count)
+        self.nodes = [Network(port, relay=True) for port in ports]
+        for n in self.nodes:
+            n.start()
+        time.sleep(WAIT_TIME)
+        return ports
+
+    def tearDown(self):
+        for n in self.nodes:
+            n.stop()
+
+    def check_converges(self):
+        for i in (1, len(self.nodes) - 1, 0):
+            m = 'from %d' % i
+            self.nodes[i].set_clipboard(m)
+            time.sleep(WAIT_TIME * 2)
+            for other in self.nodes:
+                self.assertEqual(other.get_clipboard(), m)
+
+    def test_star(self):
+        # every leaf is only connected to the hub, which has more peers than
+        # it pushes a clipboard to, so most leaves have to fetch it
+        ports = self.start(9)
+        for n in self.nodes[1:]:
+            n.connect('localhost', ports[0])
+        time.sleep(WAIT_TIME)
+        self.check_converges()
+
+    def test_chain(self):
+        ports = self.start(7)
+        for n, port in zip(self.nodes, ports[1:]):
+            n.connect('localhost', port)
+        time.sleep(WAIT_TIME)
+        self.check_converges()
+
+    def test_mesh_traffic(self):
+        ports = self.start(8)
+        for i, n in enumerate(self.nodes):
+            for port in ports[i + 1:]:
+                n.connect('localhost', port)
+        time.sleep(WAIT_TIME * 2)
+        m = ''.join('%08x' % random.getrandbits(32) for i in xrange(128 * 1024))
+        sent = sum(n.get_statistics()['bytes_sent'] for n in self.nodes)
+        self.nodes[0].set_clipboard(m)
+        start = time.time()
+        for n in self.nodes:
+            while n.get_clipboard(wait = 0) != m:
+                self.assertTrue(time.time() - start < 10)
+                time.sleep(WAIT_TIME)
+        time.sleep(WAIT_TIME)
+        sent = sum(n.get_statistics()['bytes_sent']
+                   for n in self.nodes) - sent
+        # pushing it to every peer from every node would take about
+        # len(self.nodes) ** 2 times its size
+        self.assertTrue(sent < 2 * len(self.nodes) * len(m))
+
+class TestAnnounce(unittest.TestCase):
+    def setUp(self):
+        self.port1 = random.randint(20000, 30000)
+        self.port2 = random.randint(20000, 30000)
+        self.n1 = Network(self.port1, prefetch_size=1000)
+        self.n2 = Network(self.port2, announce=True)
+        self.n1.start()
+        self.n2.start()
+        time.sleep(WAIT_TIME)
+        self.n2.connect('localhost', self.port1)
+        time.sleep(WAIT_TIME)
+
+    def tearDown(self):
+        self.n1.stop()
+        self.n2.stop()
+
+    def test_fetch_on_get(self):
+        m = ''.join(chr(random.getrandbits(8)) for i in xrange(100000))
+        sent = self.n2.get_statistics()['bytes_sent']
+        self.n2.set_clipboard(m)
+        time.sleep(WAIT_TIME)
+        # only the announcement went out
+        self.assertTrue(self.n2.get_statistics()['bytes_sent'] - sent < 1000)
+        self.assertEqual(self.n1.get_clipboard_data_type(), info.TXT)
+        self.assertEqual(self.n1.get_clipboard(wait=0), None)
+
+        self.assertEqual(self.n1.get_clipboard(), m)
+        self.assertTrue(self.n2.get_statistics()['bytes_sent'] - sent >
+                        len(m))
+
+    def test_prefetch(self):
+        self.n2.set_clipboard('small')
+        time.sleep(WAIT_TIME)
+        self.assertEqual(self.n1.get_clipboard(wait=0), 'small')
+
+    def test_announce_seen_before(self):
+        m = 'y' * 100000
+        self.n2.set_clipboard(m)
+        time.sleep(WAIT_TIME)
+        self.assertEqual(self.n1.get_clipboard(), m)
+        self.n2.set_clipboard('other')
+        time.sleep(WAIT_TIME)
+
+        # switching back needs no fetch
+        self.n2.set_clipboard(m)
+        time.sleep(WAIT_TIME)
+        self.assertEqual(self.n1.get_clipboard(wait=0), m)
+
+class TestMessageParser(unittest.TestCase):
+    def _message(self, payload, seq=1):
+        m = Message(1234, payload)
+        m.set_sequence_number(seq)
+        return m
+
+    def test_round_trip(self):
+        raw = self._message('hello', 7).raw()
+        m, rest = Message.parse_message(raw + 'extra')
+        self.assertEqual(m.get_payload(), 'hello')
+        self.assertEqual(m.get_uid(), 1234)
+        self.assertEqual(m.get_sequence_number(), 7)
+        self.assertEqual(m.get_type(), Message.CLIPBOARD)
+        self.assertEqual(rest, 'extra')
+
+        self.assertEqual(Message.parse_message(raw[:-1]), (None, raw[:-1]))
+
+    def test_segmented_stream(self):
+        payloads = ['', 'a', 'x' * network.CHUNK_SIZE, 'end']
+        stream = ''.join(self._message(p, i).raw()
+                         for i, p in enumerate(payloads))
+
+        parser = MessageParser()
+        received = []
+        pos = 0
+        while pos < len(stream):
+            n = random.randint(1, 5000)
+            parser.feed(stream[pos:pos + n])
+            pos += n
+            m = parser.next_message()
+            while m is not None:
+                received.append(m)
+                m = parser.next_message()
+
+        self.assertEqual([m.get_payload() for m in received], payloads)
+        self.assertEqual([m.get_sequence_number() for m in received],
+                         range(len(payloads)))
+        self.assertEqual(parser.buffered(), 0)
+
+    def test_views_survive_later_reads(self):
+        parser = MessageParser()
+        parser.feed(self._message('first').raw())
+        first = parser.next_message()
+        parser.feed(self._message('second').raw() + self._message('x').raw())
+        second = parser.next_message()
+        self.assertEqual(first.get_payload_view().tobytes(), 'first')
+        self.assertEqual(second.get_payload(), 'second')
+
+    def test_receive_large_frame(self):
+        a, b = socket.socketpair()
+        payload = 'z' * network.CHUNK_SIZE
+        sender = threading.Thread(target=a.sendall,
+                                  args=(self._message(payload).raw(),))
+        sender.start()
+
+        parser = MessageParser()
+        reads = 0
+        m = None
+        while m is None:
+            self.assertTrue(parser.receive(b) > 0)
+            reads += 1
+            m = parser.next_message()
+        sender.join()
+        a.close()
+        b.close()
+
+        self.assertEqual(m.get_payload(), payload)
+        # reads grow to the announced frame size rather than RECV_SIZE
+        self.assertTrue(reads < len(payload) / network.RECV_SIZE / 2)
+
+    def test_bad_magic(self):
+        parser = MessageParser()
+        parser.feed('XX' + self._message('data').raw()[2:])
+        self.assertRaises(ProtocolError, parser.next_message)
+
+    def test_forged_length(self):
+        # refused from the header alone, before room is made for the payload
+        header = network.HEADER.pack(network.MAGIC, network.PROTOCOL_VERSION,
+                                     Message.CLIPBOARD, 0, 1234, 1, 1 << 30)
+        parser = MessageParser()
+        parser.feed(header)
+        self.assertRaises(ProtocolError, parser.next_message)
+        self.assertTrue(parser.read_size() <= network.RECV_SIZE)
+
+    def test_transfer_grows(self):
+        t = network.IncomingTransfer(1234, 1, network.MAX_PAYLOAD_SIZE,
+                                     '\0' * network.DIGEST_SIZE)
+        t.add(0, 'abc', network.MAX_PAYLOAD_SIZE, '\0' * network.DIGEST_SIZE)
+        # only what has arrived is held
+        self.assertEqual(t.transferred(), 3)
+        self.assertEqual(len(t.message().get_payload_view()), 3)
+
+class TestSendQueue(unittest.TestCase):
+    def setUp(self):
+        a, b = socket.socketpair()
+        self.sender = Connection(a)
+        self.receiver = Connection(b)
+
+    def tearDown(self):
+        self.sender.close()
+        self.receiver.close()
+
+    def _receive_all(self, last_seq):
+        received = []
+        while self.sender.wants_write() or not received or \
+                received[-1].get_sequence_number() != last_seq:
+            self.assertTrue(self.sender.flush())
+            self.receiver.receive(READ_BUDGET)
+            m = self.receiver.get_next_message()
+            while m is not None:
+                received.append(m)
+                m = self.receiver.get_next_message()
+        return received
+
+    def test_slow_peer_gets_latest(self):
+        # the receiver doesn't read yet, so most of this stays queued
+        for i in xrange(40):
+            m = Message(1, ('%02d' % i) * 30000)
+            m.set_sequence_number(i)
+            self.assertTrue(self.sender.send(m))
+
+        self.assertTrue(self.sender.statistics.superseded > 0)
+        self.assertTrue(self.sender.pending_bytes() < 512 * 1024)
+
+        received = self._receive_all(39)
+
+        seqs = [m.get_sequence_number() for m in received]
+        self.assertEqual(seqs, sorted(seqs))
+        self.assertEqual(len(seqs) + self.sender.statistics.superseded, 40)
+        self.assertEqual(received[-1].get_payload(), '39' * 30000)
+
+    def test_control_frames_kept(self):
+        for i in xrange(40):
+            m = Message(1, ('%02d' % i) * 30000)
+            m.set_sequence_number(i)
+            self.assertTrue(self.sender.send(m))
+            want = Message(1, m.get_digest(), Message.WANT)
+            want.set_sequence_number(i)
+            self.assertTrue(self.sender.send(want))
+
+        received = self._receive_all(39)
+        wants = [m.get_sequence_number() for m in received
+                 if m.get_type() == Message.WANT]
+        self.assertEqual(wants, range(40))
+        clipboards = [m for m in received if m.get_type() == Message.CLIPBOARD]
+        self.assertEqual(len(clipboards) + self.sender.statistics.superseded,
+                         40)
+        self.assertEqual(clipboards[-1].get_payload(), '39' * 30000)
+
+    def test_chunked_transfer_cancelled(self):
+        big = Message(1, 'a' * (4 * 1024 * 1024))
+        big.set_sequence_number(1)
+        self.sender.send(big)
+        # start receiving, but not all of it
+        self.receiver.receive(READ_BUDGET)
+        self.assertEqual(self.receiver.get_next_message(), None)
+
+        small = Message(1, 'b' * 100)
+        small.set_sequence_number(2)
+        self.sender.send(small)
+
+        received = self._receive_all(2)
+        self.assertEqual([m.get_payload() for m in received], ['b' * 100])
+
+        states = [p.state for p in self.sender.take_progress()]
+        self.assertEqual(states[-1], TransferProgress.CANCELLED)
+        states = [p.state for p in self.receiver.take_progress()]
+        self.assertEqual(states[-1], TransferProgress.CANCELLED)
+
+    def test_receive_nothing(self):
+        # a readiness wakeup with no data isn't a closed connection
+        self.assertTrue(self.receiver.receive(READ_BUDGET))
+        self.assertEqual(self.receiver.get_next_message(), None)
+        self.sender.close()
+        self.assertFalse(self.receiver.receive(READ_BUDGET))
+
+    def _exchange_hellos(self):
+        self.sender.send_hello(1)
+        self.receiver.send_hello(2)
+        for c in (self.sender, self.receiver):
+            c.flush()
+        for c in (self.sender, self.receiver):
+            c.receive()
+            self.assertEqual(c.get_next_message().get_type(), Message.HELLO)
+
+    def test_compression(self):
+        self._exchange_hellos()
+        text = '\n'.join('line %d of some log output' % i
+                         for i in xrange(50000))
+        small = Message(1, text[:60000])
+        small.set_sequence_number(1)
+        big = Message(1, text)
+        big.set_sequence_number(2)
+        before = self.sender.statistics.bytes_sent
+        self.sender.send(small)
+        self.sender.send(big)
+
+        received = self._receive_all(2)
+        self.assertEqual([m.get_payload() for m in received],
+                         [text[:60000], text])
+        self.assertTrue(self.sender.statistics.bytes_sent - before <
+                        (len(text) + 60000) / 3)
+
+    def test_incompressible(self):
+        self._exchange_hellos()
+        data = ''.join(chr(random.randint(0, 255)) for i in xrange(200000))
+        m = Message(1, data)
+        m.set_sequence_number(1)
+        before = self.sender.statistics.bytes_sent
+        self.sender.send(m)
+        received = self._receive_all(1)
+        self.assertEqual(received[0].get_payload(), data)
+        self.assertTrue(self.sender.statistics.bytes_sent - before > len(data))
+
+    def test_chunked_transfer(self):
+        payload = ''.join(chr(random.randint(0, 255)) for i in xrange(1000))
+        payload *= 1000
+        m = Message(1, payload)
+        m.set_sequence_number(5)
+        self.sender.send(m)
+
+        received = self._receive_all(5)
+        self.assertEqual(len(received), 1)
+        self.assertEqual(received[0].get_type(), Message.CLIPBOARD)
+        self.assertEqual(received[0].get_payload(), payload)
+        progress = self.receiver.take_progress()
+        self.assertEqual(progress[-1].state, TransferProgress.DONE)
+        self.assertEqual(progress[-1].transferred, len(payload))
@@ -0,0 +1,83 @@
+"""
+    Cross-platform clipboard syncing tool
+    Copyright (C) 2013  Syncboard
+
+    This program is free software; you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation; either version 2 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License along
+    with this program; if not, write to the Free Software Foundation, Inc.,
+    51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+"""
+
+import unittest
+
+from registry import Registry
+
+class TestRegistry(unittest.TestCase):
+    def setUp(self):
+        self.registry = Registry()
+        self.events = []
+        self.registry.subscribe(
+            lambda event, entry: self.events.append((event, entry)))
+
+    def test_lookup(self):
+        r = self.registry
+        self.assertTrue(r.add('a', '10.0.0.1', 5000))
+        self.assertTrue(r.add('b', '10.0.0.1', 5001))
+        self.assertTrue(r.add('c', '10.0.0.2'))
+        self.assertEqual(r.get('10.0.0.1', 5001), 'b')
+        self.assertTrue(r.get('10.0.0.1') in ('a', 'b'))
+        self.assertEqual(sorted(r.get_all('10.0.0.1')), ['a', 'b'])
+        self.assertEqual(r.get('10.0.0.2'), 'c')
+        self.assertEqual(r.get('10.0.0.2', 5000), None)
+        self.assertEqual(r.get('10.0.0.3'), None)
+        self.assertEqual(len(r), 3)
+
+    def test_duplicate(self):
+        r = self.registry
+        self.assertTrue(r.add('a', '10.0.0.1'))
+        self.assertFalse(r.add('b', '10.0.0.1'))
+        self.assertEqual(r.get('10.0.0.1'), 'a')
+        self.assertEqual(r.entries(), ['a'])
+
+    def test_remove(self):
+        r = self.registry
+        r.add('a', '10.0.0.1', 5000, uid=7)
+        self.assertTrue(r.remove('a'))
+        self.assertFalse(r.remove('a'))
+        self.assertEqual(r.get('10.0.0.1'), None)
+        self.assertEqual(r.get_by_uid(7), None)
+        self.assertFalse('a' in r)
+
+    def test_uid(self):
+        r = self.registry
+        r.add('a', '10.0.0.1', 5000)
+        r.add('b', '10.0.0.1', 5001)
+        r.set_uid('a', 7)
+        self.assertEqual(r.get_by_uid(7), 'a')
+        # a new connection from the same peer takes over its uid
+        r.set_uid('b', 7)
+        self.assertEqual(r.get_by_uid(7), 'b')
+        r.remove('a')
+        self.assertEqual(r.get_by_uid(7), 'b')
+
+    def test_notifications(self):
+        r = self.registry
+        r.add('a', '10.0.0.1')
+        r.changed('a')
+        r.changed('not there')
+        r.remove('a')
+        self.assertEqual(self.events, [(Registry.ADDED, 'a'),
+                                       (Registry.CHANGED, 'a'),
+                                       (Registry.REMOVED, 'a')])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,87 @@
+"""
+    Cross-platform clipboard syncing tool
+    Copyright (C) 2013  Syncboard
+
+    This program is free software; you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation; either version 2 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License along
+    with this program; if not, write to the Free Software Foundation, Inc.,
+    51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+"""
+
+import socket
+import threading
+import time
+import unittest
+
+from resolver import Resolver
+
+class TestResolver(unittest.TestCase):
+    def setUp(self):
+        self.lookups = []
+        self.delay = 0
+        self.resolver = Resolver(lookup=self.lookup, ttl=0.2,
+                                 negative_ttl=0.2)
+
+    def lookup(self, name):
+        self.lookups.append(name)
+        time.sleep(self.delay)
+        if name == 'nowhere':
+            raise socket.gaierror(-2, 'Name or service not known')
+        return '10.0.0.%d' % len(self.lookups)
+
+    def test_cached(self):
+        self.assertEqual(self.resolver.resolve_wait('host'), '10.0.0.1')
+        self.assertEqual(self.resolver.resolve_wait('host'), '10.0.0.1')
+        self.assertEqual(self.resolver.cached('host'), '10.0.0.1')
+        self.assertEqual(self.lookups, ['host'])
+
+    def test_expiry(self):
+        self.resolver.resolve_wait('host')
+        time.sleep(0.3)
+        self.assertEqual(self.resolver.cached('host'), None)
+        self.assertEqual(self.resolver.resolve_wait('host'), '10.0.0.2')
+
+    def test_negative(self):
+        for i in range(3):
+            self.assertRaises(socket.gaierror, self.resolver.resolve_wait,
+                              'nowhere')
+        self.assertEqual(self.lookups, ['nowhere'])
+
+    def test_literal(self):
+        self.assertEqual(self.resolver.resolve_wait('192.168.1.2'),
+                         '192.168.1.2')
+        self.assertEqual(self.lookups, [])
+
+    def test_does_not_block(self):
+        self.delay = 0.2
+        results = []
+        done = threading.Event()
+        def resolved(address, err):
+            results.append(address)
+            done.set()
+        start = time.time()
+        self.resolver.resolve('slow', resolved)
+        self.resolver.resolve('slow', resolved)
+        self.assertTrue(time.time() - start < 0.1)
+        done.wait(1)
+        time.sleep(0.05)
+        # both requests shared one lookup
+        self.assertEqual(results, ['10.0.0.1', '10.0.0.1'])
+        self.assertEqual(self.lookups, ['slow'])
+
+    def test_timeout(self):
+        self.delay = 0.2
+        self.assertRaises(socket.timeout, self.resolver.resolve_wait, 'slow',
+                          0.05)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,74 @@
+"""
+    Cross-platform clipboard syncing tool
+    Copyright (C) 2013  Syncboard
+
+    This program is free software; you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation; either version 2 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License along
+    with this program; if not, write to the Free Software Foundation, Inc.,
+    51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+"""
+
+import os
+import shutil
+import tempfile
+import unittest
+
+import state
+from state import StateFile
+
+class TestStateFile(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'sub', 'state')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_round_trip(self):
+        f = StateFile(self.path)
+        self.assertEqual(f.load(), None)
+        self.assertTrue(f.save({'a': [1, 2]}, ['\0binary', '']))
+        self.assertEqual(StateFile(self.path).load(),
+                         ({'a': [1, 2]}, ['\0binary', '']))
+        self.assertEqual(os.listdir(os.path.dirname(self.path)), ['state'])
+
+    def test_unchanged_not_written(self):
+        f = StateFile(self.path)
+        self.assertTrue(f.save({'a': 1}))
+        self.assertFalse(f.save({'a': 1}))
+        self.assertTrue(f.save({'a': 2}))
+        f = StateFile(self.path)
+        f.load()
+        self.assertFalse(f.save({'a': 2}))
+
+    def test_damaged(self):
+        data = state.encode({'a': 1}, ['blob'])
+        self.assertEqual(state.decode(data), ({'a': 1}, ['blob']))
+        for bad in (data[:-1], data[:5], data[:-1] + 'x', 'XXXX' + data[4:]):
+            self.assertRaises(ValueError, state.decode, bad)
+        os.makedirs(os.path.dirname(self.path))
+        with open(self.path, 'wb') as f:
+            f.write(data[:-1])
+        self.assertEqual(StateFile(self.path).load(), None)
+
+    def test_changed(self):
+        saved = []
+        def get_state():
+            saved.append(len(saved))
+            return {'n': saved[-1]}, ()
+        f = StateFile(self.path, get_state, delay=0.1)
+        for i in range(10):
+            f.changed()
+        f.close()
+        # the burst is saved once
+        self.assertEqual(saved, [0])
+        self.assertEqual(StateFile(self.path).load(), ({'n': 0}, []))